@@ -0,0 +1,398 @@
+"""Command line interface for PEG.
+
+    python peg.py build design.csv -o experiment.html --repeat 2 --seed 42
+    python peg.py validate design.csv
+    python peg.py preview design.csv
+    python peg.py build design.csv --profile profile.json
+
+Commands import their modules lazily so that startup stays fast and no
+command pulls in tkinter.
+"""
+import argparse
+import sys
+
+
+def cmd_build(args):
+    from peg_assets import AssetError
+    from peg_build import DesignError, build
+    profile = None
+    if args.profile:
+        from peg_profile import BuildProfile
+        profile = BuildProfile(memory=not args.profile_no_memory)
+    try:
+        schedule = build(args.design, args.output, repeat_count=args.repeat,
+                      randomize=args.randomize, seed=args.seed,
+                      save_to_server=args.server, images_dir=args.images_dir,
+                      output_format=args.format, stimulus_pool_limit=args.dom_pool_size,
+                      asset_mode=args.assets, downsize=args.downsize,
+                      stream_results=args.stream_results, stream_interval=args.stream_interval,
+                      result_schema=args.results, profile=profile)
+    except (DesignError, AssetError, OSError) as e:
+        print(f"peg build: {e}", file=sys.stderr)
+        return 1
+    if profile is not None:
+        write_profile(args, profile)
+    out = sys.stderr if args.profile == "-" else sys.stdout  # Keep stdout for the JSON
+    if schedule.conditional:
+        print(f"Wrote {args.output} ({len(schedule.segments)} blocks with conditions, "
+              f"trial order follows responses in the browser, seed {schedule.seed})", file=out)
+    elif args.format == "runtime" and not schedule.seeded:
+        print(f"Wrote {args.output} ({len(schedule)} trials, seeded per session in the browser)", file=out)
+    elif args.format == "runtime":
+        print(f"Wrote {args.output} ({len(schedule)} trials, expanded in the browser with seed {schedule.seed})",
+              file=out)
+    else:
+        print(f"Wrote {args.output} ({len(schedule)} trials, seed {schedule.seed})", file=out)
+    return 0
+
+
+def write_profile(args, profile):
+    import json
+    from peg_profile import format_profile
+    report = profile.report(design=args.design, output=args.output, format=args.format,
+                            assets=args.assets, results=args.results, repeat=args.repeat)
+    if args.profile == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(args.profile, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("\n".join(format_profile(report)), file=sys.stderr)
+    print(f"Wrote profile to {args.profile}", file=sys.stderr)
+
+
+def cmd_batch(args):
+    from peg_assets import AssetError
+    from peg_build import DesignError
+    from peg_batch import build_batch
+    try:
+        records, elapsed = build_batch(args.design, args.manifest, args.output_dir,
+                                       repeat_count=args.repeat, randomize=args.randomize,
+                                       seed=args.seed, images_dir=args.images_dir,
+                                       workers=args.workers, asset_mode=args.assets,
+                                       downsize=args.downsize, save_to_server=args.server,
+                                       output_format=args.format,
+                                       stimulus_pool_limit=args.dom_pool_size,
+                                       stream_results=args.stream_results,
+                                       stream_interval=args.stream_interval,
+                                       result_schema=args.results)
+    except (DesignError, AssetError, OSError) as e:
+        print(f"peg batch: {e}", file=sys.stderr)
+        return 1
+    rate = len(records) / elapsed if elapsed > 0 else float('inf')
+    print(f"Built {len(records)} files in {args.output_dir} in {elapsed:.2f}s ({rate:.1f} files/s)")
+    return 0
+
+
+def cmd_validate(args):
+    from peg_build import DesignError, read_design
+    from peg_validate import validate_design
+    try:
+        rows = read_design(args.design)
+    except (DesignError, OSError) as e:
+        print(f"peg validate: {e}", file=sys.stderr)
+        return 1
+    errors = validate_design(rows, None if args.skip_images else args.images_dir)
+    for error in errors:
+        print(f"{args.design}: {error}")
+    if errors:
+        print(f"{len(errors)} problem(s) found", file=sys.stderr)
+        return 1
+    print(f"{args.design}: OK ({len(rows)} rows)")
+    return 0
+
+
+def cmd_serve(args):
+    import asyncio
+    from peg_server import serve
+    ready = lambda port: print(f"Listening on http://{args.host}:{port}", flush=True)
+    try:
+        asyncio.run(serve(args.host, args.port, args.results_dir, args.shards, ready))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_preview(args):
+    import os
+    import asyncio
+    import webbrowser
+    from peg_assets import AssetError
+    from peg_build import DesignError, build
+    from peg_cache import BuildCache
+    from peg_preview import PreviewServer, serve_preview, watch
+    from peg_server import ResultStore
+    cache = BuildCache()
+
+    def rebuild():
+        try:
+            build(args.design, args.output, repeat_count=args.repeat,
+                  randomize=args.randomize, seed=args.seed,
+                  save_to_server=args.server, images_dir=args.images_dir,
+                  output_format=args.format, stimulus_pool_limit=args.dom_pool_size,
+                  asset_mode=args.assets, downsize=args.downsize, cache=cache,
+                  stream_results=args.stream_results, stream_interval=args.stream_interval,
+                  result_schema=args.results)
+        except (DesignError, AssetError, OSError) as e:
+            print(f"peg preview: {e}", file=sys.stderr, flush=True)
+            return False
+        return True
+
+    if not rebuild():
+        return 1
+    app = PreviewServer(os.path.dirname(os.path.abspath(args.output)), ResultStore(args.results_dir),
+                        args.images_dir, os.path.basename(args.output))
+
+    def ready(url):
+        print(f"Previewing {args.output} at {url}/ (rebuilt when {args.design} or {args.images_dir} change)",
+              flush=True)
+        if not args.no_open:
+            webbrowser.open(url + "/")
+
+    async def run():
+        watcher = asyncio.ensure_future(watch(app, rebuild, [args.design, args.images_dir]))
+        try:
+            await serve_preview(app, args.host, args.port, ready)
+        finally:
+            watcher.cancel()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"peg preview: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_loadtest(args):
+    import json
+    from peg_loadtest import run_load_test
+    stats = run_load_test(args.url, args.concurrency, args.duration, args.trials,
+                          not args.no_gzip, args.shards)
+    print(json.dumps(stats, indent=2))
+    return 1 if stats['errors'] else 0
+
+
+def cmd_rehydrate(args):
+    import json
+    from peg_results import iter_documents
+    try:
+        documents = list(iter_documents(args.input))
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        print(f"peg rehydrate: {e}", file=sys.stderr)
+        return 1
+    with open(args.output, "w", encoding="utf-8") as f:
+        if len(documents) == 1 and not args.lines:
+            json.dump(documents[0], f, indent=2)
+        else:
+            for document in documents:
+                f.write(json.dumps(document) + "\n")
+    print(f"Wrote {len(documents)} document(s) to {args.output}")
+    return 0
+
+
+def cmd_aggregate(args):
+    import json
+    from peg_aggregate import aggregate, summarize
+    try:
+        table, stats = aggregate(args.results_dir, workers=args.workers, use_cache=not args.no_cache)
+        if args.output:
+            table.write_csv(args.output)
+        if args.parquet:
+            table.write_parquet(args.parquet)
+    except (OSError, ValueError, KeyError, IndexError, TypeError, ImportError) as e:
+        print(f"peg aggregate: {e}", file=sys.stderr)
+        return 1
+    summary = summarize(table)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    print(f"{summary['trials']} trials from {summary['participants']} sessions "
+          f"({stats['read']} file(s) read, {stats['cached']} cached)")
+    print(f"{'block':>8} {'trials':>8} {'accuracy':>9} {'timeouts':>9} {'mean RT':>9} {'median RT':>10}")
+    for b in summary['blocks']:
+        accuracy = '' if b['accuracy'] is None else f"{b['accuracy']:.3f}"
+        print(f"{b['block']!s:>8} {b['trials']:>8} {accuracy:>9} {b['timeouts']:>9} "
+              f"{b['meanRT'] if b['meanRT'] is not None else '':>9} "
+              f"{b['medianRT'] if b['medianRT'] is not None else '':>10}")
+    return 0
+
+
+def cmd_timing(args):
+    import json
+    from peg_timing import timing_report
+    thresholds = {}
+    for item in args.threshold or []:
+        name, _, value = item.partition("=")
+        try:
+            thresholds[name.strip()] = float(value)
+        except ValueError:
+            print(f"peg timing: threshold must be NAME=NUMBER: {item}", file=sys.stderr)
+            return 1
+    try:
+        report = timing_report(args.results, thresholds)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        print(f"peg timing: {e}", file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    flagged = [session for session in report if session['flags']]
+    for session in (report if args.all else flagged):
+        name = session['experimentId'] + (f" ({session['participant']})" if session['participant'] else "")
+        print(f"{name}: {'; '.join(session['flags']) or 'OK'}")
+    print(f"{len(flagged)} of {len(report)} session(s) below timing thresholds")
+    return 0
+
+
+def cmd_bench(args):
+    import json
+    from peg_bench import compare, format_report, run_suite
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    report = run_suite(quick=args.quick, rounds=args.rounds, runtime=not args.no_runtime,
+                       only=args.case, max_trials=args.max_trials)
+    print("\n".join(format_report(report)))
+    if baseline is not None:
+        print("\n".join(compare(baseline, report)))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+    return 0
+
+
+def add_build_options(p):
+    p.add_argument("--repeat", type=int, default=1, help="number of times to repeat the whole sequence")
+    p.add_argument("--no-randomize", dest="randomize", action="store_false",
+                   help="keep blocks 100+ in design order")
+    p.add_argument("--server", action="store_true", help="post results to the PHP endpoint")
+    p.add_argument("--images-dir", default="images", help="directory holding referenced images (default: ./images)")
+    p.add_argument("--format", choices=["full", "compact", "runtime"], default="full",
+                   help="trial data layout in the HTML (compact: unique templates plus an index sequence; "
+                        "runtime: the browser expands and shuffles the design with a per-session seed)")
+    p.add_argument("--dom-pool-size", type=int, default=0,
+                   help="keep at most N pre-rendered stimuli in the browser, evicting the least recently used "
+                        "(default: 0, keep all)")
+    p.add_argument("--assets", choices=["relative", "hashed", "embed"], default="relative",
+                   help="how images are shipped: images/ paths, content-hashed assets/ files, "
+                        "or data URIs embedded in the HTML (default: relative)")
+    p.add_argument("--downsize", type=float, default=None, metavar="SCALE",
+                   help="scale images down to their width/height option times SCALE (needs Pillow)")
+    p.add_argument("--stream-results", type=int, default=0, metavar="N",
+                   help="post results to the server every N trials while the experiment runs, buffering "
+                        "unsent trials in the browser so a reload resumes (implies --server)")
+    p.add_argument("--results", choices=["full", "lean", "columnar"], default="full",
+                   help="result record layout: full trial copies, lean records (template ID plus observed "
+                        "values, templates sent once) or lean records stored column by column (default: full)")
+    p.add_argument("--stream-interval", type=float, default=10, metavar="SECONDS",
+                   help="with --stream-results, also post pending trials this often (default: 10)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="peg", description="Psychological Experiment Generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("build", help="compile a design CSV into an experiment HTML file")
+    p.add_argument("design", help="design CSV file")
+    p.add_argument("-o", "--output", default="experiment.html", help="output HTML file (default: experiment.html)")
+    p.add_argument("--seed", type=int, default=None, help="seed for block randomization")
+    p.add_argument("--profile", metavar="FILE",
+                   help="write per-stage timings, counters and peak memory as JSON to FILE ('-' for stdout)")
+    p.add_argument("--profile-no-memory", action="store_true",
+                   help="with --profile, skip memory tracing, which slows the build down")
+    add_build_options(p)
+    p.set_defaults(func=cmd_build)
+
+    p = commands.add_parser("batch", help="build one experiment file per participant in a manifest")
+    p.add_argument("design", help="design CSV file")
+    p.add_argument("manifest", help="participant manifest CSV (participant[,seed][,design])")
+    p.add_argument("-o", "--output-dir", default="experiments", help="output directory (default: experiments)")
+    p.add_argument("--seed", type=int, default=None,
+                   help="base seed used to derive seeds for participants without one")
+    p.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    add_build_options(p)
+    p.set_defaults(func=cmd_batch)
+
+    p = commands.add_parser("validate", help="check a design CSV and list every problem")
+    p.add_argument("design", help="design CSV file")
+    p.add_argument("--images-dir", default="images", help="directory holding referenced images (default: ./images)")
+    p.add_argument("--skip-images", action="store_true", help="do not check that referenced images exist")
+    p.set_defaults(func=cmd_validate)
+
+    p = commands.add_parser("preview", help="build a design, serve it locally and rebuild it when it changes")
+    p.add_argument("design", help="design CSV file")
+    p.add_argument("-o", "--output", default="experiment.html", help="output HTML file (default: experiment.html)")
+    p.add_argument("--seed", type=int, default=None, help="seed for block randomization")
+    p.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: 127.0.0.1)")
+    p.add_argument("--port", type=int, default=8000, help="port to listen on, 0 for any free port (default: 8000)")
+    p.add_argument("--results-dir", default="experiment_results",
+                   help="directory for results posted by the experiment (default: experiment_results)")
+    p.add_argument("--no-open", action="store_true", help="do not open the experiment in a browser")
+    add_build_options(p)
+    p.set_defaults(func=cmd_preview)
+
+    p = commands.add_parser("serve", help="run the results ingestion server (replaces save_peg_results.php)")
+    p.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: 127.0.0.1)")
+    p.add_argument("--port", type=int, default=8000, help="port to listen on, 0 for any free port (default: 8000)")
+    p.add_argument("--results-dir", default="experiment_results",
+                   help="directory for the results shards (default: experiment_results)")
+    p.add_argument("--shards", type=int, default=16, help="number of append-only shard files (default: 16)")
+    p.set_defaults(func=cmd_serve)
+
+    p = commands.add_parser("loadtest", help="measure results server throughput and latency")
+    p.add_argument("--url", default=None,
+                   help="endpoint of a running server (default: start a local one with a temporary results directory)")
+    p.add_argument("--concurrency", type=int, default=100, help="simultaneous participants (default: 100)")
+    p.add_argument("--duration", type=float, default=10.0, help="seconds to run (default: 10)")
+    p.add_argument("--trials", type=int, default=200, help="trials per submission (default: 200)")
+    p.add_argument("--no-gzip", action="store_true", help="send uncompressed bodies")
+    p.add_argument("--shards", type=int, default=16, help="shard files for the local server (default: 16)")
+    p.set_defaults(func=cmd_loadtest)
+
+    p = commands.add_parser("rehydrate", help="expand lean or columnar results into full trial records")
+    p.add_argument("input", help="downloaded results JSON file or results directory")
+    p.add_argument("-o", "--output", required=True, help="output file (JSON, or JSON Lines for several documents)")
+    p.add_argument("--lines", action="store_true", help="always write JSON Lines")
+    p.set_defaults(func=cmd_rehydrate)
+
+    p = commands.add_parser("aggregate", help="combine collected results into one trial table with summaries")
+    p.add_argument("results_dir", help="directory of downloaded results files and/or results server shards")
+    p.add_argument("-o", "--output", default=None, help="write the trial table as CSV")
+    p.add_argument("--parquet", default=None, help="write the trial table as Parquet (needs pyarrow)")
+    p.add_argument("--summary", default=None, help="write per-block and per-session summaries as JSON")
+    p.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    p.add_argument("--no-cache", action="store_true",
+                   help="read every file again instead of only new or grown ones")
+    p.set_defaults(func=cmd_aggregate)
+
+    p = commands.add_parser("timing", help="flag sessions whose browser timing quality was poor")
+    p.add_argument("results", help="results JSON file or results directory")
+    p.add_argument("--threshold", action="append", metavar="NAME=VALUE",
+                   help="override a threshold, e.g. max_onset_jitter_p95=4 (repeatable; see peg_timing.py)")
+    p.add_argument("-o", "--output", default=None, help="write per-session metrics and flags as JSON")
+    p.add_argument("--all", action="store_true", help="list every session, not only flagged ones")
+    p.set_defaults(func=cmd_timing)
+
+    p = commands.add_parser("bench", help="benchmark the build pipeline and the generated runtime")
+    p.add_argument("-o", "--output", default=None, help="write the results as JSON")
+    p.add_argument("--quick", action="store_true", help="skip the largest cases")
+    p.add_argument("--case", action="append", default=None, help="run only this case (repeatable)")
+    p.add_argument("--rounds", type=int, default=3, help="timing rounds per case, best is kept (default: 3)")
+    p.add_argument("--no-runtime", action="store_true", help="skip the Node.js runtime measurements")
+    p.add_argument("--max-trials", type=int, default=2000,
+                   help="trials to run per runtime measurement (default: 2000)")
+    p.add_argument("--compare", default=None, metavar="BASELINE",
+                   help="compare against an earlier JSON report")
+    p.set_defaults(func=cmd_bench)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+"""Trial-level aggregation of collected results.
+
+Scans a directory of results, i.e. ``experiment_data_*.json`` files saved by
+``downloadData`` or ``save_peg_results.php`` and/or the ``shard-NN.jsonl``
+files written by ``peg serve``, and builds one table with a row per trial,
+keyed by experimentId, block, repetition and trialIndex:
+
+    python peg.py aggregate experiment_results -o trials.csv --summary summary.json
+
+Files are parsed in parallel worker processes. The table is kept column by
+column in typed arrays, and per-block summaries (trials, accuracy, timeouts,
+mean/median RT overall and by correctness) are computed from those columns.
+
+Re-runs are incremental. What each file contributed is cached next to the
+results, together with its size and modification time. Unchanged files are
+not read again, and shards, which are append-only, are read from where the
+last run stopped. NumPy and pyarrow are optional. With NumPy, summaries are
+grouped on the column arrays instead of row by row, and NumPy is needed for
+:meth:`TrialTable.to_numpy`; pyarrow is needed for Parquet output.
+"""
+import os
+import csv
+import json
+import math
+import pickle
+import statistics
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from peg_build import write_atomic
+from peg_results import trial_rows
+
+# (name, array typecode or None for a Python list)
+COLUMNS = (
+    ('experimentId', None), ('participant', None), ('block', 'i'), ('repetition', 'i'),
+    ('blockRepetition', 'i'), ('trialIndex', 'i'), ('actualResponse', None),
+    ('responseTime', 'd'), ('isCorrect', 'b'), ('timeout', 'b'), ('droppedFrames', 'i')
+)
+MISSING = -1  # Integer columns of records without the field, e.g. no block
+CACHE_NAME = ".peg_aggregate.cache"
+CACHE_VERSION = 1
+
+
+def _int(value, default):
+    """``value`` as a 32-bit int, or ``default`` if it is missing or not a number."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return default
+    return value if -2 ** 31 <= value < 2 ** 31 else default
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class TrialTable:
+    """Column-oriented trial table.
+
+    ``isCorrect`` is 1, 0 or -1 for unscored trials; ``responseTime`` is NaN
+    when there was no response; ``timeout`` is 1 when the trial ended
+    without one. ``block`` is :data:`MISSING` for records without a usable
+    one, and ``trialIndex`` falls back to the record's position.
+    """
+
+    def __init__(self):
+        self.columns = {name: array(typecode) if typecode else [] for name, typecode in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns['trialIndex'])
+
+    def append(self, experiment_id, participant, block, repetition, block_repetition, trial_index,
+               response, response_time, is_correct, dropped_frames):
+        c = self.columns
+        c['experimentId'].append(experiment_id)
+        c['participant'].append(participant)
+        c['block'].append(_int(block, MISSING))
+        c['repetition'].append(_int(repetition, 0))
+        c['blockRepetition'].append(_int(block_repetition, 0))
+        c['trialIndex'].append(_int(trial_index, MISSING))
+        c['actualResponse'].append(response)
+        c['responseTime'].append(_float(response_time) if response is not None else math.nan)
+        c['isCorrect'].append(-1 if is_correct is None else int(bool(is_correct)))
+        c['timeout'].append(int(response is None))
+        c['droppedFrames'].append(_int(dropped_frames, 0))
+
+    def extend(self, other):
+        for name, column in self.columns.items():
+            column.extend(other.columns[name])
+
+    def rows(self):
+        return zip(*(self.columns[name] for name, _ in COLUMNS))
+
+    def write_csv(self, path):
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([name for name, _ in COLUMNS])
+            for row in self.rows():
+                writer.writerow(['' if isinstance(v, float) and math.isnan(v) else v for v in row])
+
+    def to_numpy(self):
+        """The columns as NumPy arrays (string columns as object arrays)."""
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("to_numpy() requires NumPy (pip install numpy).")
+        return {name: np.frombuffer(column, dtype=column.typecode) if typecode else np.array(column, dtype=object)
+                for (name, typecode), column in zip(COLUMNS, self.columns.values())}
+
+    def write_parquet(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow (pip install pyarrow).")
+        table = pa.table({name: pa.array(column.tolist() if typecode else column)
+                          for (name, typecode), column in zip(COLUMNS, self.columns.values())})
+        pq.write_table(table, path)
+
+
+def _add_document(table, document, templates):
+    """Append one results document's trials; ``templates`` maps experimentId to its template table."""
+    if not isinstance(document, dict):
+        return  # Not a results document
+    experiment_id = document.get('experimentId')
+    participant = document.get('participant')
+    lean = document.get('resultSchema', 'full') != 'full'
+    if lean and isinstance(document.get('templates'), list):
+        # Only the block is needed from each template
+        templates[experiment_id] = [t.get('block') if isinstance(t, dict) else None
+                                    for t in document['templates']]
+    blocks = templates.get(experiment_id) if lean else None
+    if lean and blocks is None:
+        return  # Later streamed batch whose first batch is missing
+    trials = document.get('trials')
+    for i, record in enumerate(trial_rows(trials) if isinstance(trials, (list, dict)) else []):
+        if not isinstance(record, dict):
+            continue
+        if lean:
+            template_id = _int(record.get('templateId'), MISSING)
+            block = blocks[template_id] if 0 <= template_id < len(blocks) else None
+        else:
+            block = record.get('block')
+        table.append(experiment_id, participant, block, record.get('repetition'),
+                     record.get('blockRepetition'), _int(record.get('trialIndex'), i),
+                     record.get('actualResponse'), record.get('responseTime'),
+                     record.get('isCorrect'), record.get('droppedFrames'))
+
+
+def scan_file(job):
+    """Worker: parse one file, from ``offset`` for shards; returns its contribution."""
+    path, offset, templates = job
+    table = TrialTable()
+    if path.endswith('.jsonl'):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Being written: pick it up next run
+                offset += len(line)
+                try:
+                    document = json.loads(line)
+                except ValueError:
+                    continue  # Line torn by a crash
+                _add_document(table, document, templates)
+    else:
+        with open(path, 'rb') as f:
+            _add_document(table, json.load(f), templates)
+    return table, offset, templates
+
+
+def _results_files(results_dir):
+    for entry in os.scandir(results_dir):
+        name = entry.name
+        if entry.is_file() and (name.endswith('.json') or (name.startswith('shard-') and name.endswith('.jsonl'))):
+            yield entry
+
+
+def aggregate(results_dir, workers=None, cache_path=None, use_cache=True):
+    """Build the :class:`TrialTable` for ``results_dir``.
+
+    Returns ``(table, stats)`` where ``stats`` counts the files that were
+    read and those reused from the cache.
+    """
+    cache_path = cache_path or os.path.join(results_dir, CACHE_NAME)
+    cached = {}
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                state = pickle.load(f)
+            if state.get('version') == CACHE_VERSION:
+                cached = state['files']
+        except (OSError, pickle.PickleError, EOFError, AttributeError):
+            cached = {}
+
+    files, jobs = {}, []
+    for entry in sorted(_results_files(results_dir), key=lambda e: e.name):
+        st = entry.stat()
+        stat = (st.st_mtime_ns, st.st_size)
+        previous = cached.get(entry.name)
+        if previous and previous['stat'] == stat:
+            files[entry.name] = previous
+            continue
+        if previous and entry.name.endswith('.jsonl') and st.st_size >= previous['offset']:
+            # Append-only shard: continue after what was already read
+            files[entry.name] = dict(previous, stat=stat)
+            jobs.append((entry.name, (entry.path, previous['offset'], previous['templates'])))
+        else:
+            files[entry.name] = {'stat': stat, 'offset': 0, 'templates': {}, 'table': TrialTable()}
+            jobs.append((entry.name, (entry.path, 0, {})))
+
+    if len(jobs) > 4 and workers != 1:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(scan_file, [job for _, job in jobs],
+                                    chunksize=max(1, len(jobs) // (workers * 8))))
+    else:
+        results = [scan_file(job) for _, job in jobs]
+    for (name, _), (table, offset, templates) in zip(jobs, results):
+        files[name]['table'].extend(table)
+        files[name]['offset'] = offset
+        files[name]['templates'] = templates
+
+    if use_cache and jobs:
+        write_atomic(cache_path, pickle.dumps({'version': CACHE_VERSION, 'files': files}, pickle.HIGHEST_PROTOCOL))
+
+    table = TrialTable()
+    for name in sorted(files):
+        table.extend(files[name]['table'])
+    return table, {'files': len(files), 'read': len(jobs), 'cached': len(files) - len(jobs)}
+
+
+def _rt_stats(rts):
+    if not rts:
+        return None, None
+    return round(statistics.fmean(rts), 2), round(statistics.median(rts), 2)
+
+
+def _rt_stats_numpy(np, codes, rts, groups):
+    """Mean and median RT per group code (None where a group has no RTs)."""
+    keep = ~np.isnan(rts)
+    codes, rts = codes[keep], rts[keep]
+    counts = np.bincount(codes, minlength=groups)
+    sums = np.bincount(codes, weights=rts, minlength=groups)
+    order = np.lexsort((rts, codes))
+    rts = rts[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    lower = rts[np.minimum(starts + (counts - 1) // 2, len(rts) - 1)] if len(rts) else np.zeros(groups)
+    upper = rts[np.minimum(starts + counts // 2, len(rts) - 1)] if len(rts) else np.zeros(groups)
+    return [(round(float(sums[g] / counts[g]), 2), round(float((lower[g] + upper[g]) / 2), 2))
+            if counts[g] else (None, None) for g in range(groups)]
+
+
+def _group_rows_numpy(np, keys, table):
+    """Summary rows per distinct key in ``keys`` (one per trial), grouped on the column arrays."""
+    c = table.columns
+    index = {}
+    codes = np.fromiter((index.setdefault(k, len(index)) for k in keys), dtype=np.intp, count=len(table))
+    groups = len(index)
+    correct = np.frombuffer(c['isCorrect'], dtype=np.int8)
+    rts = np.frombuffer(c['responseTime'], dtype=np.float64)
+    trials = np.bincount(codes, minlength=groups)
+    timeouts = np.bincount(codes, weights=np.frombuffer(c['timeout'], dtype=np.int8), minlength=groups)
+    scored = np.bincount(codes, weights=correct >= 0, minlength=groups)
+    right = np.bincount(codes, weights=correct == 1, minlength=groups)
+    overall = _rt_stats_numpy(np, codes, rts, groups)
+    by_correct = _rt_stats_numpy(np, codes, np.where(correct == 1, rts, np.nan), groups)
+    by_incorrect = _rt_stats_numpy(np, codes, np.where(correct == 0, rts, np.nan), groups)
+    rows = {}
+    for key, g in index.items():
+        rows[key] = {
+            'trials': int(trials[g]),
+            'accuracy': round(float(right[g] / scored[g]), 4) if scored[g] else None,
+            'timeouts': int(timeouts[g])
+        }
+        rows[key]['meanRT'], rows[key]['medianRT'] = overall[g]
+        rows[key]['meanRTCorrect'], rows[key]['medianRTCorrect'] = by_correct[g]
+        rows[key]['meanRTIncorrect'], rows[key]['medianRTIncorrect'] = by_incorrect[g]
+    return rows
+
+
+def _group_rows(keys, table):
+    """:func:`_group_rows_numpy` without NumPy: one pass over the rows."""
+    c = table.columns
+    groups = {}
+    for key, rt, correct, timeout in zip(keys, c['responseTime'], c['isCorrect'], c['timeout']):
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = {'trials': 0, 'scored': 0, 'correct': 0, 'timeouts': 0, 'rt': ([], [], [])}
+        g['trials'] += 1
+        g['timeouts'] += timeout
+        if correct >= 0:
+            g['scored'] += 1
+            g['correct'] += correct
+        if rt == rt:  # not NaN
+            g['rt'][correct].append(rt)  # [0] incorrect, [1] correct, [-1] unscored
+
+    def row(g):
+        incorrect, correct, unscored = g['rt']
+        out = {
+            'trials': g['trials'],
+            'accuracy': round(g['correct'] / g['scored'], 4) if g['scored'] else None,
+            'timeouts': g['timeouts']
+        }
+        out['meanRT'], out['medianRT'] = _rt_stats(incorrect + correct + unscored)
+        out['meanRTCorrect'], out['medianRTCorrect'] = _rt_stats(correct)
+        out['meanRTIncorrect'], out['medianRTIncorrect'] = _rt_stats(incorrect)
+        return out
+
+    return {key: row(g) for key, g in groups.items()}
+
+
+def summarize(table):
+    """Per-block and per-participant summaries of a :class:`TrialTable`.
+
+    With NumPy installed the groups are computed on the column arrays
+    (``bincount`` sums and one sort for the medians); without it, in a
+    single loop over the rows.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    c = table.columns
+    block_keys = [None if b == MISSING else b for b in c['block']]
+    if np is not None and len(table):
+        blocks = _group_rows_numpy(np, block_keys, table)
+        participants = _group_rows_numpy(np, c['experimentId'], table)
+    else:
+        blocks = _group_rows(block_keys, table)
+        participants = _group_rows(c['experimentId'], table)
+    return {
+        'trials': len(table),
+        'participants': len(participants),
+        'blocks': [dict(block=b, **blocks[b]) for b in sorted(blocks, key=lambda b: (b is None, b))],
+        'byParticipant': [dict(experimentId=p, **participants[p]) for p in sorted(participants)]
+    }
@@ -0,0 +1,146 @@
+"""Image asset pipeline for generated experiments.
+
+Images referenced by ``[image:...]`` stimuli are content-hashed, so identical
+files are stored and fetched once whatever they are called. Three output
+modes are supported:
+
+``relative``
+    Reference ``images/<name>`` next to the HTML file (the original layout).
+``hashed``
+    Copy each unique image to ``assets/<hash>.<ext>`` next to the HTML file.
+    The names change whenever the content does, so they can be cached forever.
+``embed``
+    Put every unique image into the HTML once as a data URI, giving a single
+    self-contained file that keeps working when moved.
+
+With ``downsize`` set, images are scaled down to the ``width``/``height``
+requested in the stimulus options (times ``downsize``, e.g. 2 for HiDPI
+screens). This needs Pillow; it is only imported when downsizing is used.
+"""
+import os
+import io
+import re
+import base64
+import hashlib
+import mimetypes
+
+ASSET_MODES = ('relative', 'hashed', 'embed')
+
+asset_ref_regex = re.compile(r'data-asset="([^"]+)"')
+
+
+class AssetError(ValueError):
+    """An image could not be processed for the requested asset mode."""
+
+
+class AssetPipeline:
+    """Resolves image references to deduplicated, optionally resized assets."""
+
+    def __init__(self, images_dir="images", mode='relative', downsize=None):
+        if mode not in ASSET_MODES:
+            raise AssetError(f"Unknown asset mode: {mode}")
+        self.images_dir = images_dir
+        self.mode = mode
+        self.downsize = downsize
+        self._digests = {}   # (path, mtime, size) -> sha256 of the file
+        self._assets = {}    # (filename, width, height) -> asset name
+        self.files = {}      # asset name -> bytes, for hashed and embed modes
+
+    def __getstate__(self):
+        # Worker processes only need resolved names, not the cached digests
+        state = dict(self.__dict__)
+        state['_digests'] = {}
+        return state
+
+    def _digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        if key not in self._digests:
+            with open(path, "rb") as f:
+                self._digests[key] = hashlib.sha256(f.read()).hexdigest()
+        return self._digests[key]
+
+    def _resize(self, data, ext, width, height):
+        """Scale image bytes down to the requested display size."""
+        if ext in ('.svg', '.gif'):
+            return data  # Vector or possibly animated: leave untouched
+        try:
+            from PIL import Image
+        except ImportError:
+            raise AssetError("Downsizing images requires Pillow (pip install Pillow).")
+        with Image.open(io.BytesIO(data)) as img:
+            scale = self.downsize
+            target_w = int(width * scale) if width else None
+            target_h = int(height * scale) if height else None
+            if target_w and not target_h:
+                target_h = max(1, round(img.height * target_w / img.width))
+            elif target_h and not target_w:
+                target_w = max(1, round(img.width * target_h / img.height))
+            if target_w >= img.width and target_h >= img.height:
+                return data  # Never upscale
+            out = io.BytesIO()
+            img.resize((min(target_w, img.width), min(target_h, img.height)), Image.LANCZOS).save(out, format=img.format)
+            return out.getvalue()
+
+    def resolve(self, filename, width=None, height=None):
+        """Return the ``(attribute, value)`` that makes an ``<img>`` show ``filename``."""
+        if self.mode == 'relative':
+            return 'src', f"images/{filename}"
+        if not self.downsize:
+            width = height = None
+        key = (filename, width, height)
+        if key not in self._assets:
+            path = os.path.join(self.images_dir, filename)
+            ext = os.path.splitext(filename)[1].lower()
+            data = None
+            digest = self._digest(path)
+            if width or height:
+                with open(path, "rb") as f:
+                    data = self._resize(f.read(), ext, width, height)
+                digest = hashlib.sha256(data).hexdigest()
+            name = digest[:16] + ext
+            if name not in self.files:
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                self.files[name] = data
+            self._assets[key] = name
+        name = self._assets[key]
+        if self.mode == 'embed':
+            return 'data-asset', name
+        return 'src', f"assets/{name}"
+
+    def bundle(self, stimuli=None):
+        """Data URIs for embed mode, keyed by asset name.
+
+        With ``stimuli`` (processed stimulus HTML) only the assets they
+        reference are included, so a pipeline reused across builds does not
+        carry images that are no longer used.
+        """
+        if self.mode != 'embed':
+            return {}
+        names = self.files
+        if stimuli is not None:
+            names = {name for html in stimuli for name in asset_ref_regex.findall(html)}
+        bundle = {}
+        for name in sorted(names):
+            data = self.files[name]
+            mime = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            bundle[name] = f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+        return bundle
+
+    def write(self, output_dir):
+        """Write hashed assets into ``output_dir/assets``; existing files are kept."""
+        if self.mode != 'hashed':
+            return 0
+        from peg_build import write_atomic
+        assets_dir = os.path.join(output_dir, "assets")
+        os.makedirs(assets_dir, exist_ok=True)
+        written = 0
+        for name, data in self.files.items():
+            path = os.path.join(assets_dir, name)
+            if os.path.exists(path):
+                continue  # Content-addressed: same name, same bytes
+            write_atomic(path, data)
+            written += 1
+        return written
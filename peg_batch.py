@@ -0,0 +1,161 @@
+"""Parallel per-participant experiment builds.
+
+A participant manifest is a CSV with a ``participant`` column and optional
+``seed`` and ``design`` columns. ``design`` names an alternative design CSV
+(relative to the manifest) and is how counterbalancing lists are assigned;
+rows without it use the main design. Every design is parsed and validated
+once in the parent process and handed to the worker processes when they
+start, so workers only expand, render and write.
+"""
+import os
+import csv
+import json
+import time
+import hashlib
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from peg_assets import AssetPipeline
+from peg_build import (DesignError, read_design, parse_design, check_images, collect_assets,
+                       expand_trials, generate_html, write_atomic, write_if_changed)
+from peg_schedule import new_seed
+
+# Set in each worker by _init_worker
+_designs = None
+_schedule_options = None
+_render_options = None
+
+
+def load_manifest(path):
+    """Read a participant manifest into a list of dicts.
+
+    Raises :class:`DesignError` for duplicate participants and for IDs that
+    would be written to the same file (see :func:`output_name`).
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or 'participant' not in [h.strip().lower() for h in reader.fieldnames]:
+            raise DesignError("Manifest must have a 'participant' column.")
+        entries = []
+        seen = set()
+        files = {}  # lowercased output name -> (row number, participant)
+        for i, row in enumerate(reader):
+            row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k}
+            participant = row.get('participant', '')
+            if not participant: continue
+            if participant in seen:
+                raise DesignError(f"Manifest row {i+2}: duplicate participant {participant}.")
+            seen.add(participant)
+            # Case-insensitive, as on Windows and macOS file systems
+            name = output_name(participant)
+            if name.lower() in files:
+                other_row, other = files[name.lower()]
+                raise DesignError(f"Manifest row {i+2}: participant '{participant}' would be written to "
+                                  f"{name}, the same file as '{other}' (row {other_row}); "
+                                  f"rename one of them.")
+            files[name.lower()] = (i + 2, participant)
+            if row.get('seed'):
+                try:
+                    row['seed'] = int(row['seed'])
+                except ValueError:
+                    raise DesignError(f"Manifest row {i+2}: seed must be an integer.")
+            else:
+                row['seed'] = None
+            entries.append(row)
+        return entries
+
+
+def participant_seed(participant, base_seed=None):
+    """Seed for a participant without one in the manifest.
+
+    With a base seed the result is derived from it and the participant ID, so
+    re-running the batch reproduces the same files.
+    """
+    if base_seed is None:
+        return new_seed()
+    digest = hashlib.sha256(f"{base_seed}:{participant}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big")
+
+
+def output_name(participant):
+    """The participant's file name: characters unsafe in file names become ``_``."""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', participant) + ".html"
+
+
+def _init_worker(designs, schedule_options, render_options):
+    global _designs, _schedule_options, _render_options
+    _designs = designs
+    _schedule_options = schedule_options
+    _render_options = render_options
+
+
+def _build_one(job):
+    participant, design_key, seed, path = job
+    repeat_count, randomize = _schedule_options
+    schedule = expand_trials(_designs[design_key], repeat_count, randomize, seed)
+    data = generate_html(schedule, participant=participant, **_render_options).encode("utf-8")
+    write_if_changed(path, data)
+    return {
+        'participant': participant,
+        'design': design_key,
+        'seed': seed,
+        'file': os.path.basename(path),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'bytes': len(data),
+        'trials': len(schedule)
+    }
+
+
+def build_batch(design_path, manifest_path, output_dir, repeat_count=1, randomize=True,
+                seed=None, images_dir="images", workers=None, asset_mode='relative',
+                downsize=None, **render_options):
+    """Build one experiment file per manifest participant.
+
+    ``render_options`` are passed on to :func:`peg_build.generate_html`.
+    Images are resolved and hashed assets written once, before the workers
+    start.
+
+    Writes the HTML files and a ``manifest.json`` of seeds and hashes into
+    ``output_dir`` and returns ``(records, elapsed_seconds)``.
+    """
+    entries = load_manifest(manifest_path)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    designs = {}
+    jobs = []
+    assets = AssetPipeline(images_dir, asset_mode, downsize)
+    os.makedirs(output_dir, exist_ok=True)
+    for entry in entries:
+        design_key = entry.get('design') or design_path
+        if design_key not in designs:
+            path = design_key if design_key == design_path else os.path.join(manifest_dir, design_key)
+            design = parse_design(read_design(path))
+            if not design.block_order:
+                raise DesignError(f"{design_key}: Please define at least one trial.")
+            check_images(design, images_dir)
+            collect_assets(design, assets)
+            designs[design_key] = design
+        entry_seed = entry['seed'] if entry['seed'] is not None else participant_seed(entry['participant'], seed)
+        jobs.append((entry['participant'], design_key, entry_seed,
+                     os.path.join(output_dir, output_name(entry['participant']))))
+
+    assets.write(output_dir)
+    render_options['assets'] = assets
+
+    start = time.perf_counter()
+    schedule_options = (repeat_count, randomize)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(designs, schedule_options, render_options)) as pool:
+        records = list(pool.map(_build_one, jobs, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        'design': design_path,
+        'repetitions': repeat_count,
+        'randomized': randomize,
+        'files': records
+    }
+    write_atomic(os.path.join(output_dir, "manifest.json"),
+                 json.dumps(summary, indent=2).encode("utf-8"))
+    return records, elapsed
@@ -0,0 +1,327 @@
+"""Benchmarks for the build pipeline and the generated runtime.
+
+Synthetic designs are generated from the shipped example designs
+(``simon_task.csv``, ``gonogo_task.csv``, ``simon_colored_squares.csv``) by
+repeating their trial rows over more blocks, rows, repeats and images. For
+each case the pipeline steps the GUI's Start Experiment runs are timed
+separately: validate, parse, expand and render (``generate_html``). The
+output size and the peak Python memory of one complete build are recorded.
+
+With Node.js installed, selected cases are also run in a small DOM stand-in
+with a simulated 60 Hz display that answers every trial. It reports the CPU
+cost of the frame that switches from one trial to the next, of the keydown
+handler, and of an ordinary frame. No browser is needed.
+
+    python peg.py bench -o bench.json
+    python peg.py bench --quick --compare bench.json
+
+Results are JSON, so runs on different commits can be compared.
+"""
+import os
+import json
+import time
+import zlib
+import struct
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+from peg_assets import AssetPipeline
+from peg_build import read_design, parse_design, check_images, expand_trials, generate_html, _is_int
+from peg_stimulus import image_regex
+from peg_validate import validate_design
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def case(name, pattern='simon_task', blocks=10, rows_per_block=10, block_repeats=1, repeat_count=1,
+         images=0, output_format='full', asset_mode='relative', measure_runtime=False, quick=True):
+    return dict(name=name, pattern=pattern, blocks=blocks, rows_per_block=rows_per_block,
+                block_repeats=block_repeats, repeat_count=repeat_count, images=images,
+                output_format=output_format, asset_mode=asset_mode, measure_runtime=measure_runtime,
+                quick=quick)
+
+
+# Cases with quick=False are left out of --quick runs
+CASES = [
+    case('rows-1k', blocks=100, rows_per_block=10, measure_runtime=True),
+    case('rows-10k', blocks=100, rows_per_block=100),
+    case('rows-100k', blocks=100, rows_per_block=1000, quick=False),
+    case('rows-10k-compact', blocks=100, rows_per_block=100, output_format='compact'),
+    case('rows-10k-runtime', blocks=100, rows_per_block=100, output_format='runtime'),
+    case('blocks-10', pattern='gonogo_task', blocks=10, rows_per_block=10, measure_runtime=True),
+    case('blocks-1000', pattern='gonogo_task', blocks=1000, rows_per_block=10, quick=False),
+    case('repeats-10x5', blocks=50, rows_per_block=10, block_repeats=10, repeat_count=5),
+    case('images-10', pattern='simon_colored_squares', blocks=100, rows_per_block=10, images=10, measure_runtime=True),
+    case('images-500', pattern='simon_colored_squares', blocks=100, rows_per_block=10, images=500),
+    case('images-500-embed', pattern='simon_colored_squares', blocks=100, rows_per_block=10, images=500,
+         asset_mode='embed', measure_runtime=True),
+]
+
+
+def _with_image(stimulus, n):
+    """``stimulus`` showing image ``n``: existing image references are renamed, otherwise one is added."""
+    if image_regex.search(stimulus):
+        return image_regex.sub(lambda m: f"[image:img{n}.png" + (f"({m.group(2)})" if m.group(2) is not None else '') + "]",
+                               stimulus)
+    return f"[image:img{n}.png(width=200)]{stimulus}"
+
+
+def synthetic_design(pattern, blocks=10, rows_per_block=10, block_repeats=1, images=0):
+    """Design rows built from a shipped design's instructions and trial rows.
+
+    The instruction rows (blocks below 100) are kept; ``blocks`` blocks of
+    ``rows_per_block`` rows cycle through the trial rows. With ``images``,
+    stimuli reference ``img0.png`` .. ``img{images-1}.png`` in turn.
+    """
+    base = read_design(os.path.join(HERE, pattern + '.csv'))
+    intro = [row for row in base if _is_int(row[0]) and int(row[0]) < 100]
+    trials = [row for row in base if _is_int(row[0]) and int(row[0]) >= 100]
+    rows, k = [list(row) for row in intro], 0
+    for b in range(blocks):
+        for j in range(rows_per_block):
+            row = list(trials[k % len(trials)])
+            row[0], row[1] = str(101 + b), str(block_repeats) if j == 0 else ''
+            if images:
+                row[2] = _with_image(row[2], k % images)
+            rows.append(row)
+            k += 1
+    return rows
+
+
+def _png(n):
+    """A distinct 1x1 PNG for image ``n``."""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    pixel = b'\x00' + bytes((n & 255, n >> 8 & 255, 128))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(pixel)) + chunk(b'IEND', b''))
+
+
+def make_images(images_dir, count):
+    os.makedirs(images_dir, exist_ok=True)
+    for n in range(count):
+        path = os.path.join(images_dir, f"img{n}.png")
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(_png(n))
+
+
+def _build(rows, c, images_dir, steps=None):
+    """One complete build; records each step's duration into ``steps``."""
+    def step(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        if steps is not None:
+            steps[name] = min(steps.get(name, float('inf')), time.perf_counter() - start)
+        return result
+
+    def expand(design):
+        schedule = expand_trials(design, c['repeat_count'], True, 1)
+        sum(1 for _ in schedule)  # The schedule is lazy: walk it as rendering does
+        return schedule
+
+    step('validate', validate_design, rows, images_dir)
+    design = step('parse', parse_design, rows)
+    step('check_images', check_images, design, images_dir)
+    schedule = step('expand', expand, design)
+    assets = AssetPipeline(images_dir, c['asset_mode'])
+    return schedule, step('render', generate_html, schedule, False, None, c['output_format'], 0, assets)
+
+
+def bench_case(c, work_dir, rounds=3, runtime=True, max_trials=2000):
+    """Run one benchmark case and return its measurements."""
+    images_dir = os.path.join(work_dir, 'images')
+    make_images(images_dir, c['images'])
+    rows = synthetic_design(c['pattern'], c['blocks'], c['rows_per_block'], c['block_repeats'], c['images'])
+
+    steps = {}
+    for _ in range(rounds):
+        schedule, html = _build(rows, c, images_dir, steps)
+    tracemalloc.start()
+    try:
+        _build(rows, c, images_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = dict(c, rows=len(rows), trials=len(schedule), output_bytes=len(html.encode('utf-8')),
+                  peak_memory_bytes=peak, seconds={k: round(v, 6) for k, v in steps.items()})
+    result['seconds']['total'] = round(sum(steps.values()), 6)
+    if runtime and c['measure_runtime']:
+        html_path = os.path.join(work_dir, c['name'] + '.html')
+        with open(html_path, "w", encoding="utf-8") as f:
+            f.write(html)
+        result['runtime'] = run_runtime(html_path, max_trials)
+    return result
+
+
+# Node.js driver for a generated experiment. Provides just enough DOM for the
+# runtime, steps a simulated clock one frame at a time and answers each trial
+# `responseDelay` ms after it appears (text entries via their button, NA
+# correct responses by waiting for the latency). Prints costs in microseconds.
+RUNTIME_BENCH_JS = r'''
+const fs = require('fs');
+const vm = require('vm');
+const [htmlPath, maxTrials, responseDelay] = process.argv.slice(2).map((v, i) => i ? Number(v) : v);
+const script = fs.readFileSync(htmlPath, 'utf8').match(/<script>([\s\S]*)<\/script>/)[1];
+const FRAME = 1000 / 60;
+const KEYS = { space: [' ', 'Space'], ctrl: ['Control', 'ControlLeft'], alt: ['Alt', 'AltLeft'],
+               shift: ['Shift', 'ShiftLeft'], lshift: ['Shift', 'ShiftLeft'], rshift: ['Shift', 'ShiftRight'] };
+
+function element(tag) {
+  return { tagName: tag, style: {}, dataset: {}, children: [], innerHTML: '', textContent: '', value: '',
+           appendChild(c) { this.children.push(c); return c; }, removeChild(c) { return c; },
+           replaceChildren(...c) { this.children = c; },
+           get content() { return this; },
+           querySelectorAll() { return []; }, focus() {}, click() {}, setAttribute() {}, addEventListener() {} };
+}
+let now = 0;
+let frames = [];
+const timers = [];
+const elements = {};
+const document = { body: element('body'), onkeydown: null, addEventListener() {}, createElement: element,
+                   getElementById: id => elements[id] || (elements[id] = element('div')) };
+const context = {
+  document, console, URLSearchParams, performance: { now: () => now },
+  requestAnimationFrame: f => frames.push(f),
+  setTimeout: (f, ms) => timers.push([now + (ms || 0), f]), setInterval: () => 0, clearInterval() {},
+  navigator: { userAgent: 'peg-bench', onLine: true, sendBeacon: () => true },
+  location: { pathname: '/', search: '' },
+  crypto: { getRandomValues: a => { for (let i = 0; i < a.length; i++) a[i] = i + 1; return a; } },
+  localStorage: { getItem: () => null, setItem() {}, removeItem() {} },
+  fetch: () => Promise.resolve({ ok: true, json: () => Promise.resolve({}) }),
+  Blob: function () {}, URL: { createObjectURL: () => '', revokeObjectURL() {} },
+  addEventListener() {}, removeEventListener() {}
+};
+context.window = context;
+vm.createContext(context);
+
+const clock = () => Number(process.hrtime.bigint()) / 1000;
+const state = new vm.Script('[currentTrial, trialCount, trialResults.length, activeTrial]');
+function stats(samples) {
+  const s = samples.slice().sort((a, b) => a - b);
+  const at = p => s.length ? s[Math.min(s.length - 1, Math.floor(p * s.length))] : 0;
+  const round = v => Math.round(v * 100) / 100;
+  return { count: s.length, mean: round(s.reduce((a, b) => a + b, 0) / (s.length || 1)),
+           p50: round(at(0.5)), p95: round(at(0.95)), max: round(s.length ? s[s.length - 1] : 0) };
+}
+
+async function run() {
+  const transition = [], input = [], idle = [];
+  const setupStart = clock();
+  vm.runInContext(script, context);
+  const setup = (clock() - setupStart) / 1000;
+  let shown = -1, shownAt = 0, answered = -1;
+  for (let step = 0; step < 10000000; step++) {
+    await new Promise(setImmediate);  // let decode and frame-estimate promises settle
+    now += FRAME;
+    for (let i = timers.length - 1; i >= 0; i--) {
+      if (timers[i][0] <= now) timers.splice(i, 1)[0][1]();
+    }
+    let [current, count, recorded, trial] = state.runInContext(context);
+    if (recorded >= maxTrials || (current >= count && !frames.length)) break;
+    if (current !== shown) { shown = current; shownAt = now; }
+    if (trial && answered !== current && now - shownAt >= responseDelay) {
+      const button = document.getElementById('container').children.find(c => c.onclick);
+      const wanted = (trial.correctResponse || trial.response.split(',')[0]).trim();
+      if (button) {
+        answered = current;
+        document.getElementById('container').children.forEach(c => { c.value = wanted; });
+        button.onclick({ timeStamp: now });
+      } else if (document.onkeydown && wanted.toUpperCase() !== 'NA') {
+        answered = current;
+        const [key, code] = KEYS[wanted.toLowerCase()] || [wanted, 'Key' + wanted.toUpperCase()];
+        const start = clock();
+        document.onkeydown({ key, code, timeStamp: now - 1, repeat: false, preventDefault() {} });
+        input.push(clock() - start);
+      }
+    }
+    const callbacks = frames;
+    frames = [];
+    for (const callback of callbacks) {
+      const start = clock();
+      callback(now);
+      const cost = clock() - start;
+      if (state.runInContext(context)[0] !== current) transition.push(cost); else idle.push(cost);
+    }
+  }
+  const recorded = state.runInContext(context)[2];
+  console.log(JSON.stringify({ trials: recorded, setup_ms: Math.round(setup * 100) / 100,
+                               transition_us: stats(transition), keydown_us: stats(input), frame_us: stats(idle) }));
+}
+run().catch(e => { console.error(e && e.stack || e); process.exit(1); });
+'''
+
+
+def run_runtime(html_path, max_trials=2000, response_delay=300):
+    """Run a generated experiment in Node.js and return its runtime costs."""
+    node = shutil.which('node')
+    if node is None:
+        return {'skipped': 'node not found'}
+    with tempfile.NamedTemporaryFile('w', suffix='.js', delete=False) as f:
+        f.write(RUNTIME_BENCH_JS)
+    try:
+        proc = subprocess.run([node, f.name, html_path, str(max_trials), str(response_delay)],
+                              capture_output=True, text=True, timeout=600)
+    finally:
+        os.unlink(f.name)
+    if proc.returncode:
+        return {'error': (proc.stderr.strip().splitlines() or ['node failed'])[0]}
+    return json.loads(proc.stdout)
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(quick=False, rounds=3, runtime=True, only=None, max_trials=2000):
+    """Run the benchmark cases and return the report as a dict."""
+    cases = [c for c in CASES if (c['quick'] or not quick) and (not only or c['name'] in only)]
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cases': []
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for c in cases:
+            report['cases'].append(bench_case(c, work_dir, rounds, runtime, max_trials))
+    return report
+
+
+def compare(baseline, report):
+    """Lines comparing ``report`` to a ``baseline`` report, case by case."""
+    old = {c['name']: c for c in baseline['cases']}
+    lines = []
+    for c in report['cases']:
+        b = old.get(c['name'])
+        if b is None:
+            continue
+        ratio = c['seconds']['total'] / b['seconds']['total'] if b['seconds']['total'] else float('inf')
+        line = (f"{c['name']:<18} time x{ratio:.2f}  size {c['output_bytes'] - b['output_bytes']:+d} B  "
+                f"memory x{c['peak_memory_bytes'] / max(1, b['peak_memory_bytes']):.2f}")
+        rt, brt = c.get('runtime', {}), b.get('runtime', {})
+        if 'transition_us' in rt and 'transition_us' in brt and brt['transition_us']['p50']:
+            line += f"  transition p50 x{rt['transition_us']['p50'] / brt['transition_us']['p50']:.2f}"
+        lines.append(line)
+    return lines
+
+
+def format_report(report):
+    lines = [f"{'case':<18} {'rows':>7} {'trials':>8} {'total s':>8} {'render s':>9} {'size KB':>9} "
+             f"{'peak MB':>8} {'switch us':>10}"]
+    for c in report['cases']:
+        transition = c.get('runtime', {}).get('transition_us', {}).get('p50', '')
+        lines.append(f"{c['name']:<18} {c['rows']:>7} {c['trials']:>8} {c['seconds']['total']:>8.3f} "
+                     f"{c['seconds']['render']:>9.3f} {c['output_bytes'] / 1024:>9.1f} "
+                     f"{c['peak_memory_bytes'] / 2 ** 20:>8.1f} {transition!s:>10}")
+    return lines
@@ -0,0 +1,1551 @@
+"""GUI-free build pipeline for PEG experiments.
+
+Turns a design (CSV file or rows of strings) into a validated design, expands
+it into the trial sequence and renders the self-contained ``experiment.html``.
+Nothing here imports tkinter, so it can be used from scripts and batch jobs.
+"""
+import os
+import io
+import csv
+import gzip
+import json
+
+from peg_assets import AssetPipeline
+from peg_profile import NO_PROFILE
+from peg_condition import (MEASURES, OPS, ConditionError, check_placement, check_repeats, check_targets,
+                           parse_condition)
+from peg_schedule import Schedule
+from peg_stimulus import StimulusError, parse_stimulus, render_stimulus, stimulus_audio, media_files
+
+HEADERS = [
+    'Block', 'Block Repeats', 'Stimulus', 'Response', 'Latency',
+    'Correct Response', 'Feedback Text', 'Feedback Duration',
+    'Stimulus Color', 'Background Color', 'Condition'
+]
+
+
+class DesignError(ValueError):
+    """A design problem that prevents the experiment from being compiled."""
+
+
+class MissingImageError(DesignError):
+    """A stimulus references an image or sound that is not in the images directory."""
+
+
+# Stages reported by build() and the GUI, in order
+BUILD_STAGES = ('validate', 'expand', 'render', 'write')
+
+
+class BuildCancelled(Exception):
+    """Raised by a ``progress`` callback to abandon the build it reports on."""
+
+
+def _with_progress(items, total, progress, every=1000):
+    """``items``, calling ``progress(fraction)`` every ``every`` items if given.
+
+    ``progress`` may raise (e.g. :class:`BuildCancelled`) to stop the loop
+    consuming the items.
+    """
+    if progress is None:
+        return items
+    def reporting():
+        for i, item in enumerate(items):
+            if i % every == 0:
+                progress(i / total if total else 0.0)
+            yield item
+    return reporting()
+
+
+class Design:
+    """Validated design: trials grouped by block plus the block repeat counts and conditions."""
+
+    def __init__(self, trials_by_block, block_repeats, block_order, block_conditions=None):
+        self.trials_by_block = trials_by_block
+        self.block_repeats = block_repeats  # Repeat counts for each block (from first occurrence)
+        self.block_order = block_order  # Order blocks appear in the design
+        self.block_conditions = block_conditions or {}  # Condition rules of blocks that have one
+
+
+def open_design(path):
+    """Open a design CSV for reading, decompressing gzip files transparently.
+
+    Returns ``(text_stream, raw_file)``; ``raw_file.tell()`` is the position
+    in the file on disk, for progress reporting.
+    """
+    raw = open(path, "rb")
+    try:
+        compressed = raw.read(2) == b'\x1f\x8b'
+        raw.seek(0)
+        stream = gzip.GzipFile(fileobj=raw, mode="rb") if compressed else raw
+        return io.TextIOWrapper(stream, encoding="utf-8", newline=""), raw
+    except Exception:
+        raw.close()
+        raise
+
+
+def iter_design(path, progress=None, every=1000):
+    """Yield the rows of a design CSV one at a time, padded to the current columns.
+
+    Reads plain or gzip-compressed files without loading them whole.
+    ``progress(fraction)`` is called every ``every`` rows with the share of
+    the file read so far.
+    """
+    f, raw = open_design(path)
+    with f, raw:
+        size = os.fstat(raw.fileno()).st_size or 1
+        reader = csv.reader(f)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return # Empty file
+        # Allow loading of files without the Condition column, or without
+        # Block Repeats as well, for backward compatibility
+        legacy = len(header) == len(HEADERS) - 2  # Old format without Block Repeats
+        if not legacy and (len(header) < len(HEADERS) - 1 or
+                           [h.lower() for h in header] != [h.lower() for h in HEADERS[:len(header)]]):
+            raise DesignError("CSV headers do not match expected format.")
+        for n, row_vals in enumerate(reader, 1):
+            if legacy and len(row_vals) == len(HEADERS) - 2:
+                row_vals.insert(1, '')  # Insert empty Block Repeats value
+            yield (row_vals + [''] * len(HEADERS))[:len(HEADERS)]
+            if progress is not None and n % every == 0:
+                progress(raw.tell() / size)
+
+
+def read_design(path):
+    """Read a design CSV and return its rows, padded to the current columns."""
+    return list(iter_design(path))
+
+
+def parse_row(row):
+    """Validate one design row without its row number.
+
+    Returns ``(block_num, block_repeat, condition, trial, error)``.
+    ``block_num`` is None when the Block cell is invalid; ``error`` is the
+    first other problem, if any. Block Repeats and Condition are only
+    validated by :func:`parse_design`, because only the first row of each
+    block uses them. Rows without the Condition column are accepted.
+    """
+    row_values = [v.strip() for v in row]
+    if not any(row_values): return None
+
+    (block, block_repeat, stimulus, response, latency, correct_response, feedback_text,
+     feedback_duration, stimulus_color, background_color, condition) = (row_values + [''])[:len(HEADERS)]
+
+    if not block:
+        return None, None, None, None, "Block cannot be empty."
+    try:
+        block_num = int(block)
+    except ValueError:
+        return None, None, None, None, "Block must be an integer."
+
+    error = None
+    if response.upper() == 'NA' and latency.upper() == 'NA':
+        error = "Response and Latency cannot both be NA."
+    elif latency.upper() != 'NA' and not _is_int(latency):
+        error = "Latency must be a number or NA."
+    elif (correct_response and response.upper() != 'NA' and not response.startswith('[text')
+          and correct_response not in [r.strip() for r in response.split(',')]):
+        error = "Correct Response must be one of the Response options."
+    elif feedback_duration and not _is_int(feedback_duration):
+        error = "Feedback Duration must be a number."
+    else:
+        try:
+            parse_stimulus(stimulus)
+        except StimulusError as e:
+            error = str(e)
+
+    trial = {
+        'block': block_num,
+        'stimulus': stimulus,
+        'response': response,
+        'latency': latency,
+        'correct_response': correct_response,
+        'feedback_text': feedback_text,
+        'feedback_duration': feedback_duration,
+        'stimulus_color': stimulus_color or 'white',
+        'background_color': background_color or 'darkgrey'
+    }
+    return block_num, block_repeat, condition, trial, error
+
+
+def _is_int(value):
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_design(rows, row_cache=None, progress=None):
+    """Validate design rows and group them into a :class:`Design`.
+
+    Raises :class:`DesignError` naming the first offending row. ``row_cache``
+    is an optional dict of earlier :func:`parse_row` results keyed by row, so
+    that unchanged rows are not validated again. ``progress(fraction)`` is
+    called every 1000 rows.
+    """
+    trials_by_block = {}
+    block_repeats = {}
+    block_conditions = {}
+    condition_rows = {}
+    first_rows = {}
+    original_block_order = []
+
+    for i, row in enumerate(_with_progress(rows, len(rows), progress)):
+        if row_cache is None:
+            parsed = parse_row(row)
+        else:
+            key = tuple(row)
+            if key not in row_cache:
+                row_cache[key] = parse_row(row)
+            parsed = row_cache[key]
+        if parsed is None: continue
+        block_num, block_repeat, condition, trial, error = parsed
+
+        if block_num is None:
+            raise DesignError(f"Row {i+1}: {error}")
+
+        # Track the original order blocks appear
+        if block_num not in block_repeats:
+            original_block_order.append(block_num)
+            first_rows[block_num] = i
+
+            # Handle Block Repeats - only use value from first occurrence of each block
+            if block_repeat:
+                try:
+                    block_repeats[block_num] = int(block_repeat)
+                except ValueError:
+                    raise DesignError(f"Row {i+1}: Block Repeats must be a number.")
+            else:
+                block_repeats[block_num] = 1  # Default to 1 if empty
+
+            # Condition, like Block Repeats, is taken from the first row
+            if condition:
+                try:
+                    block_conditions[block_num] = parse_condition(condition)
+                except ConditionError as e:
+                    raise DesignError(f"Row {i+1}: {e}")
+                condition_rows[block_num] = i
+
+        if error:
+            raise DesignError(f"Row {i+1}: {error}")
+
+        trials_by_block.setdefault(block_num, []).append(trial)
+
+    # Sections and jump targets can only be checked once every block is known
+    for block_num, rules in block_conditions.items():
+        error = check_placement(block_num, original_block_order) or \
+            check_targets(rules, block_num, original_block_order)
+        if error:
+            raise DesignError(f"Row {condition_rows[block_num]+1}: {error}")
+    if block_conditions:
+        for block_num in original_block_order:
+            error = check_repeats(block_num, block_repeats[block_num], original_block_order)
+            if error:
+                raise DesignError(f"Row {first_rows[block_num]+1}: {error}")
+
+    return Design(trials_by_block, block_repeats, original_block_order, block_conditions)
+
+
+def check_images(design, images_dir, exists=None):
+    """Raise :class:`MissingImageError` for the first image or sound not in ``images_dir``.
+
+    ``exists(filename)`` replaces the per-file ``os.path.isfile`` check, e.g.
+    with a lookup in a cached directory listing.
+    """
+    if exists is None:
+        exists = lambda fname: os.path.isfile(os.path.join(images_dir, fname))
+    for block_trials in design.trials_by_block.values():
+        for t in block_trials:
+            for kind, fname in media_files(parse_stimulus(t['stimulus'])):
+                if fname and not exists(fname):
+                    raise MissingImageError(f"{kind} file not found in ./images: {fname}")
+
+
+def expand_trials(design, repeat_count=1, randomize=True, seed=None):
+    """Expand a design into the seeded :class:`~peg_schedule.Schedule` presented to participants."""
+    return Schedule(design, repeat_count, randomize, seed)
+
+
+def process_stim(raw, assets):
+    """Render a Stimulus cell; returns ``(html, position, sounds)``.
+
+    ``sounds`` are ``(attribute, value, volume, delay)`` with the asset
+    reference from ``assets.resolve``.
+    """
+    stimulus = parse_stimulus(raw)
+    sounds = [assets.resolve(a.filename) + (a.volume, a.delay) for a in stimulus_audio(stimulus)]
+    return render_stimulus(stimulus, assets), stimulus.position, sounds
+
+
+def collect_assets(design, assets):
+    """Resolve every image a design uses, e.g. before handing ``assets`` to workers."""
+    stimuli = {t['stimulus'] for block_trials in design.trials_by_block.values() for t in block_trials}
+    for raw in stimuli:
+        process_stim(raw, assets)
+
+
+def trial_template(t, processed_stimulus, position, audio=None):
+    """The per-row part of a trial as the runtime sees it.
+
+    ``audio`` is a list of ``[source index, volume, delay]`` and only added
+    when the stimulus plays sounds.
+    """
+    template = {
+        'block': t['block'],
+        'stimulus': processed_stimulus,
+        'response': t['response'],
+        'latency': int(t['latency']) if t['latency'].upper() != 'NA' else None,
+        'correctResponse': t['correct_response'] or None,
+        'feedbackText': t['feedback_text'] or None,
+        'feedbackDuration': int(t['feedback_duration']) if t['feedback_duration'] else None,
+        'stimulusColor': t['stimulus_color'],
+        'backgroundColor': t['background_color'],
+        'position': position
+    }
+    if audio:
+        template['audio'] = audio
+    return template
+
+
+# Key names as the runtime's keyName() derives them from a key event: the
+# lowercased event.key, except for the aliases below and the two shift keys,
+# which are told apart by event.code. A plain 'shift' accepts either side.
+KEY_ALIASES = {' ': 'space', 'control': 'ctrl'}
+KEY_GROUPS = {'shift': ('shift', 'lshift', 'rshift')}
+
+
+def key_names(keys):
+    """The key names a list of design key specs accepts, as a JSON-ready set."""
+    names = {}
+    for key in keys:
+        key = key.strip().lower()
+        key = KEY_ALIASES.get(key, key)
+        for name in KEY_GROUPS.get(key, (key,)):
+            if name:
+                names[name] = 1
+    return names
+
+
+def feedback_messages(text):
+    """[if correct, if incorrect, otherwise] messages for a Feedback Text cell.
+
+    ``[all]`` shows its message after every response, ``[correct]`` and
+    ``[incorrect]`` only after that outcome; text without markers is always
+    shown. An empty message shows nothing.
+    """
+    text = text.strip()
+    if '[all]' in text:
+        return [text.replace('[all]', '', 1).strip()] * 3
+    if '[correct]' not in text and '[incorrect]' not in text:
+        return [text] * 3
+    return [text.replace('[correct]', '', 1).strip() if '[correct]' in text else '',
+            text.replace('[incorrect]', '', 1).strip() if '[incorrect]' in text else '',
+            '']
+
+
+def response_rules_js(templates):
+    """Key sets, correct-response names and feedback messages, keyed by the design strings.
+
+    Compiled once per distinct Response, Correct Response and Feedback Text
+    so the runtime only does lookups when a key is pressed.
+    """
+    response_keys, correct_keys, messages = {}, {}, {}
+    for t in templates:
+        response, correct, feedback = t['response'], t['correctResponse'], t['feedbackText']
+        if response not in response_keys and response.upper() != 'NA' and not response.strip().startswith('[text'):
+            response_keys[response] = key_names(response.split(','))
+        if correct and correct not in correct_keys:
+            correct_keys[correct] = key_names([correct])
+        if feedback and feedback not in messages:
+            messages[feedback] = feedback_messages(feedback)
+    return (f'const responseKeys = {compact_json(response_keys)};\n'
+            f'    const correctKeys = {compact_json(correct_keys)};\n'
+            f'    const feedbackMessages = {compact_json(messages)};')
+
+
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def unique_templates(templates):
+    """Deduplicate templates; returns their minified JSON and an id per table row."""
+    unique, template_ids = {}, []
+    for template in templates:
+        template_ids.append(unique.setdefault(compact_json(template), len(unique)))
+    return list(unique), template_ids
+
+
+# Resolves trials from `templates`, a `sequence` of template ids and
+# repetition `runs` of [repetition, blockRepetition, length]. templateAt(i)
+# is the shared template, trialAt(i) a fresh per-presentation object.
+TRIAL_RESOLVER_JS = '''const trialCount = sequence.length;
+    const trialRepetition = new Uint32Array(trialCount);
+    const trialBlockRepetition = new Uint32Array(trialCount);
+    for (let r = 0, i = 0; r < runs.length; i += runs[r][2], r++) {
+        trialRepetition.fill(runs[r][0], i, i + runs[r][2]);
+        trialBlockRepetition.fill(runs[r][1], i, i + runs[r][2]);
+    }
+    function templateAt(i) { return templates[sequence[i]]; }
+    function templateIdAt(i) { return sequence[i]; }
+    function trialAt(i) {
+        return Object.assign({}, templates[sequence[i]], {
+            repetition: trialRepetition[i],
+            blockRepetition: trialBlockRepetition[i],
+            trialIndex: i
+        });
+    }
+    function* plannedTemplates() { for (let i = 0; i < trialCount; i++) yield templates[sequence[i]]; }'''
+
+# Seeded random numbers in the browser; see session_seed_js for the seed.
+SEEDED_RANDOM_JS = '''function mulberry32(a) {
+        return function () {
+            a = (a + 0x6D2B79F5) | 0;
+            let t = Math.imul(a ^ (a >>> 15), 1 | a);
+            t = (t + Math.imul(t ^ (t >>> 7), 61 | t)) ^ t;
+            return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+        };
+    }
+
+    function shuffleInPlace(order, random) {
+        for (let i = order.length - 1; i > 0; i--) {
+            const j = Math.floor(random() * (i + 1));
+            [order[i], order[j]] = [order[j], order[i]];
+        }
+        return order;
+    }'''
+
+
+def session_seed_js(default=None):
+    """The browser's ``sessionSeed``: ``?seed=N``, a resumed session's own, else ``default``.
+
+    Without ``default`` each session draws a fresh seed.
+    """
+    fallback = 'crypto.getRandomValues(new Uint32Array(1))[0]' if default is None else str(default)
+    return f'''// ?seed=N reproduces a participant's order, a resumed session keeps its
+    // own; otherwise {'draw a fresh seed' if default is None else 'use the build seed'}
+    const seedParam = new URLSearchParams(location.search).get('seed');
+    const sessionSeed = seedParam !== null && /^\\d+$/.test(seedParam)
+        ? Number(seedParam) >>> 0
+        : resumed ? resumed.seed : {fallback};'''
+
+
+# Seeded expansion of the block/section design in the browser. Segments are
+# [templateIds, repeats, isSection]; sections are shuffled per repetition.
+SEEDED_EXPANSION_JS = '''function expandDesign(design, seed) {
+        const random = mulberry32(seed);
+        const sequence = [];
+        const runs = [];
+        for (let rep = 1; rep <= design.repeatCount; rep++) {
+            for (const [ids, repeats, isSection] of design.segments) {
+                for (let segRep = 1; segRep <= repeats; segRep++) {
+                    const order = ids.slice();
+                    if (isSection && design.randomize) shuffleInPlace(order, random);
+                    for (const id of order) sequence.push(id);
+                    runs.push([rep, isSection ? 1 : segRep, order.length]);
+                }
+            }
+        }
+        return [sequence, runs];
+    }'''
+
+# Conditional sequencing. `flow.nodes` are the design's segments as
+# [templateIds, repeats, isSection] and `flow.rules[n]` is node n's jump
+# table: [target node or -1 to end, tests], each test [measure, op, value]
+# with indices into peg_condition.MEASURES and OPS. Trials are appended one
+# run of a node at a time; when a run's last trial ends, its counters
+# answer every test in constant time and pick the next node. The state is a
+# plain object so a streamed session can resume it.
+CONDITIONAL_FLOW_JS = '''const flowOps = [(a, b) => a < b, (a, b) => a <= b, (a, b) => a > b, (a, b) => a >= b,
+                     (a, b) => a === b, (a, b) => a !== b];
+    const flowMeasures = [
+        s => s.scored ? 100 * s.correct / s.scored : null,  // accuracy
+        s => s.correct,
+        s => s.scored - s.correct,                           // incorrect
+        s => s.responded ? s.rtSum / s.responded : null,     // rt
+        null,                                                // response: compared as a key set
+        s => s.runs[s.node]
+    ];
+    const RESPONSE_MEASURE = 4;
+    const flowState = resumed && resumed.flow ? resumed.flow : {
+        repetition: 1, node: 0, runCount: 0, runs: [],
+        scored: 0, correct: 0, responded: 0, rtSum: 0, lastResponse: null,
+        sequence: [], trialRepetition: [], trialBlockRepetition: []
+    };
+    let trialCount = flowState.sequence.length;
+
+    // Append one run of `node`: its Block Repeats passes, sections shuffled
+    function startRun(node) {
+        const s = flowState;
+        const [ids, repeats, isSection] = flow.nodes[node];
+        const run = s.runs[node] = (s.runs[node] || 0) + 1;
+        const random = mulberry32((sessionSeed + Math.imul(++s.runCount, 0x9E3779B9)) >>> 0);
+        s.node = node;
+        s.scored = s.correct = s.responded = s.rtSum = 0;
+        s.lastResponse = null;
+        for (let pass = 1; pass <= repeats; pass++) {
+            const order = isSection && flow.randomize ? shuffleInPlace(ids.slice(), random) : ids;
+            for (const id of order) {
+                s.sequence.push(id);
+                s.trialRepetition.push(s.repetition);
+                s.trialBlockRepetition.push(isSection ? 1 : (run - 1) * repeats + pass);
+            }
+        }
+        trialCount = s.sequence.length;
+    }
+
+    function flowTest([measure, op, value]) {
+        const s = flowState;
+        if (measure === RESPONSE_MEASURE) return (value[s.lastResponse] === 1) === (op === 4);  // 4 is =
+        const observed = flowMeasures[measure](s);
+        return observed !== null && flowOps[op](observed, value);
+    }
+
+    // Count a finished trial; after the last trial of a run, follow the
+    // first rule whose tests hold or go on to the next node
+    function advanceFlow(trial, isCorrect, name, responseTime) {
+        const s = flowState;
+        if (trial.correctResponse) {
+            s.scored++;
+            if (isCorrect) s.correct++;
+        }
+        if (name !== null) {
+            s.responded++;
+            s.rtSum += responseTime;
+            s.lastResponse = name;
+        }
+        if (currentTrial !== trialCount - 1) return;
+        for (const [target, tests] of flow.rules[s.node]) {
+            if (tests.every(flowTest)) {
+                if (target >= 0) startRun(target);
+                return;
+            }
+        }
+        if (s.node + 1 < flow.nodes.length) {
+            startRun(s.node + 1);
+        } else if (s.repetition < flow.repeatCount) {
+            s.repetition++;
+            s.runs = [];
+            startRun(0);
+        }
+    }
+
+    if (trialCount === 0 && flow.nodes.length) startRun(0);
+    function templateAt(i) { return templates[flowState.sequence[i]]; }
+    function templateIdAt(i) { return flowState.sequence[i]; }
+    function trialAt(i) {
+        return Object.assign({}, templates[flowState.sequence[i]], {
+            repetition: flowState.trialRepetition[i],
+            blockRepetition: flowState.trialBlockRepetition[i],
+            trialIndex: i
+        });
+    }
+    // Any block may come next: plan the first run, then every block in order
+    function* plannedTemplates() {
+        for (let i = 0; i < trialCount; i++) yield templateAt(i);
+        for (const [ids] of flow.nodes) for (const id of ids) yield templates[id];
+    }'''
+
+
+def full_trial_data(schedule, templates, progress=None):
+    """Every presented trial spelled out as its own object."""
+    js_trials = []
+    for i, (row, rep, block_rep, _) in enumerate(_with_progress(schedule, len(schedule), progress)):
+        js_trial = dict(templates[row])
+        js_trial.update({'repetition': rep, 'blockRepetition': block_rep, 'trialIndex': i})
+        js_trials.append(js_trial)
+    return f'''const trials = {json.dumps(js_trials, indent=4)};
+    const sessionSeed = {schedule.seed};
+    const trialCount = trials.length;
+    function templateAt(i) {{ return trials[i]; }}
+    function trialAt(i) {{ return trials[i]; }}
+    function* plannedTemplates() {{ yield* trials; }}'''
+
+
+def compact_trial_data(schedule, templates, progress=None):
+    """Unique templates once, the order as template indices and repetition runs."""
+    unique, template_ids = unique_templates(templates)
+    sequence = [template_ids[row] for row, _, _, _ in _with_progress(schedule, len(schedule), progress)]
+    runs = [[rep, block_rep, length] for rep, block_rep, _, length in schedule.runs()]
+    return f'''const templates = [{','.join(unique)}];
+    const sequence = {compact_json(sequence)};
+    const runs = {compact_json(runs)};
+    const sessionSeed = {schedule.seed};
+    {TRIAL_RESOLVER_JS}'''
+
+
+def runtime_trial_data(schedule, templates, progress=None):
+    """Unique templates and the block/section design, expanded by the browser.
+
+    The file size no longer depends on repeat counts and every participant
+    gets their own seeded order from the same file. A schedule built with an
+    explicit seed (``--seed``, or a participant's seed in a batch) uses it
+    instead, unless ``?seed=`` or a resumed session gives another.
+    """
+    unique, template_ids = unique_templates(templates)
+    design = {
+        'segments': [[[template_ids[row] for row in indices], repeats, is_section]
+                     for indices, repeats, is_section in schedule.segments],
+        'repeatCount': schedule.repeat_count,
+        'randomize': schedule.randomize
+    }
+    return f'''const templates = [{','.join(unique)}];
+    const design = {compact_json(design)};
+    {SEEDED_RANDOM_JS}
+    {session_seed_js(schedule.seed if schedule.seeded else None)}
+    {SEEDED_EXPANSION_JS}
+    const [sequence, runs] = expandDesign(design, sessionSeed);
+    {TRIAL_RESOLVER_JS}'''
+
+
+def conditional_trial_data(schedule, templates, progress=None):
+    """Unique templates and the block graph with its jump table, followed in the browser.
+
+    The order depends on the participant's responses, so it is neither
+    expanded here nor enumerated: the file size depends on the design only.
+    Sections are shuffled from the build seed unless ``?seed=`` or a resumed
+    session gives another.
+    """
+    unique, template_ids = unique_templates(templates)
+    node_of = {block: n for n, blocks in enumerate(schedule.segment_blocks) for block in blocks}
+    rules = []
+    for n, node_rules in enumerate(schedule.conditions):
+        table = []
+        for rule in node_rules:
+            target = n if rule.action == 'repeat' else -1 if rule.action == 'end' else node_of[rule.target]
+            tests = [[MEASURES.index(t.measure), OPS.index(t.op),
+                      key_names([t.value]) if t.measure == 'response' else t.value] for t in rule.tests]
+            table.append([target, tests])
+        rules.append(table)
+    flow = {
+        'nodes': [[[template_ids[row] for row in indices], repeats, is_section]
+                  for indices, repeats, is_section in schedule.segments],
+        'rules': rules,
+        'repeatCount': schedule.repeat_count,
+        'randomize': schedule.randomize
+    }
+    return f'''const templates = [{','.join(unique)}];
+    const flow = {compact_json(flow)};
+    {SEEDED_RANDOM_JS}
+    {session_seed_js(schedule.seed)}
+    {CONDITIONAL_FLOW_JS}'''
+
+
+# Each takes (schedule, templates, progress=None); those that expand the
+# trial order call progress(fraction) as they go
+OUTPUT_FORMATS = {'full': full_trial_data, 'compact': compact_trial_data, 'runtime': runtime_trial_data}
+
+# How result records are built and encoded. 'full' copies the whole trial
+# object into each record (the original layout). 'lean' keeps the trial's
+# position, its template ID and what was observed, and sends the templates
+# once per results document; 'columnar' is 'lean' stored as one array per
+# field. peg_results.rehydrate() restores the full view of either.
+RESULT_SCHEMAS = ('full', 'lean', 'columnar')
+
+FULL_RESULTS_JS = '''function resultRecord(trial, observed) { return Object.assign(trial, observed); }
+    function encodeResults(records) { return records; }'''
+
+LEAN_RESULTS_JS = '''function resultRecord(trial, observed) {
+        const { intendedDuration, ...measured } = observed;  // intendedDuration is the template's latency
+        return Object.assign({
+            trialIndex: trial.trialIndex,
+            templateId: templateIdAt(trial.trialIndex),
+            repetition: trial.repetition,
+            blockRepetition: trial.blockRepetition
+        }, measured);
+    }
+    function encodeResults(records) {
+        if (resultSchema !== 'columnar') return records;
+        const columns = {};
+        records.forEach((record, i) => {
+            for (const field in record) {
+                (columns[field] || (columns[field] = new Array(records.length).fill(null)))[i] = record[field];
+            }
+        });
+        return columns;
+    }'''
+
+# Streaming sessions keep their state in localStorage under a per-page key,
+# so a reload picks up where the participant left off.
+RESUME_JS = '''const sessionKey = 'peg:' + location.pathname + location.search;
+    const resumed = (() => {
+        try { return JSON.parse(localStorage.getItem(sessionKey)); } catch (e) { return null; }
+    })();'''
+
+# Timing quality: refresh rate, onset jitter, latency overshoot, dropped
+# frames, hidden-tab time and event-loop stalls, summarised into every
+# results document as `timing`. peg_timing.py reports on it.
+TIMING_JS = '''const STALL_MS = 50;  // a frame this late means the main thread was blocked
+    const timingStats = {
+        initialFrameDuration: null,
+        onsetJitter: [],   // per trial: how much later than one refresh the onset frame came
+        overshoot: [],     // per timed-out latency trial: actual minus intended duration
+        droppedFrames: 0,
+        trialsWithDroppedFrames: 0,
+        visibilityChanges: 0,
+        hiddenMs: 0,
+        hiddenSince: document.hidden ? performance.now() : null,
+        hiddenTrials: 0,   // trials that ended while the tab was hidden
+        stalls: 0,
+        longestStall: 0,
+        longTasks: null    // filled in where the browser reports long tasks
+    };
+
+    document.addEventListener('visibilitychange', () => {
+        timingStats.visibilityChanges++;
+        if (document.hidden) {
+            timingStats.hiddenSince = performance.now();
+        } else if (timingStats.hiddenSince !== null) {
+            timingStats.hiddenMs += performance.now() - timingStats.hiddenSince;
+            timingStats.hiddenSince = null;
+        }
+    });
+
+    try {
+        if (PerformanceObserver.supportedEntryTypes.includes('longtask')) {
+            const longTasks = timingStats.longTasks = { count: 0, totalMs: 0, maxMs: 0 };
+            new PerformanceObserver(list => {
+                for (const entry of list.getEntries()) {
+                    longTasks.count++;
+                    longTasks.totalMs = Math.round(longTasks.totalMs + entry.duration);
+                    longTasks.maxMs = Math.max(longTasks.maxMs, Math.round(entry.duration));
+                }
+            }).observe({ type: 'longtask', buffered: true });
+        }
+    } catch (e) {}  // No PerformanceObserver: longTasks stays null
+
+    function timingDistribution(values) {
+        if (values.length === 0) return null;
+        const sorted = values.slice().sort((a, b) => a - b);
+        const round = v => Math.round(v * 100) / 100;
+        return {
+            mean: round(sorted.reduce((a, b) => a + b, 0) / sorted.length),
+            p95: round(sorted[Math.min(sorted.length - 1, Math.floor(sorted.length * 0.95))]),
+            max: round(sorted[sorted.length - 1])
+        };
+    }
+
+    function timingSummary() {
+        const s = timingStats;
+        const hiddenMs = s.hiddenMs + (s.hiddenSince !== null ? performance.now() - s.hiddenSince : 0);
+        return {
+            refreshRate: s.initialFrameDuration ? Math.round(10000 / s.initialFrameDuration) / 10 : null,
+            frameDuration: Math.round(frameDuration * 100) / 100,
+            trials: s.onsetJitter.length,
+            onsetJitter: timingDistribution(s.onsetJitter),
+            overshoot: timingDistribution(s.overshoot),
+            droppedFrames: s.droppedFrames,
+            trialsWithDroppedFrames: s.trialsWithDroppedFrames,
+            visibilityChanges: s.visibilityChanges,
+            hiddenMs: Math.round(hiddenMs),
+            hiddenTrials: s.hiddenTrials,
+            stalls: s.stalls,
+            longestStall: Math.round(s.longestStall),
+            longTasks: s.longTasks
+        };
+    }'''
+
+# Audio stimuli are fetched and decoded into AudioBuffers before the first
+# trial, then started on the AudioContext clock. The time a sound reaches the
+# speakers is converted to the performance.now() timebase of onsets and key
+# events and recorded as audioOnsetTime.
+AUDIO_JS = '''const AudioContextClass = window.AudioContext || window.webkitAudioContext;
+    const audioContext = audioSources.length && AudioContextClass ? new AudioContextClass({ latencyHint: 'interactive' }) : null;
+    const audioBuffers = [];
+
+    function loadAudio() {
+        if (!audioContext) return Promise.resolve();
+        return Promise.all(audioSources.map(([attr, value], i) =>
+            fetch(attr === 'data-asset' ? assetBundle[value] : value)
+                .then(response => response.arrayBuffer())
+                .then(data => new Promise((resolve, reject) => audioContext.decodeAudioData(data, resolve, reject)))
+                .then(buffer => { audioBuffers[i] = buffer; })
+                .catch(error => console.error('Could not load audio ' + value + ':', error))));
+    }
+
+    // Browsers only let audio play after a key press or click on the page
+    function unlockAudio() {
+        if (!audioContext || audioContext.state === 'running') return Promise.resolve();
+        return new Promise(resolve => {
+            document.getElementById('container').innerHTML = '<h2>Press any key or click to start</h2>';
+            const start = () => {
+                document.removeEventListener('keydown', start);
+                document.removeEventListener('pointerdown', start);
+                audioContext.resume().then(resolve, resolve);
+            };
+            document.addEventListener('keydown', start);
+            document.addEventListener('pointerdown', start);
+        });
+    }
+
+    // Schedule a trial's sounds to be heard `delay` ms after `onset`, or as
+    // soon as possible if that has passed. Returns when the first is heard.
+    function playAudio(sounds, onset) {
+        if (!audioContext || !sounds) return null;
+        // Pair a context time with the performance.now() time it is heard at
+        const stamp = audioContext.getOutputTimestamp ? audioContext.getOutputTimestamp() : null;
+        const [contextTime, heardAt] = stamp && stamp.performanceTime > 0
+            ? [stamp.contextTime, stamp.performanceTime]
+            : [audioContext.currentTime, performance.now() + (audioContext.outputLatency || audioContext.baseLatency || 0) * 1000];
+        let first = null;
+        for (const [source, volume, delay] of sounds) {
+            const buffer = audioBuffers[source];
+            if (!buffer) continue;
+            const when = Math.max(audioContext.currentTime, contextTime + (onset + delay - heardAt) / 1000);
+            const node = audioContext.createBufferSource();
+            node.buffer = buffer;
+            let output = node;
+            if (volume !== 1) {
+                output = audioContext.createGain();
+                output.gain.value = volume;
+                node.connect(output);
+            }
+            output.connect(audioContext.destination);
+            node.start(when);
+            const heard = heardAt + (when - contextTime) * 1000;
+            if (first === null || heard < first) first = heard;
+        }
+        return first;
+    }'''
+
+
+def generate_html(schedule, save_to_server=False, participant=None, output_format='full',
+                  stimulus_pool_limit=0, assets=None, stimulus_cache=None,
+                  stream_results=0, stream_interval=10, result_schema='full', progress=None,
+                  profile=None):
+    """Render a trial schedule into the experiment HTML document.
+
+    ``output_format`` is ``'full'`` (one JSON object per presented trial),
+    ``'compact'`` (unique trial templates plus an index sequence, resolved by
+    the runtime as trials are shown) or ``'runtime'`` (templates plus the
+    block design, expanded and shuffled in the browser with its own seed).
+    Designs with conditions always ship their block graph and jump table
+    (see :func:`conditional_trial_data`), whatever the ``output_format``.
+
+    Each unique stimulus is pre-rendered into a detached DOM node before the
+    first trial. ``stimulus_pool_limit`` caps how many are kept (least
+    recently used are evicted, upcoming ones are built a trial ahead); 0
+    keeps them all. ``assets`` is the :class:`~peg_assets.AssetPipeline`
+    used for images (default: relative ``images/`` paths); the caller writes
+    any hashed asset files. ``stimulus_cache`` is an optional dict of
+    processed stimuli kept between builds with the same ``assets``.
+
+    With ``stream_results`` set, results are posted to the server in batches
+    of that many trials (or every ``stream_interval`` seconds) while the
+    experiment runs. Unsent trials are kept in localStorage and a reloaded
+    page resumes at the next trial. Implies ``save_to_server``.
+
+    ``result_schema`` is one of :data:`RESULT_SCHEMAS`.
+
+    ``progress(fraction)`` is called as the stimuli are processed and the
+    trial order is expanded; it may raise :class:`BuildCancelled`. A
+    :class:`~peg_profile.BuildProfile` as ``profile`` times both steps.
+    """
+    randomize, repeat_count = schedule.randomize, schedule.repeat_count
+    assets = assets or AssetPipeline()
+    profile = profile or NO_PROFILE
+
+    # Progress counts table rows, then presented trials for each pass over
+    # the expanded order (none for formats the browser expands, two for lean
+    # results in the full format)
+    expand_passes = 0 if schedule.conditional or output_format == 'runtime' else \
+        2 if output_format == 'full' and result_schema != 'full' else 1
+    table_work = len(schedule.table)
+    pass_work = len(schedule) if progress is not None and expand_passes else 0
+    def part_progress(done, share):
+        if progress is None:
+            return None
+        total = table_work + expand_passes * pass_work or 1
+        return lambda fraction: progress((done + fraction * share) / total)
+
+    # Stimuli are processed once per unique stimulus, not once per presentation
+    stimuli = {} if stimulus_cache is None else stimulus_cache
+    templates = []
+    audio_sources = {}  # (attribute, value) -> index in audioSources
+    with profile.stage('stimuli'):
+        cached = len(stimuli)
+        for t in _with_progress(schedule.table, table_work, part_progress(0, table_work)):
+            raw = t['stimulus']
+            if raw not in stimuli:
+                stimuli[raw] = process_stim(raw, assets)
+            html, position, sounds = stimuli[raw]
+            audio = [[audio_sources.setdefault((attr, value), len(audio_sources)), volume, delay]
+                     for attr, value, volume, delay in sounds]
+            templates.append(trial_template(t, html, position, audio))
+        profile.count('unique_stimuli', len({t['stimulus'] for t in schedule.table}))
+        profile.count('processed_stimuli', len(stimuli) - cached)
+    # The schedule is lazy: the trial order is expanded and encoded here
+    with profile.stage('trials'):
+        if schedule.conditional:
+            trial_data_js = conditional_trial_data(schedule, templates)
+        else:
+            trial_data_js = OUTPUT_FORMATS[output_format](
+                schedule, templates, part_progress(table_work, pass_work)) + \
+                '\n    function advanceFlow(trial, isCorrect, name, responseTime) {}  // The order is fixed'
+        if result_schema != 'full' and output_format == 'full' and not schedule.conditional:
+            # Lean records refer to unique templates, which the full layout lacks
+            unique, template_ids = unique_templates(templates)
+            ids_progress = part_progress(table_work + pass_work, pass_work)
+            trial_template_ids = [template_ids[row] for row, _, _, _ in
+                                  _with_progress(schedule, len(schedule), ids_progress)]
+            trial_data_js += f'''
+    const templates = [{','.join(unique)}];
+    const trialTemplateIds = {compact_json(trial_template_ids)};
+    function templateIdAt(i) {{ return trialTemplateIds[i]; }}'''
+    asset_bundle_json = json.dumps(assets.bundle(
+        [t['stimulus'] for t in templates] + [f'{attr}="{value}"' for attr, value in audio_sources]))
+    audio_sources_json = json.dumps([list(source) for source in audio_sources])
+    rules_js = response_rules_js(templates)
+
+    # Session metadata recorded by every downloadData variant
+    metadata = {'randomized': randomize, 'repetitions': repeat_count}
+    if participant is not None:
+        metadata['participant'] = participant
+    metadata_js = ''.join(f'{k}: {json.dumps(v)},\n            ' for k, v in metadata.items()) + \
+        'seed: sessionSeed,\n            timing: timingSummary(),'
+
+    # Lean schemas carry the template table in the document header and are
+    # written without indentation
+    if result_schema == 'full':
+        results_js, schema_js, json_indent = FULL_RESULTS_JS, '', 2
+    else:
+        results_js, json_indent = LEAN_RESULTS_JS, 0
+        schema_js = 'resultSchema: resultSchema,\n            templates: templates,'
+
+    # Generate conditional downloadData function
+    resume_js = 'const resumed = null;'
+    if stream_results:
+        resume_js = RESUME_JS
+        # Batches are always row records; the templates go with the first one
+        flow_session_js = ', flow: flowState' if schedule.conditional else ''
+        stream_schema_js = '' if result_schema == 'full' else \
+            "resultSchema: 'lean',\n            templates: templatesSent ? undefined : templates,"
+        download_function = f'''
+    // Streaming upload: finished trials wait in localStorage until the server
+    // acknowledges them, so a crash or reload loses at most the current trial.
+    // The server drops trials it already has (same experimentId and
+    // trialIndex), so resending after a lost response is harmless.
+    const streamBatchSize = {int(stream_results)};
+    const experimentId = resumed ? resumed.experimentId
+        : 'exp_' + Date.now().toString(36) + crypto.getRandomValues(new Uint32Array(1))[0].toString(36);
+    let pendingUpload = resumed ? resumed.pending : [];
+    let sessionPosition = resumed ? resumed.position : 0;
+    let templatesSent = resumed ? resumed.templatesSent : false;
+    let uploading = false;
+
+    function saveSession() {{
+        try {{
+            localStorage.setItem(sessionKey, JSON.stringify({{
+                experimentId: experimentId, seed: sessionSeed, position: sessionPosition,
+                templatesSent: templatesSent, pending: pendingUpload{flow_session_js}
+            }}));
+        }} catch (e) {{
+            // Storage full or disabled: uploads still go ahead, only resuming is lost
+        }}
+    }}
+
+    function onTrialResult(result) {{
+        pendingUpload.push(result);
+        sessionPosition = currentTrial + 1;
+        saveSession();
+        if (pendingUpload.length >= streamBatchSize) {{
+            (window.requestIdleCallback || setTimeout)(uploadPending);
+        }}
+    }}
+
+    // Resolves true once nothing is left to send
+    function uploadPending() {{
+        if (uploading) return Promise.resolve(false);
+        if (pendingUpload.length === 0) return Promise.resolve(true);
+        uploading = true;
+        const batch = pendingUpload.slice();
+        const data = {{
+            experimentId: experimentId,
+            timestamp: new Date().toISOString(),
+            browserInfo: navigator.userAgent,
+            {metadata_js}
+            {stream_schema_js}
+            streamed: true,
+            trials: batch
+        }};
+        return fetch('/experiments/save_peg_results.php', {{
+            method: 'POST',
+            headers: {{
+                'Content-Type': 'application/json'
+            }},
+            body: JSON.stringify(data)
+        }})
+        .then(response => {{
+            if (!response.ok) {{
+                throw new Error('HTTP error! status: ' + response.status);
+            }}
+            return response.json();
+        }})
+        .then(result => {{
+            if (result.status !== 'success') {{
+                throw new Error(result.message || 'Failed to save results');
+            }}
+            pendingUpload = pendingUpload.slice(batch.length);
+            templatesSent = true;
+            saveSession();
+            return pendingUpload.length === 0;
+        }})
+        .catch(error => {{
+            console.warn('Upload deferred:', error);
+            return false;
+        }})
+        .finally(() => {{
+            uploading = false;
+        }});
+    }}
+
+    setInterval(uploadPending, {float(stream_interval) * 1000:g});
+    window.addEventListener('online', uploadPending);
+
+    function downloadData() {{
+        const container = document.getElementById('container');
+        container.innerHTML = "<h2>Experiment complete. Sending results...</h2>";
+        (function finish(attempt) {{
+            uploadPending().then(done => {{
+                if (done) {{
+                    localStorage.removeItem(sessionKey);
+                    container.innerHTML = "<h2>Experiment complete. Results sent to server!</h2>";
+                }} else if (attempt < 5) {{
+                    setTimeout(() => finish(attempt + 1), 1000 * attempt);
+                }} else {{
+                    // Unsent trials stay in localStorage; reopening the page retries
+                    container.innerHTML =
+                        "<h2>Experiment complete. Error saving to server.</h2><p>Attempting local download...</p>";
+                    downloadDataLocally();
+                }}
+            }});
+        }})(1);
+    }}
+
+    function downloadDataLocally() {{
+        // After a reload trialResults starts empty: unsent trials from before
+        // it are still in pendingUpload, sent ones are only on the server
+        const recorded = new Set(trialResults.map(r => r.trialIndex));
+        const trials = pendingUpload.filter(r => !recorded.has(r.trialIndex)).concat(trialResults);
+        const data = {{
+            experimentId: experimentId,
+            timestamp: new Date().toISOString(),
+            browserInfo: navigator.userAgent,
+            {metadata_js}
+            {schema_js}
+            resumedFrom: resumed ? resumed.position : undefined,
+            incomplete: resumed ? trials.length < sessionPosition : undefined,
+            trials: encodeResults(trials)
+        }};
+        const jsonData = JSON.stringify(data, null, {json_indent});
+        const blob = new Blob([jsonData], {{ type: 'application/json' }});
+        const url = URL.createObjectURL(blob);
+        const a = document.createElement('a');
+        a.href = url;
+        a.download = `experiment_data_${{experimentId}}.json`;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+        URL.revokeObjectURL(url);
+    }}'''
+    elif save_to_server:
+        download_function = f'''
+    function downloadData() {{
+        const experimentId = 'exp_' + Date.now().toString(36);
+        const data = {{
+            experimentId: experimentId,
+            timestamp: new Date().toISOString(),
+            browserInfo: navigator.userAgent,
+            {metadata_js}
+            {schema_js}
+            trials: encodeResults(trialResults)
+        }};
+
+        // Send to server via PHP
+        fetch('/experiments/save_peg_results.php', {{
+            method: 'POST',
+            headers: {{
+                'Content-Type': 'application/json'
+            }},
+            body: JSON.stringify(data)
+        }})
+        .then(response => {{
+            if (!response.ok) {{
+                throw new Error('HTTP error! status: ' + response.status);
+            }}
+            return response.json();
+        }})
+        .then(result => {{
+            if (result.status === 'success') {{
+                document.getElementById('container').innerHTML =
+                    "<h2>Experiment complete. Results sent to server!</h2>";
+            }} else {{
+                throw new Error(result.message || 'Failed to save results');
+            }}
+        }})
+        .catch(error => {{
+            console.error('Save error:', error);
+            document.getElementById('container').innerHTML =
+                "<h2>Experiment complete. Error saving to server: " + error.message + "</h2><p>Attempting local download...</p>";
+            // Fallback to local download
+            downloadDataLocally();
+        }});
+    }}
+
+    function downloadDataLocally() {{
+        const experimentId = 'exp_' + Date.now().toString(36);
+        const data = {{
+            experimentId: experimentId,
+            timestamp: new Date().toISOString(),
+            browserInfo: navigator.userAgent,
+            {metadata_js}
+            {schema_js}
+            trials: encodeResults(trialResults)
+        }};
+        const jsonData = JSON.stringify(data, null, {json_indent});
+        const blob = new Blob([jsonData], {{ type: 'application/json' }});
+        const url = URL.createObjectURL(blob);
+        const a = document.createElement('a');
+        a.href = url;
+        a.download = `experiment_data_${{experimentId}}.json`;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+        URL.revokeObjectURL(url);
+    }}'''
+    else:
+        # Preserve existing local download functionality
+        download_function = f'''
+    function downloadData() {{
+        const experimentId = 'exp_' + Date.now().toString(36);
+        const data = {{
+            experimentId: experimentId,
+            timestamp: new Date().toISOString(),
+            browserInfo: navigator.userAgent,
+            {metadata_js}
+            {schema_js}
+            trials: encodeResults(trialResults)
+        }};
+        const jsonData = JSON.stringify(data, null, {json_indent});
+        const blob = new Blob([jsonData], {{ type: 'application/json' }});
+        const url = URL.createObjectURL(blob);
+        const a = document.createElement('a');
+        a.href = url;
+        a.download = `experiment_data_${{experimentId}}.json`;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+        URL.revokeObjectURL(url);
+    }}'''
+
+    if not stream_results:
+        download_function += '''
+
+    function onTrialResult(result) {}  // Results are sent or saved once, at the end'''
+
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+<title>Experiment</title>
+<style>
+    body {{ background-color: darkgrey; color: white; font-family: Arial, sans-serif; height: 100vh; margin: 0; display: flex; justify-content: center; align-items: center; }}
+    #container {{ text-align: center; max-width: 90%; }}
+    #feedback {{ position: fixed; bottom: 20px; left: 50%; transform: translateX(-50%); padding: 8px 12px; background: rgba(0,0,0,0.6); border-radius: 6px; display: none; }}
+    input[type='text'] {{ font-size: 24px; padding: 8px; }}
+    button {{ font-size: 18px; padding: 8px 16px; margin-left: 8px; }}
+</style>
+</head>
+<body>
+<div id="container"></div>
+<div id="feedback"></div>
+<script>
+    {resume_js}
+    {trial_data_js}
+    const resultSchema = '{result_schema}';
+    {results_js}
+    const assetBundle = {asset_bundle_json};
+    const audioSources = {audio_sources_json};
+    {AUDIO_JS}
+    {rules_js}
+    const keyCodeNames = {{ ShiftLeft: 'lshift', ShiftRight: 'rshift' }};
+    const keyAliases = {json.dumps(KEY_ALIASES)};
+    
+    let currentTrial = 0;
+    let activeTrial = null;
+    let trialResults = [];
+
+    // Frame-locked timing: every screen change is made inside a
+    // requestAnimationFrame callback, and the callback's timestamp is taken as
+    // the time that frame is painted. Onsets, offsets and key event
+    // timeStamps all share the performance.now() timebase.
+    let frameDuration = 1000 / 60;  // refined from observed frame intervals
+    let lastFrameTime = null;
+    let phase = null;               // 'stimulus' or 'feedback' while a trial is on screen
+    let phaseOnset = 0;
+    let phaseDuration = null;
+    let droppedFrames = 0;
+    let pendingResponse = null;     // [response, event timeStamp, key name] waiting for the next frame
+    let frameInterval = null;       // time since the previous frame
+    let onsetJitter = 0;
+    let audioOnset = null;          // when the trial's first sound was heard
+
+    {TIMING_JS}
+
+    // Pre-rendered stimuli: each unique stimulus is parsed once into a
+    // detached node (with decoded images) and swapped in by reference.
+    const stimulusPoolLimit = {int(stimulus_pool_limit or 0)}; // 0 keeps every stimulus
+    const stimulusPool = new Map();
+
+    function buildStimulus(trial) {{
+        // Parsed in an inert template and without src, so no image is
+        // requested until load()
+        const template = document.createElement('template');
+        template.innerHTML = trial.stimulus;
+        const images = Array.from(template.content.querySelectorAll('img'));
+        const sources = images.map(img => {{
+            const src = img.dataset.asset ? assetBundle[img.dataset.asset] : img.getAttribute('src');
+            img.removeAttribute('src');
+            return src;
+        }});
+        const node = document.createElement('div');
+        node.style.display = 'contents';
+        node.appendChild(template.content);
+        const [y_pos, x_pos] = trial.position.split('-');
+        let loaded = false;
+        let decoded = null;
+        const load = () => {{
+            if (loaded) return;
+            loaded = true;
+            images.forEach((img, i) => {{ if (sources[i]) img.src = sources[i]; }});
+        }};
+        return {{
+            node: node,
+            alignItems: y_pos === 'top' ? 'flex-start' : y_pos === 'bottom' ? 'flex-end' : 'center',
+            justifyContent: x_pos === 'left' ? 'flex-start' : x_pos === 'right' ? 'flex-end' : 'center',
+            load: load,
+            decode: () => decoded || (load(), decoded = Promise.all(images.map(img => img.decode().catch(() => {{}}))))
+        }};
+    }}
+
+    function pooledStimulus(trial) {{
+        let entry = stimulusPool.get(trial.stimulus);
+        if (entry) {{
+            stimulusPool.delete(trial.stimulus); // Re-inserted below as most recently used
+        }} else {{
+            entry = buildStimulus(trial);
+        }}
+        stimulusPool.set(trial.stimulus, entry);
+        if (stimulusPoolLimit && stimulusPool.size > stimulusPoolLimit) {{
+            stimulusPool.delete(stimulusPool.keys().next().value);
+        }}
+        return entry;
+    }}
+
+    function prebuildStimuli() {{
+        // Fill the pool in presentation order, noting the trial each stimulus is first shown in
+        const entries = [];
+        let i = 0;
+        for (const trial of plannedTemplates()) {{
+            if (stimulusPoolLimit && stimulusPool.size >= stimulusPoolLimit) break;
+            if (!stimulusPool.has(trial.stimulus)) {{
+                const entry = pooledStimulus(trial);
+                entry.firstTrial = i;
+                entries.push(entry);
+            }}
+            i++;
+        }}
+        return entries;
+    }}
+
+    // Fetch and decode images progressively in presentation order, a couple
+    // at a time and at most DECODE_AHEAD stimuli past the one on screen, and
+    // start as soon as the first few stimuli are ready.
+    const DECODE_AHEAD = 10;
+    let wakeDecoders = () => {{}};  // called as trials advance
+    function decodeProgressively(entries, startAfter, lanes) {{
+        let next = 0;
+        let shown = 0;  // the last entry whose first trial has been reached
+        const waiting = [];
+        wakeDecoders = () => {{
+            while (shown + 1 < entries.length && entries[shown + 1].firstTrial <= currentTrial) shown++;
+            waiting.splice(0).forEach(resume => resume());
+        }};
+        const lane = () => {{
+            if (next >= entries.length) return null;
+            if (next > shown + DECODE_AHEAD) return new Promise(resume => waiting.push(resume)).then(lane);
+            return entries[next++].decode().then(lane);
+        }};
+        for (let i = 0; i < lanes; i++) lane();
+        return Promise.all(entries.slice(0, startAfter).map(entry => entry.decode()));
+    }}
+
+    function estimateFrameDuration(samples) {{
+        return new Promise(resolve => {{
+            const times = [];
+            function sample(t) {{
+                times.push(t);
+                if (times.length <= samples) return requestAnimationFrame(sample);
+                const intervals = times.slice(1).map((v, i) => v - times[i]).sort((a, b) => a - b);
+                frameDuration = intervals[Math.floor(intervals.length / 2)] || frameDuration;
+                timingStats.initialFrameDuration = frameDuration;
+                resolve();
+            }}
+            requestAnimationFrame(sample);
+        }});
+    }}
+
+    function tick(t) {{
+        if (currentTrial >= trialCount) return; // Experiment finished
+        requestAnimationFrame(tick);
+        frameInterval = lastFrameTime !== null ? t - lastFrameTime : null;
+        if (frameInterval !== null) {{
+            if (frameInterval > STALL_MS && !document.hidden) {{
+                timingStats.stalls++;
+                timingStats.longestStall = Math.max(timingStats.longestStall, frameInterval);
+            }}
+            if (frameInterval > frameDuration * 1.5) {{
+                if (phase === 'stimulus') droppedFrames += Math.round(frameInterval / frameDuration) - 1;
+            }} else {{
+                frameDuration += (frameInterval - frameDuration) * 0.05;
+            }}
+        }}
+        lastFrameTime = t;
+
+        // A change made now is painted in this frame, so end a timed phase on
+        // the frame closest to its intended offset.
+        if (phase === 'stimulus') {{
+            if (pendingResponse) {{
+                endStimulus(t, pendingResponse[0], pendingResponse[1], pendingResponse[2]);
+            }} else if (phaseDuration !== null && t >= phaseOnset + phaseDuration - frameDuration / 2) {{
+                endStimulus(t, null, null, null);
+            }}
+        }} else if (phase === 'feedback' && t >= phaseOnset + phaseDuration - frameDuration / 2) {{
+            document.getElementById('feedback').style.display = 'none';
+            nextTrial(t);
+        }}
+    }}
+
+    function keyName(key, code) {{
+        const name = key.toLowerCase();
+        return keyCodeNames[code] || keyAliases[name] || name;
+    }}
+
+    function respond(response, eventTime, name) {{
+        if (phase === 'stimulus' && !pendingResponse) pendingResponse = [response, eventTime, name];
+    }}
+
+    function showTrial(trial, t) {{
+        activeTrial = trial;
+        const container = document.getElementById('container');
+        const stimulus = pooledStimulus(trial);
+        stimulus.load();  // Normally done ahead by the decode lanes
+        wakeDecoders();
+        document.body.style.backgroundColor = trial.backgroundColor;
+        container.style.color = trial.stimulusColor;
+        document.body.style.alignItems = stimulus.alignItems;
+        document.body.style.justifyContent = stimulus.justifyContent;
+        container.replaceChildren(stimulus.node);
+        document.onkeydown = null;
+
+        // With a capped pool, build the next stimulus while this one is shown
+        const upcoming = currentTrial + 1;
+        if (stimulusPoolLimit && upcoming < trialCount) {{
+            setTimeout(() => pooledStimulus(templateAt(upcoming)).decode(), 0);
+        }}
+
+        const allowedKeys = responseKeys[trial.response];
+        if (allowedKeys) {{
+            document.onkeydown = (e) => {{
+                const name = keyName(e.key, e.code);
+                if (allowedKeys[name] === 1) {{
+                    document.onkeydown = null; // Disable further key presses
+                    respond(e.key, e.timeStamp, name);
+                }}
+            }};
+        }} else if (trial.response.trim().startsWith('[text')) {{
+            const input = document.createElement('input');
+            input.type = 'text';
+            const btn = document.createElement('button');
+            btn.textContent = 'Continue';
+            btn.onclick = (e) => respond(input.value, e.timeStamp, keyName(input.value, ''));
+            container.appendChild(document.createElement('br'));
+            container.appendChild(input);
+            container.appendChild(btn);
+            input.focus();
+        }}
+
+        // This frame paints the stimulus: it is the onset. A response during
+        // a timed trial ends it early; otherwise it ends after `latency` ms.
+        phase = 'stimulus';
+        phaseOnset = t;
+        phaseDuration = trial.latency;
+        droppedFrames = 0;
+        pendingResponse = null;
+        onsetJitter = frameInterval !== null ? Math.max(0, Math.round((frameInterval - frameDuration) * 100) / 100) : 0;
+        audioOnset = playAudio(trial.audio, t);
+    }}
+
+    function endStimulus(t, response, eventTime, name) {{
+        const trial = activeTrial;
+        document.onkeydown = null;
+        pendingResponse = null;
+        const responseTime = (eventTime !== null ? eventTime : t) - phaseOnset;
+
+        const correctKey = trial.correctResponse ? correctKeys[trial.correctResponse] : null;
+        const isCorrect = correctKey ? (response && correctKey[name] === 1) : null;
+
+        trialResults.push(resultRecord(trial, {{
+            actualResponse: response,
+            responseTime: responseTime,
+            isCorrect: isCorrect,
+            timestamp: new Date().toISOString(),
+            onsetTime: phaseOnset,
+            intendedDuration: trial.latency,
+            actualDuration: t - phaseOnset,
+            droppedFrames: droppedFrames,
+            frameDuration: frameDuration,
+            onsetJitter: onsetJitter,
+            ...(audioOnset !== null ? {{ audioOnsetTime: audioOnset }} : {{}})
+        }}));
+        timingStats.onsetJitter.push(onsetJitter);
+        if (response === null && trial.latency !== null) timingStats.overshoot.push(t - phaseOnset - trial.latency);
+        timingStats.droppedFrames += droppedFrames;
+        if (droppedFrames > 0) timingStats.trialsWithDroppedFrames++;
+        if (document.hidden) timingStats.hiddenTrials++;
+        advanceFlow(trial, isCorrect, name, responseTime);
+        onTrialResult(trialResults[trialResults.length - 1]);
+
+        // Feedback Text markers ([correct], [incorrect], [all]) are resolved at build time
+        const messages = trial.feedbackText ? feedbackMessages[trial.feedbackText] : null;
+        const feedbackMessage = messages ? messages[isCorrect === true ? 0 : isCorrect === false ? 1 : 2] : '';
+
+        if (feedbackMessage) {{
+            const fb = document.getElementById('feedback');
+            fb.textContent = feedbackMessage;
+            fb.style.display = 'block';
+            phase = 'feedback';
+            phaseOnset = t;
+            phaseDuration = trial.feedbackDuration || 1000;
+        }} else {{
+            nextTrial(t);
+        }}
+    }}
+
+    function nextTrial(t) {{
+        currentTrial++;
+        if (currentTrial < trialCount) {{
+            showTrial(trialAt(currentTrial), t);
+        }} else {{
+            phase = null;
+            document.getElementById('container').innerHTML = "<h2>Experiment complete. Thank you!</h2>";
+            downloadData();
+        }}
+    }}
+
+{download_function}
+
+    const ready = Promise.all([decodeProgressively(prebuildStimuli(), 5, 2), loadAudio()]).then(unlockAudio);
+    ready.then(() => estimateFrameDuration(20)).then(() => {{
+        if (trialCount === 0) return;
+        currentTrial = resumed ? resumed.position : 0;
+        if (currentTrial >= trialCount) {{
+            // Reloaded after the last trial: only the upload is left
+            document.getElementById('container').innerHTML = "<h2>Experiment complete. Thank you!</h2>";
+            downloadData();
+            return;
+        }}
+        requestAnimationFrame(t => {{
+            lastFrameTime = t;
+            showTrial(trialAt(currentTrial), t);
+            requestAnimationFrame(tick);
+        }});
+    }});
+</script>
+</body>
+</html>
+'''
+
+
+def write_atomic(path, data):
+    """Write ``data`` (bytes) to ``path`` via a temporary file and rename."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_if_changed(path, data):
+    """:func:`write_atomic` unless ``path`` already holds ``data``; returns whether it wrote."""
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+    write_atomic(path, data)
+    return True
+
+
+def build(design_path, output_path, repeat_count=1, randomize=True, seed=None,
+          save_to_server=False, images_dir="images", output_format='full',
+          stimulus_pool_limit=0, asset_mode='relative', downsize=None, cache=None,
+          stream_results=0, stream_interval=10, result_schema='full', progress=None,
+          profile=None):
+    """Compile a design CSV into an experiment HTML file.
+
+    Returns the :class:`~peg_schedule.Schedule` that was written, whose
+    ``seed`` reproduces the same trial order. Raises :class:`DesignError` if the
+    design is invalid or references missing images. Pass a
+    :class:`~peg_cache.BuildCache` as ``cache`` to reuse work between builds;
+    the output file is left untouched when its content would not change.
+
+    ``progress(stage, fraction)`` is called as each of :data:`BUILD_STAGES`
+    runs; raising :class:`BuildCancelled` from it abandons the build before
+    the output is written. Pass a :class:`~peg_profile.BuildProfile` as
+    ``profile`` to time each step and count rows, stimuli, trials and bytes.
+    """
+    def stage(name):
+        if progress is None:
+            return None
+        progress(name, 0.0)
+        return lambda fraction: progress(name, fraction)
+
+    if cache is None:
+        from peg_cache import BuildCache
+        cache = BuildCache()
+    profile = profile or NO_PROFILE
+    try:
+        with profile.stage('read'):
+            rows = read_design(design_path)
+        profile.count('rows', len(rows))
+        with profile.stage('validate'):
+            design = cache.parse_design(rows, progress=stage('validate'))
+        if not design.block_order:
+            raise DesignError("Please define at least one trial.")
+        profile.count('blocks', len(design.block_order))
+        with profile.stage('check_images'):
+            cache.check_images(design, images_dir)
+        with profile.stage('assets'):
+            assets, stimulus_cache = cache.assets(images_dir, asset_mode, downsize)
+        stage('expand')
+        # Not a profile stage: the schedule is lazy, and walking it is timed
+        # under render.trials
+        schedule = expand_trials(design, repeat_count, randomize, seed)
+        profile.count('expanded_trials', len(schedule))
+        with profile.stage('render'):
+            html_content = generate_html(schedule, save_to_server, output_format=output_format,
+                                         stimulus_pool_limit=stimulus_pool_limit, assets=assets,
+                                         stimulus_cache=stimulus_cache, stream_results=stream_results,
+                                         stream_interval=stream_interval, result_schema=result_schema,
+                                         progress=stage('render'), profile=profile)
+        stage('write')
+        with profile.stage('write'):
+            data = html_content.encode("utf-8")
+            profile.count('written', int(write_if_changed(output_path, data)))
+            assets.write(os.path.dirname(os.path.abspath(output_path)))
+        profile.count('output_bytes', len(data))
+    finally:
+        profile.stop()
+    return schedule
@@ -0,0 +1,75 @@
+"""Incremental build cache.
+
+Keeps the work of previous builds so that rebuilding after a small edit only
+redoes what changed:
+
+* design rows are validated once per distinct row content;
+* image checks use one directory listing instead of a ``stat`` per reference;
+* processed stimulus HTML and resolved assets are reused for as long as the
+  images directory is unchanged (same names, sizes and modification times).
+
+The GUI keeps one cache for the whole session; scripts can pass one to
+:func:`peg_build.build` when they rebuild repeatedly.
+"""
+import os
+
+from peg_assets import AssetPipeline
+from peg_build import parse_design, check_images
+
+
+class BuildCache:
+    """Parsed rows, image listings and processed stimuli from earlier builds."""
+
+    def __init__(self):
+        self.rows = {}     # row tuple -> parse_row result
+        self._assets = {}  # (images_dir, mode, downsize) -> (fingerprint, AssetPipeline, stimuli)
+
+    def parse_design(self, rows, progress=None):
+        """:func:`peg_build.parse_design`, validating only rows not seen before."""
+        design = parse_design(rows, self.rows, progress)
+        if len(self.rows) > 2 * len(rows) + 1000:
+            # Drop rows that were edited away so the cache cannot grow without bound
+            current = {tuple(row) for row in rows}
+            self.rows = {k: v for k, v in self.rows.items() if k in current}
+            stimuli = {row[2].strip() for row in rows}
+            for _, _, cached in self._assets.values():
+                for raw in [raw for raw in cached if raw not in stimuli]:
+                    del cached[raw]
+        return design
+
+    def fingerprint(self, images_dir):
+        """``{filename: (mtime, size)}`` for the files in ``images_dir``."""
+        files = {}
+        try:
+            with os.scandir(images_dir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            pass
+        return files
+
+    def check_images(self, design, images_dir):
+        """:func:`peg_build.check_images` against a single directory listing."""
+        files = self.fingerprint(images_dir)
+        def exists(fname):
+            if fname in files:
+                return True
+            # Names with a directory part are not in the listing
+            return os.path.isfile(os.path.join(images_dir, fname))
+        check_images(design, images_dir, exists)
+
+    def assets(self, images_dir="images", mode='relative', downsize=None):
+        """An :class:`~peg_assets.AssetPipeline` and its processed-stimulus cache.
+
+        Both are reused while the images directory is unchanged and replaced
+        as soon as any image is added, removed or modified.
+        """
+        key = (images_dir, mode, downsize)
+        files = self.fingerprint(images_dir)
+        cached = self._assets.get(key)
+        if cached is None or cached[0] != files:
+            cached = (files, AssetPipeline(images_dir, mode, downsize), {})
+            self._assets[key] = cached
+        return cached[1], cached[2]
@@ -0,0 +1,123 @@
+"""Condition column compiler.
+
+A block's Condition says where the experiment goes once the block has run.
+It is a list of rules separated by ``;``, checked in order; the first rule
+whose tests all hold is followed, and without one the next block runs:
+
+    repeat if accuracy < 80 and runs < 5; goto 301 if rt > 900
+
+``repeat`` runs the block again, ``goto <block>`` continues at another block
+(skipping ahead or going back) and ``end`` ends the experiment. A rule
+without ``if`` always applies. Tests compare a measure of the run that just
+ended with a value; see :data:`MEASURES`. :func:`parse_condition` turns the
+cell into :class:`Rule` tuples and raises :class:`ConditionError` for
+anything it cannot compile.
+"""
+import re
+from collections import namedtuple
+
+# Measures over the block's last run (all its Block Repeats passes):
+#   accuracy   percent correct of the trials with a Correct Response
+#   correct    trials answered correctly
+#   incorrect  trials with a Correct Response not answered correctly
+#   rt         mean response time of the trials with a response, in ms
+#   response   the last response given in the run (= and != only)
+#   runs       how many times the block has run, counting this run
+MEASURES = ('accuracy', 'correct', 'incorrect', 'rt', 'response', 'runs')
+OPS = ('<', '<=', '>', '>=', '=', '!=')
+
+# ``action`` is 'repeat', 'goto' or 'end'; ``target`` the goto block number
+Rule = namedtuple('Rule', 'action target tests')
+# ``value`` is a number, or the key spec ``response`` is compared with
+Test = namedtuple('Test', 'measure op value')
+
+rule_regex = re.compile(r'^(repeat|end|goto\s+(-?\d+))(?:\s+if\s+(.+))?$', re.IGNORECASE)
+test_regex = re.compile(r'^([a-z]+)\s*(<=|>=|!=|<|>|=)\s*(.+)$', re.IGNORECASE)
+
+
+class ConditionError(ValueError):
+    """A Condition cell that cannot be compiled, e.g. an unknown measure."""
+
+
+def parse_test(text):
+    """Parse one ``measure op value`` test into a :class:`Test`."""
+    m = test_regex.match(text.strip())
+    if not m:
+        raise ConditionError(f"Condition test '{text.strip()}' must look like 'accuracy < 80'.")
+    measure, op, value = m.group(1).lower(), m.group(2), m.group(3).strip()
+    if measure not in MEASURES:
+        raise ConditionError(f"Condition measure must be one of {', '.join(MEASURES)} (got '{measure}').")
+    if measure == 'response':
+        if op not in ('=', '!='):
+            raise ConditionError(f"Condition response can only be compared with = or != (got '{op}').")
+        return Test(measure, op, value)
+    try:
+        number = float(value[:-1] if measure == 'accuracy' and value.endswith('%') else value)
+    except ValueError:
+        raise ConditionError(f"Condition {measure} must be compared with a number (got '{value}').")
+    return Test(measure, op, number)
+
+
+def parse_condition(text):
+    """Compile a Condition cell into a tuple of :class:`Rule`; empty for no condition."""
+    rules = []
+    for part in [p.strip() for p in text.split(';') if p.strip()]:
+        m = rule_regex.match(part)
+        if not m:
+            raise ConditionError(f"Condition '{part}' must start with 'repeat', 'goto <block>' or 'end'.")
+        action = m.group(1).split()[0].lower()
+        tests = tuple(parse_test(t) for t in re.split(r'\s+and\s+', m.group(3), flags=re.IGNORECASE)) \
+            if m.group(3) else ()
+        if action == 'repeat' and not tests:
+            raise ConditionError("Condition 'repeat' needs a test, e.g. 'repeat if accuracy < 80'.")
+        rules.append(Rule(action, int(m.group(2)) if m.group(2) else None, tests))
+    return tuple(rules)
+
+
+def _section_start(block_num, block_order):
+    """The block a section's Condition and Block Repeats are read from: its lowest."""
+    if block_num < 100:
+        return block_num
+    return min(b for b in block_order if b >= 100 and b // 100 == block_num // 100)
+
+
+def check_placement(block_num, block_order):
+    """The problem with a Condition on ``block_num``, or None.
+
+    A section (blocks 100-199, 200-299, ...) runs as one unit and takes its
+    Condition from its lowest block, so one on any other block would be
+    ignored.
+    """
+    lowest = _section_start(block_num, block_order)
+    if block_num != lowest:
+        return f"Condition is only read from block {lowest}, the lowest block of this section."
+    return None
+
+
+def check_repeats(block_num, repeats, block_order):
+    """The problem with ``repeats`` Block Repeats on ``block_num`` in a design with conditions, or None.
+
+    Conditions are followed after a block's last trial, so a block that runs
+    no trials could never be left.
+    """
+    if repeats < 1 and _section_start(block_num, block_order) == block_num:
+        return "Block Repeats must be at least 1 in a design with conditions."
+    return None
+
+
+def check_targets(rules, block_num, block_order):
+    """The first problem with the blocks ``rules`` jump to, or None.
+
+    Every goto target must be a block of the design, and a goto without a
+    test must not lead back to this block or one before it, which would
+    loop forever.
+    """
+    position = {b: k for k, b in enumerate(block_order)}
+    for rule in rules:
+        if rule.action != 'goto':
+            continue
+        if rule.target not in position:
+            return f"Condition jumps to block {rule.target}, which is not in the design."
+        if not rule.tests and position[rule.target] <= position[block_num]:
+            return f"Condition 'goto {rule.target}' without 'if' would repeat forever."
+    return None
@@ -0,0 +1,124 @@
+"""Load test for the results ingestion server.
+
+Simulates many participants finishing at once: ``concurrency`` clients each
+keep a connection open and post result payloads of ``trials`` trials back to
+back for ``duration`` seconds. Reports sustained submissions/s and latency
+percentiles.
+
+    python peg.py loadtest --concurrency 500 --duration 10
+
+Without ``--url`` a server is started in a subprocess on a free port with a
+temporary results directory, so the numbers reflect this machine's disk.
+"""
+import os
+import sys
+import json
+import time
+import gzip
+import asyncio
+import tempfile
+import subprocess
+from urllib.parse import urlsplit
+
+from peg_server import RESULTS_PATH
+
+
+def sample_payload(trials):
+    """A results document shaped like the one downloadData posts."""
+    return {
+        'experimentId': 'exp_{id}',
+        'timestamp': '2024-01-01T00:00:00.000Z',
+        'browserInfo': 'peg-loadtest',
+        'randomized': True,
+        'repetitions': 1,
+        'seed': 1,
+        'trials': [{
+            'block': 101, 'stimulus': 'RED', 'response': 'z,m', 'latency': None,
+            'correctResponse': 'z', 'feedbackText': None, 'feedbackDuration': None,
+            'stimulusColor': 'red', 'backgroundColor': 'darkgrey', 'position': 'center-center',
+            'repetition': 1, 'blockRepetition': 1, 'trialIndex': i,
+            'actualResponse': 'z', 'responseTime': 412.3, 'isCorrect': True,
+            'timestamp': 1700000000000 + i, 'onsetTime': 1000.0 + i, 'intendedDuration': None,
+            'actualDuration': 412.3, 'droppedFrames': 0, 'frameDuration': 16.67
+        } for i in range(trials)]
+    }
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+async def _client(host, port, path, body_parts, compress, deadline, latencies, errors, counter):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            counter[0] += 1
+            body = body_parts[0] + format(counter[0], 'x').encode() + body_parts[1]
+            headers = f'POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+            if compress:
+                body = gzip.compress(body, 1)
+                headers += 'Content-Encoding: gzip\r\n'
+            headers += f'Content-Length: {len(body)}\r\n\r\n'
+            start = time.perf_counter()
+            writer.write(headers.encode('latin-1') + body)
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[0] += 1
+    finally:
+        writer.close()
+
+
+async def _run(host, port, path, concurrency, duration, trials, compress):
+    template = json.dumps(sample_payload(trials)).encode('utf-8')
+    body_parts = template.split(b'{id}')
+    latencies, errors, counter = [], [0], [0]
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[_client(host, port, path, body_parts, compress, deadline, latencies, errors, counter)
+                           for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'submissions': len(latencies),
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'submissions_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round((latencies[-1] if latencies else 0) * 1000, 2),
+        'concurrency': concurrency,
+        'trials_per_submission': trials,
+        'gzip': compress
+    }
+
+
+def run_load_test(url=None, concurrency=100, duration=10.0, trials=200, compress=True, shards=16):
+    """Run the load test and return its statistics as a dict."""
+    if url is not None:
+        parts = urlsplit(url)
+        return asyncio.run(_run(parts.hostname, parts.port or 80, parts.path or RESULTS_PATH,
+                                concurrency, duration, trials, compress))
+
+    with tempfile.TemporaryDirectory() as results_dir:
+        peg = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'peg.py')
+        server = subprocess.Popen([sys.executable, peg, 'serve', '--port', '0', '--results-dir', results_dir,
+                                   '--shards', str(shards)], stdout=subprocess.PIPE, text=True)
+        try:
+            port = urlsplit(server.stdout.readline().split()[-1]).port
+            stats = asyncio.run(_run('127.0.0.1', port, RESULTS_PATH, concurrency, duration, trials, compress))
+        finally:
+            server.terminate()
+            server.wait()
+        stats['stored_bytes'] = sum(os.path.getsize(os.path.join(results_dir, n)) for n in os.listdir(results_dir))
+        return stats
@@ -1,12 +1,150 @@
 import tkinter as tk
-from tkinter import messagebox, filedialog
+from tkinter import messagebox, filedialog, ttk
 import webbrowser
 import os
 import csv
-import random
 import shutil
-import re
-import json
+import filecmp
+import queue
+import threading
+import time
+
+from peg_assets import AssetError
+from peg_build import (HEADERS, BUILD_STAGES, BuildCancelled, DesignError, iter_design,
+                       expand_trials, generate_html, write_if_changed)
+from peg_cache import BuildCache
+from peg_preview import start_preview
+from peg_schedule import new_seed
+from peg_validate import validate_design
+
+class VirtualTrialGrid:
+    """Scrollable trial table that only materializes the rows in view.
+
+    The design is held in ``rows`` as a list of string tuples. A fixed pool of
+    Entry widgets is recycled as the view scrolls, and edits are written back
+    to the backing table immediately.
+    """
+
+    def __init__(self, master, headers, widths, visible_rows=18):
+        self.frame = tk.Frame(master)
+        self.headers = headers
+        self.visible_rows = visible_rows
+        self.rows = []
+        self.top = 0
+        self._refreshing = False
+        self._values = {}  # shared copies of repeated cell values
+
+        tk.Label(self.frame, text='#', font=('Arial', 12, 'bold')).grid(row=0, column=0, padx=5, pady=5)
+        for i, header in enumerate(headers):
+            label = tk.Label(self.frame, text=header, font=('Arial', 12, 'bold'))
+            label.grid(row=0, column=i + 1, padx=5, pady=5)
+
+        self.scrollbar = tk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.scrollbar.grid(row=1, column=len(headers) + 1, rowspan=visible_rows, sticky='ns')
+
+        self.row_labels = []
+        self.cells = []
+        for slot in range(visible_rows):
+            lbl = tk.Label(self.frame, width=6, anchor='e', fg='grey')
+            lbl.grid(row=slot + 1, column=0, padx=(5, 0), pady=2)
+            self.row_labels.append(lbl)
+            slot_cells = []
+            for col, w in enumerate(widths):
+                var = tk.StringVar()
+                var.trace_add('write', lambda *_, s=slot, c=col, v=var: self._on_edit(s, c, v))
+                e = tk.Entry(self.frame, width=w, textvariable=var)
+                e.grid(row=slot + 1, column=col + 1, padx=5, pady=2)
+                e.bind('<Up>', lambda ev, s=slot, c=col: self._move_focus(s, c, -1))
+                e.bind('<Down>', lambda ev, s=slot, c=col: self._move_focus(s, c, 1))
+                slot_cells.append((e, var))
+            self.cells.append(slot_cells)
+
+        # Bind mousewheel to the grid
+        master.bind_all("<MouseWheel>", lambda e: self.yview('scroll', int(-1*(e.delta/120)), 'units'))
+        master.bind_all("<Button-4>", lambda e: self.yview('scroll', -1, 'units'))
+        master.bind_all("<Button-5>", lambda e: self.yview('scroll', 1, 'units'))
+
+        self.refresh()
+
+    def _intern(self, values):
+        return tuple(self._values.setdefault(v, v) for v in values)
+
+    def set_rows(self, rows):
+        self.rows = [self._intern(r) for r in rows]
+        self.top = 0
+        self.refresh()
+
+    def extend_rows(self, rows):
+        visible = len(self.rows) < self.top + self.visible_rows
+        self.rows.extend(self._intern(r) for r in rows)
+        if visible:
+            self.refresh()
+        else:
+            self.scrollbar.set(self.top / len(self.rows),
+                               min(1.0, (self.top + self.visible_rows) / len(self.rows)))
+
+    def append_row(self, values=None):
+        self.rows.append(self._intern(values or [''] * len(self.headers)))
+        self.see(len(self.rows) - 1)
+
+    def see(self, index):
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.visible_rows:
+            self.top = index - self.visible_rows + 1
+        self.refresh()
+
+    def yview(self, *args):
+        max_top = max(0, len(self.rows) - self.visible_rows)
+        if args[0] == 'moveto':
+            top = int(float(args[1]) * len(self.rows))
+        elif args[2] == 'pages':
+            top = self.top + int(args[1]) * self.visible_rows
+        else:
+            top = self.top + int(args[1])
+        top = min(max(top, 0), max_top)
+        if top != self.top:
+            self.top = top
+            self.refresh()
+
+    def refresh(self):
+        self._refreshing = True
+        for slot, slot_cells in enumerate(self.cells):
+            index = self.top + slot
+            row = self.rows[index] if index < len(self.rows) else None
+            self.row_labels[slot].config(text=str(index + 1) if row else '')
+            for col, (e, var) in enumerate(slot_cells):
+                e.config(state='normal')
+                var.set(row[col] if row else '')
+                if not row:
+                    e.config(state='disabled')
+        self._refreshing = False
+        if self.rows:
+            self.scrollbar.set(self.top / len(self.rows),
+                               min(1.0, (self.top + self.visible_rows) / len(self.rows)))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _on_edit(self, slot, col, var):
+        if self._refreshing: return
+        index = self.top + slot
+        if index < len(self.rows):
+            row = list(self.rows[index])
+            row[col] = var.get()
+            self.rows[index] = tuple(row)
+
+    def focus_cell(self, index, col):
+        if not 0 <= index < len(self.rows): return
+        self.see(index)
+        self.cells[index - self.top][col][0].focus_set()
+
+    def _move_focus(self, slot, col, step):
+        target = self.top + slot + step
+        if not 0 <= target < len(self.rows): return 'break'
+        self.see(target)
+        self.cells[target - self.top][col][0].focus_set()
+        return 'break'
+
 
 class ExperimentGenerator:
     def __init__(self, master):
@@ -14,52 +152,24 @@ class ExperimentGenerator:
         master.title("Psychological Experiment Generator")
         master.geometry("1200x600")
 
-        # Create main container with scrollbar
-        main_container = tk.Frame(master)
-        main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        
-        # Create canvas and scrollbar for scrolling
-        canvas = tk.Canvas(main_container)
-        scrollbar = tk.Scrollbar(main_container, orient="vertical", command=canvas.yview)
-        scrollable_frame = tk.Frame(canvas)
-        
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-        )
-        
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-        
-        # Pack canvas and scrollbar
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
-        
-        # Bind mousewheel to canvas
-        def _on_mousewheel(event):
-            canvas.yview_scroll(int(-1*(event.delta/120)), "units")
-        canvas.bind_all("<MouseWheel>", _on_mousewheel)
-
-        # --- Main Frames ---
-        self.main_frame = tk.Frame(scrollable_frame)
-        self.main_frame.pack(padx=10, pady=10)
-
-        # --- Header ---
-        self.headers = [
-            'Block', 'Block Repeats', 'Stimulus', 'Response', 'Latency',
-            'Correct Response', 'Feedback Text', 'Feedback Duration',
-            'Stimulus Color', 'Background Color'
-        ]
-        for i, header in enumerate(self.headers):
-            label = tk.Label(self.main_frame, text=header, font=('Arial', 12, 'bold'))
-            label.grid(row=0, column=i, padx=5, pady=5)
-
-        # --- Data Rows Container ---
-        self.trial_rows = []
+        # --- Trial Grid ---
+        # Only the rows in view get Entry widgets; the design itself is kept in
+        # the grid's backing table so large files stay responsive.
+        self.headers = HEADERS
+        widths = [5, 10, 40, 20, 10, 15, 20, 10, 15, 15, 30]
+        self.grid = VirtualTrialGrid(master, self.headers, widths)
+        self.grid.frame.pack(padx=10, pady=(10, 0))
         self.add_trial_row() # Start with one row
 
-        # --- Controls (moved inside scrollable area) ---
-        self.button_frame = tk.Frame(scrollable_frame)
+        # Validated rows and processed stimuli are reused between builds
+        self.build_cache = BuildCache()
+        self.preview = None  # Local preview server, started on the first run
+        # One block order per session, so rebuilding an unchanged design gives
+        # the same file; "Reshuffle" draws a new one
+        self.seed = new_seed()
+
+        # --- Controls ---
+        self.button_frame = tk.Frame(master)
         self.button_frame.pack(padx=10, pady=(10,10))
 
         self.add_button = tk.Button(self.button_frame, text="Add Trial Row", command=self.add_trial_row)
@@ -87,6 +197,9 @@ class ExperimentGenerator:
         self.repeat_entry = tk.Entry(self.button_frame, width=4, textvariable=self.repeat_var)
         self.repeat_entry.grid(row=0, column=7, padx=5)
 
+        self.reshuffle_button = tk.Button(self.button_frame, text="Reshuffle", command=self.reshuffle)
+        self.reshuffle_button.grid(row=0, column=8, padx=5)
+
         # Add server save checkbox
         self.save_to_server_var = tk.BooleanVar(value=False)
         self.save_to_server_check = tk.Checkbutton(
@@ -96,183 +209,245 @@ class ExperimentGenerator:
         )
         self.save_to_server_check.grid(row=1, column=0, columnspan=3, padx=5, sticky='w')
 
+        # Output format: full trial objects, compact templates + sequence, or
+        # runtime expansion in the browser
+        self.output_format_var = tk.StringVar(value="full")
+        tk.Label(self.button_frame, text="Output Format:").grid(row=1, column=3, padx=(15,5), sticky='e')
+        self.output_format_menu = tk.OptionMenu(self.button_frame, self.output_format_var, "full", "compact", "runtime")
+        self.output_format_menu.grid(row=1, column=4, padx=5, sticky='w')
+
+        # Images: ./images paths, hashed ./assets files or embedded in the HTML
+        self.asset_mode_var = tk.StringVar(value="relative")
+        tk.Label(self.button_frame, text="Images:").grid(row=1, column=5, padx=(15,5), sticky='e')
+        self.asset_mode_menu = tk.OptionMenu(self.button_frame, self.asset_mode_var, "relative", "hashed", "embed")
+        self.asset_mode_menu.grid(row=1, column=6, padx=5, sticky='w')
+
+        # Streaming: send results every 20 trials and resume after a reload
+        self.stream_results_var = tk.BooleanVar(value=False)
+        self.stream_results_check = tk.Checkbutton(
+            self.button_frame,
+            text="Stream Results During Experiment",
+            variable=self.stream_results_var
+        )
+        self.stream_results_check.grid(row=2, column=0, columnspan=3, padx=5, sticky='w')
+
+        # Results: full trial copies, or lean records with templates sent once
+        self.result_schema_var = tk.StringVar(value="full")
+        tk.Label(self.button_frame, text="Results:").grid(row=2, column=3, padx=(15,5), sticky='e')
+        self.result_schema_menu = tk.OptionMenu(self.button_frame, self.result_schema_var, "full", "lean", "columnar")
+        self.result_schema_menu.grid(row=2, column=4, padx=5, sticky='w')
+
+        # Progress of a CSV load; only shown while one is running
+        self.load_frame = tk.Frame(master)
+        self.load_label = tk.Label(self.load_frame, text="Loading...")
+        self.load_label.pack(side='left', padx=5)
+        self.load_progress = ttk.Progressbar(self.load_frame, length=300, maximum=1.0)
+        self.load_progress.pack(side='left', padx=5)
+        tk.Button(self.load_frame, text="Cancel", command=self.cancel_load).pack(side='left', padx=5)
+        self.load_state = None
+
+        # Progress of a build; only shown while one is running
+        self.build_frame = tk.Frame(master)
+        self.build_label = tk.Label(self.build_frame, text="Building...", width=22, anchor='w')
+        self.build_label.pack(side='left', padx=5)
+        self.build_progress = ttk.Progressbar(self.build_frame, length=300, maximum=1.0)
+        self.build_progress.pack(side='left', padx=5)
+        tk.Button(self.build_frame, text="Cancel", command=self.cancel_build).pack(side='left', padx=5)
+        self.build_state = None
+        self.build_thread = None
+
     def add_trial_row(self):
-        row_num = len(self.trial_rows) + 1
-        widgets = []
-        widths = [5, 10, 40, 20, 10, 15, 20, 10, 15, 15]
-        for col, w in enumerate(widths):
-            e = tk.Entry(self.main_frame, width=w)
-            e.grid(row=row_num, column=col, padx=5, pady=2)
-            widgets.append(e)
-        self.trial_rows.append(tuple(widgets))
+        self.grid.append_row()
 
     def upload_images(self):
         filepaths = filedialog.askopenfilenames(
-            title="Select image files",
-            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.gif;*.svg"), ("All Files", "*.*の声")]
+            title="Select image or audio files",
+            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.gif;*.svg"),
+                       ("Audio Files", "*.wav;*.mp3;*.ogg;*.m4a"), ("All Files", "*.*の声")]
         )
         if not filepaths: return
         images_dir = os.path.join(os.getcwd(), "images")
         os.makedirs(images_dir, exist_ok=True)
+        copied = 0
         for fp in filepaths:
+            dest = os.path.join(images_dir, os.path.basename(fp))
+            if os.path.isfile(dest) and filecmp.cmp(fp, dest, shallow=False):
+                continue  # Identical file already uploaded
             shutil.copy2(fp, images_dir)
-        messagebox.showinfo("Images Uploaded", f"Copied {len(filepaths)} image(s) to ./images")
+            copied += 1
+        unchanged = len(filepaths) - copied
+        messagebox.showinfo("Files Uploaded", f"Copied {copied} file(s) to ./images"
+                            + (f" ({unchanged} already up to date)" if unchanged else ""))
 
     def start_experiment(self):
-        trials_by_block = {}
-        block_repeats = {}  # Store repeat counts for each block (from first occurrence)
-        original_block_order = []  # Track the order blocks appear in the design
-        
-        for i, row_widgets in enumerate(self.trial_rows):
-            row_values = [w.get().strip() for w in row_widgets]
-            if not any(row_values): continue
-
-            (block, block_repeat, stimulus, response, latency, correct_response, feedback_text, 
-             feedback_duration, stimulus_color, background_color) = row_values
-
-            if not block:
-                messagebox.showwarning("Input Error", f"Row {i+1}: Block cannot be empty.")
-                return
-            try:
-                block_num = int(block)
-            except ValueError:
-                messagebox.showwarning("Input Error", f"Row {i+1}: Block must be an integer.")
-                return
-
-            # Track the original order blocks appear
-            if block_num not in original_block_order:
-                original_block_order.append(block_num)
-
-            # Handle Block Repeats - only use value from first occurrence of each block
-            if block_num not in block_repeats:
-                if block_repeat.strip():
-                    try:
-                        block_repeats[block_num] = int(block_repeat)
-                    except ValueError:
-                        messagebox.showwarning("Input Error", f"Row {i+1}: Block Repeats must be a number.")
-                        return
-                else:
-                    block_repeats[block_num] = 1  # Default to 1 if empty
-
-            if response.upper() == 'NA' and latency.upper() == 'NA':
-                messagebox.showwarning("Input Error", f"Row {i+1}: Response and Latency cannot both be NA.")
-                return
-
-            if latency.upper() != 'NA':
-                try:
-                    int(latency)
-                except ValueError:
-                    messagebox.showwarning("Input Error", f"Row {i+1}: Latency must be a number or NA.")
-                    return
-            
-            if correct_response and response.upper() != 'NA' and not response.strip().startswith('[text'):
-                response_options = [r.strip() for r in response.split(',')]
-                if correct_response not in response_options:
-                    messagebox.showwarning("Input Error", f"Row {i+1}: Correct Response must be one of the Response options.")
-                    return
-
-            if feedback_duration:
-                try:
-                    int(feedback_duration)
-                except ValueError:
-                    messagebox.showwarning("Input Error", f"Row {i+1}: Feedback Duration must be a number.")
-                    return
-
-            trials_by_block.setdefault(block_num, []).append({
-                'block': block_num,
-                'stimulus': stimulus,
-                'response': response,
-                'latency': latency,
-                'correct_response': correct_response,
-                'feedback_text': feedback_text,
-                'feedback_duration': feedback_duration,
-                'stimulus_color': stimulus_color or 'white',
-                'background_color': background_color or 'darkgrey'
-            })
-
-        if not trials_by_block:
-            messagebox.showinfo("No Trials", "Please define at least one trial.")
-            return
-            
-        image_regex = re.compile(r'\[image:([^()\]]+?)(?:\((.*?)\))?\]')
-        for block_trials in trials_by_block.values():
-            for t in block_trials:
-                for m in image_regex.finditer(t['stimulus']):
-                    fname = m.group(1).strip()
-                    if fname and not os.path.isfile(os.path.join(os.getcwd(), "images", fname)):
-                        messagebox.showerror("Missing Images", f"Image file not found in ./images: {fname}")
-                        return
-
+        if self.build_state is not None: return  # A build is already running
         try:
             repeat_count = int(self.repeat_var.get())
         except ValueError:
             messagebox.showwarning("Input Error", "Repeat Sequence must be a valid number.")
             return
+        # Tk variables are read here; the worker only sees this snapshot
+        options = {
+            'repeat_count': repeat_count,
+            'randomize': self.randomize_var.get(),
+            'save_to_server': self.save_to_server_var.get(),
+            'output_format': self.output_format_var.get(),
+            'asset_mode': self.asset_mode_var.get(),
+            'stream_results': 20 if self.stream_results_var.get() else 0,
+            'result_schema': self.result_schema_var.get(),
+            'seed': self.seed,
+        }
+        # Validation, expansion and rendering run on a worker thread, so the
+        # window stays responsive for large designs
+        messages = queue.Queue()
+        cancel = threading.Event()
+        self.build_state = {'messages': messages, 'cancel': cancel}
+        self.build_thread = threading.Thread(target=self._build, daemon=True,
+                                             args=(list(self.grid.rows), options, messages, cancel,
+                                                   self.build_thread))
+        self.build_thread.start()
+        self._show_build_progress(BUILD_STAGES[0], 0.0)
+        self.build_frame.pack(padx=10, pady=(0, 10))
+        self.start_button.config(state='disabled')
+        self.master.after(20, self._poll_build)
+
+    def reshuffle(self):
+        """Draw a new block order and rebuild with it."""
+        if self.build_state is not None: return  # Keep the seed of the running build
+        self.seed = new_seed()
+        self.start_experiment()
+
+    def _build(self, rows, options, messages, cancel, previous):
+        # Worker thread: no Tk calls here, only messages for _poll_build
+        if previous is not None:
+            previous.join()  # A cancelled build may still be using the cache
+        def stage(name, start=0.0, share=1.0):
+            def progress(fraction):
+                if cancel.is_set():
+                    raise BuildCancelled()
+                messages.put(('progress', (name, start + fraction * share)))
+            progress(0.0)
+            return progress
 
-        final_trials = []
-        
-        for rep in range(repeat_count):
-            # Create section groups for randomization (100s, 200s, etc.)
-            randomizable_sections = {}
-            
-            # First, organize trials into sections
-            for block_num in original_block_order:
-                if block_num >= 100:
-                    section_id = block_num // 100  # 101->1, 201->2, etc.
-                    if section_id not in randomizable_sections:
-                        randomizable_sections[section_id] = []
-                    randomizable_sections[section_id].append(block_num)
-            
-            # Determine section repeat counts (from first block in each section)
-            section_repeats = {}
-            for section_id, section_blocks in randomizable_sections.items():
-                first_block = min(section_blocks)
-                section_repeats[section_id] = block_repeats.get(first_block, 1)
-            
-            # Process the sequence following the original design order
-            for block_num in original_block_order:
-                if block_num < 100:
-                    # Fixed block - add with its individual repeats
-                    for block_rep in range(block_repeats[block_num]):
-                        for trial in trials_by_block[block_num]:
-                            trial_copy = trial.copy()
-                            trial_copy['repetition'] = rep + 1
-                            trial_copy['block_repetition'] = block_rep + 1
-                            final_trials.append(trial_copy)
-                else:
-                    # Randomizable section - check if this is the first block in its section
-                    section_id = block_num // 100
-                    section_blocks = randomizable_sections[section_id]
-                    
-                    if block_num == min(section_blocks):
-                        # This is the first block in the section - process the entire section
-                        section_repeat_count = section_repeats[section_id]
-                        
-                        for section_rep in range(section_repeat_count):
-                            # Collect all trials in this section
-                            section_trials = []
-                            for sect_block_num in section_blocks:
-                                for trial in trials_by_block[sect_block_num]:
-                                    trial_copy = trial.copy()
-                                    trial_copy['repetition'] = rep + 1
-                                    trial_copy['section_repetition'] = section_rep + 1
-                                    section_trials.append(trial_copy)
-                            
-                            # Randomize section if requested
-                            if self.randomize_var.get():
-                                random.shuffle(section_trials)
-                            
-                            # Add all section trials to final list
-                            final_trials.extend(section_trials)
-                    # If not the first block in section, skip (already processed)
-
-        self.compile_and_run(final_trials)
-
-    def compile_and_run(self, trials):
-        html_content = self.generate_html(trials)
-        with open("experiment.html", "w", encoding="utf-8") as f:
-            f.write(html_content)
-        webbrowser.open('file://' + os.path.realpath('experiment.html'))
+        images_dir = os.path.join(os.getcwd(), "images")
+        try:
+            # The cached parse and image check make unchanged rebuilds cheap;
+            # only a failing design is run through the full validator, so
+            # every problem is reported at once rather than one per attempt
+            try:
+                design = self.build_cache.parse_design(rows, stage('validate', 0.0, 0.5))
+                self.build_cache.check_images(design, images_dir)
+            except DesignError:
+                errors = validate_design(rows, images_dir, stage('validate', 0.5, 0.5))
+                if not errors:
+                    raise
+                messages.put(('errors', errors))
+                return
+            if not design.block_order:
+                messages.put(('info', ("No Trials", "Please define at least one trial.")))
+                return
+            stage('expand')
+            schedule = expand_trials(design, options['repeat_count'], options['randomize'], options['seed'])
+            progress = stage('render')
+            assets, stimulus_cache = self.build_cache.assets(images_dir, options['asset_mode'])
+            html_content = generate_html(schedule, options['save_to_server'],
+                                         output_format=options['output_format'], assets=assets,
+                                         stimulus_cache=stimulus_cache,
+                                         stream_results=options['stream_results'],
+                                         result_schema=options['result_schema'], progress=progress)
+            stage('write')
+            write_if_changed("experiment.html", html_content.encode("utf-8"))
+            assets.write(os.getcwd())
+            messages.put(('done', None))
+        except BuildCancelled:
+            pass
+        except DesignError as e:
+            messages.put(('warning', ("Input Error", str(e))))
+        except (AssetError, OSError) as e:
+            messages.put(('error', ("Image Error", str(e))))
+        except Exception as e:
+            # Always end with a message, or the window would wait for the build forever
+            messages.put(('error', ("Build Error", f"{type(e).__name__}: {e}")))
+
+    def _show_build_progress(self, stage, fraction):
+        index = BUILD_STAGES.index(stage)
+        self.build_label.config(text=f"{stage.capitalize()}... ({index + 1} of {len(BUILD_STAGES)})")
+        self.build_progress['value'] = (index + fraction) / len(BUILD_STAGES)
+
+    def _poll_build(self):
+        state = self.build_state
+        if state is None: return
+        latest = None
+        while True:
+            try:
+                kind, value = state['messages'].get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                latest = value  # Only the newest position is drawn
+                continue
+            self._end_build()
+            if kind == 'errors':
+                self.show_errors(value)
+            elif kind == 'info':
+                messagebox.showinfo(*value)
+            elif kind == 'warning':
+                messagebox.showwarning(*value)
+            elif kind == 'error':
+                messagebox.showerror(*value)
+            elif kind == 'done':
+                self.show_preview()
+            return
+        if latest is not None:
+            self._show_build_progress(*latest)
+        self.master.after(20, self._poll_build)
+
+    def cancel_build(self):
+        if self.build_state is None: return
+        # The worker stops at its next progress check; experiment.html is
+        # only written once rendering has finished
+        self.build_state['cancel'].set()
+        self._end_build()
+
+    def _end_build(self):
+        self.build_state = None
+        self.build_frame.pack_forget()
+        self.start_button.config(state='normal')
+
+    def show_errors(self, errors):
+        """List all design errors; double-clicking one jumps to its cell."""
+        window = tk.Toplevel(self.master)
+        window.title("Design Errors")
+        tk.Label(window, text=f"{len(errors)} problem(s) found. Double-click one to go to its cell.").pack(padx=10, pady=(10, 5), anchor='w')
+        frame = tk.Frame(window)
+        frame.pack(fill='both', expand=True, padx=10, pady=(0, 10))
+        scrollbar = tk.Scrollbar(frame, orient="vertical")
+        listbox = tk.Listbox(frame, width=90, height=min(len(errors), 20), yscrollcommand=scrollbar.set)
+        scrollbar.config(command=listbox.yview)
+        listbox.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+        listbox.insert('end', *[str(e) for e in errors])
+
+        def go_to_error(event):
+            selection = listbox.curselection()
+            if not selection: return
+            error = errors[selection[0]]
+            self.grid.focus_cell(error.row - 1, self.headers.index(error.column))
+        listbox.bind('<Double-Button-1>', go_to_error)
+
+    def show_preview(self):
+        # Served over HTTP rather than file:// so images load as they will when
+        # deployed and results can be saved; an open tab reloads after a rebuild
+        if self.preview is None:
+            try:
+                self.preview = start_preview(os.getcwd())
+            except OSError as e:
+                messagebox.showwarning("Preview Server", f"Could not start the preview server: {e}")
+                webbrowser.open('file://' + os.path.realpath('experiment.html'))
+                return
+        elif self.preview.reload():
+            return  # The open tab reloads itself
+        webbrowser.open(self.preview.url + '/experiment.html')
 
     def save_file(self):
         filepath = filedialog.asksaveasfilename(
@@ -283,361 +458,80 @@ class ExperimentGenerator:
         with open(filepath, "w", newline="", encoding="utf-8") as f:
             writer = csv.writer(f)
             writer.writerow(self.headers)
-            for row_widgets in self.trial_rows:
-                values = [w.get() for w in row_widgets]
+            for values in self.grid.rows:
                 if any(values):
                     writer.writerow(values)
 
     def load_file(self):
+        if self.load_state is not None: return  # A load is already running
         filepath = filedialog.askopenfilename(
-            filetypes=[("CSV Files", "*.csv"), ("All Files", "*.*の声")]
+            filetypes=[("CSV Files", "*.csv *.csv.gz"), ("All Files", "*.*の声")]
         )
         if not filepath: return
-        with open(filepath, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
+        # Rows are parsed on a worker thread and handed over in batches, so
+        # the window stays responsive for large files
+        messages = queue.Queue()
+        cancel = threading.Event()
+        self.load_state = {'messages': messages, 'cancel': cancel, 'previous': self.grid.rows, 'loaded': 0}
+        threading.Thread(target=self._read_design, args=(filepath, messages, cancel), daemon=True).start()
+        self.load_label.config(text=f"Loading {os.path.basename(filepath)}...")
+        self.load_progress['value'] = 0
+        self.load_frame.pack(padx=10, pady=(0, 10))
+        self.load_button.config(state='disabled')
+        self.master.after(20, self._poll_load)
+
+    def _read_design(self, filepath, messages, cancel):
+        # Worker thread: no Tk calls here, only messages for _poll_load
+        try:
+            batch = []
+            for row in iter_design(filepath, lambda fraction: messages.put(('progress', fraction))):
+                if cancel.is_set(): return
+                batch.append(row)
+                if len(batch) == 2000:
+                    messages.put(('rows', batch))
+                    batch = []
+            messages.put(('rows', batch))
+            messages.put(('done', None))
+        except (DesignError, OSError, EOFError, UnicodeDecodeError, csv.Error) as e:
+            messages.put(('error', str(e)))
+
+    def _poll_load(self):
+        state = self.load_state
+        if state is None: return
+        deadline = time.perf_counter() + 0.03  # Keep each slice short enough to stay responsive
+        while time.perf_counter() < deadline:
             try:
-                header = next(reader)
-                # Allow loading of files with or without the Block Repeats column for backward compatibility
-                if len(header) == len(self.headers) - 1:  # Old format without Block Repeats
-                    # Insert empty Block Repeats column for compatibility
-                    header.insert(1, 'Block Repeats')
-                elif [h.lower() for h in header] != [h.lower() for h in self.headers]:
-                    messagebox.showwarning("Load Failed", "CSV headers do not match expected format.")
-                    return
-            except StopIteration:
-                return # Empty file
-
-            for e in self.trial_rows:
-                for w in e: w.destroy()
-            self.trial_rows.clear()
-
-            for i, row_vals in enumerate(reader):
-                # Handle old format files that don't have Block Repeats column
-                if len(row_vals) == len(self.headers) - 1:
-                    row_vals.insert(1, '')  # Insert empty Block Repeats value
-                
-                self.add_trial_row()
-                for e, val in zip(self.trial_rows[i], row_vals):
-                    e.insert(0, val)
-
-    def generate_html(self, trials):
-        # Capture server save preference
-        save_to_server = self.save_to_server_var.get()
-
-        image_regex = re.compile(r'\[image:([^()\]]+?)(?:\((.*?)\))?\]')
-        preloaded_images = set()
-
-        def img_tag(filename, opts_str):
-            attrs, flags = {}, set()
-            position_y, position_x = 'center', 'center'
-            if opts_str:
-                for token in [t.strip() for t in opts_str.split(',') if t.strip()]:
-                    if '=' in token:
-                        k, v = token.split('=', 1)
-                        attrs[k.strip().lower()] = v.strip().strip("'")
-                    else:
-                        flags.add(token.lower())
-            for flag in flags:
-                if 'top' in flag: position_y = 'top'
-                if 'bottom' in flag: position_y = 'bottom'
-                if 'left' in flag: position_x = 'left'
-                if 'right' in flag: position_x = 'right'
-            
-            src = f"images/{filename}"
-            preloaded_images.add(src)
-            styles = ["max-width:90%", "max-height:90vh"]
-            if 'width' in attrs: styles.append(f"width:{int(attrs['width'])}px")
-            if 'height' in attrs: styles.append(f"height:{int(attrs['height'])}px")
-            
-            style_attr = f' style="{';'.join(styles)}"'
-            tag = f'<img src="{src}" alt="{filename}"{style_attr} />'
-            return tag, f"{position_y}-{position_x}"
-
-        def process_stim(raw):
-            final_pos = 'center-center'
-            def _repl(m):
-                nonlocal final_pos
-                fname, opts = m.group(1).strip(), (m.group(2) or '').strip()
-                tag, pos = img_tag(fname, opts)
-                final_pos = pos
-                return tag
-            processed_content = image_regex.sub(_repl, raw)
-            return processed_content, final_pos
-
-        js_trials = []
-        for i, t in enumerate(trials):
-            processed_stimulus, position = process_stim(t['stimulus'])
-            js_trials.append({
-                'block': t['block'],
-                'stimulus': processed_stimulus,
-                'response': t['response'],
-                'latency': int(t['latency']) if t['latency'].upper() != 'NA' else None,
-                'correctResponse': t['correct_response'] or None,
-                'feedbackText': t['feedback_text'] or None,
-                'feedbackDuration': int(t['feedback_duration']) if t['feedback_duration'] else None,
-                'stimulusColor': t['stimulus_color'],
-                'backgroundColor': t['background_color'],
-                'position': position,
-                'repetition': t.get('repetition', 1),
-                'blockRepetition': t.get('block_repetition', 1),
-                'trialIndex': i
-            })
-
-        trials_json = json.dumps(js_trials, indent=4)
-        preload_list_json = json.dumps(list(preloaded_images))
-
-        # Generate conditional downloadData function
-        if save_to_server:
-            download_function = f'''
-        function downloadData() {{
-            const experimentId = 'exp_' + Date.now().toString(36);
-            const data = {{
-                experimentId: experimentId,
-                timestamp: new Date().toISOString(),
-                browserInfo: navigator.userAgent,
-                randomized: {str(self.randomize_var.get()).lower()},
-                repetitions: {self.repeat_var.get()},
-                trials: trialResults
-            }};
-
-            // Send to server via PHP
-            fetch('/experiments/save_peg_results.php', {{
-                method: 'POST',
-                headers: {{
-                    'Content-Type': 'application/json'
-                }},
-                body: JSON.stringify(data)
-            }})
-            .then(response => {{
-                if (!response.ok) {{
-                    throw new Error('HTTP error! status: ' + response.status);
-                }}
-                return response.json();
-            }})
-            .then(result => {{
-                if (result.status === 'success') {{
-                    document.getElementById('container').innerHTML =
-                        "<h2>Experiment complete. Results sent to server!</h2>";
-                }} else {{
-                    throw new Error(result.message || 'Failed to save results');
-                }}
-            }})
-            .catch(error => {{
-                console.error('Save error:', error);
-                document.getElementById('container').innerHTML =
-                    "<h2>Experiment complete. Error saving to server: " + error.message + "</h2><p>Attempting local download...</p>";
-                // Fallback to local download
-                downloadDataLocally();
-            }});
-        }}
-
-        function downloadDataLocally() {{
-            const experimentId = 'exp_' + Date.now().toString(36);
-            const data = {{
-                experimentId: experimentId,
-                timestamp: new Date().toISOString(),
-                browserInfo: navigator.userAgent,
-                randomized: {str(self.randomize_var.get()).lower()},
-                repetitions: {self.repeat_var.get()},
-                trials: trialResults
-            }};
-            const jsonData = JSON.stringify(data, null, 2);
-            const blob = new Blob([jsonData], {{ type: 'application/json' }});
-            const url = URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = `experiment_data_${{experimentId}}.json`;
-            document.body.appendChild(a);
-            a.click();
-            document.body.removeChild(a);
-            URL.revokeObjectURL(url);
-        }}'''
-        else:
-            # Preserve existing local download functionality
-            download_function = f'''
-        function downloadData() {{
-            const experimentId = 'exp_' + Date.now().toString(36);
-            const data = {{
-                experimentId: experimentId,
-                timestamp: new Date().toISOString(),
-                browserInfo: navigator.userAgent,
-                randomized: {str(self.randomize_var.get()).lower()},
-                repetitions: {self.repeat_var.get()},
-                trials: trialResults
-            }};
-            const jsonData = JSON.stringify(data, null, 2);
-            const blob = new Blob([jsonData], {{ type: 'application/json' }});
-            const url = URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = `experiment_data_${{experimentId}}.json`;
-            document.body.appendChild(a);
-            a.click();
-            document.body.removeChild(a);
-            URL.revokeObjectURL(url);
-        }}'''
-
-        return f'''<!DOCTYPE html>
-<html>
-<head>
-    <title>Experiment</title>
-    <style>
-        body {{ background-color: darkgrey; color: white; font-family: Arial, sans-serif; height: 100vh; margin: 0; display: flex; justify-content: center; align-items: center; }}
-        #container {{ text-align: center; max-width: 90%; }}
-        #feedback {{ position: fixed; bottom: 20px; left: 50%; transform: translateX(-50%); padding: 8px 12px; background: rgba(0,0,0,0.6); border-radius: 6px; display: none; }}
-        input[type='text'] {{ font-size: 24px; padding: 8px; }}
-        button {{ font-size: 18px; padding: 8px 16px; margin-left: 8px; }}
-    </style>
-</head>
-<body>
-    <div id="container"></div>
-    <div id="feedback"></div>
-    <script>
-        const trials = {trials_json};
-        const preloadList = {preload_list_json};
-        const keyMap = {{ 'space': ' ', 'ctrl': 'control', 'alt': 'alt', 'lshift': 'shift', 'rshift': 'shift' }};
-        
-        let currentTrial = 0;
-        let startTime = 0;
-        let trialResults = [];
-        let rafTimer = null;
-
-        function preloadImages(srcs) {{
-            if (!srcs || srcs.length === 0) return Promise.resolve();
-            return Promise.all(srcs.map(src => new Promise(resolve => {{
-                const img = new Image();
-                img.onload = img.onerror = () => resolve();
-                img.src = src;
-            }})));
-        }}
-
-        function displayTrial(trial) {{
-            const container = document.getElementById('container');
-            document.body.style.backgroundColor = trial.backgroundColor;
-            container.style.color = trial.stimulusColor;
-
-            const [y_pos, x_pos] = trial.position.split('-');
-            document.body.style.alignItems = y_pos === 'top' ? 'flex-start' : y_pos === 'bottom' ? 'flex-end' : 'center';
-            document.body.style.justifyContent = x_pos === 'left' ? 'flex-start' : x_pos === 'right' ? 'flex-end' : 'center';
-            
-            container.innerHTML = trial.stimulus;
-            startTime = performance.now();
-
-            if (rafTimer) clearTimeout(rafTimer);
-            document.onkeydown = null;
-
-            const isText = trial.response.trim().startsWith('[text');
-            if (isText) {{
-                const input = document.createElement('input');
-                input.type = 'text';
-                const btn = document.createElement('button');
-                btn.textContent = 'Continue';
-                btn.onclick = () => handleResponse(input.value);
-                container.appendChild(document.createElement('br'));
-                container.appendChild(input);
-                container.appendChild(btn);
-                input.focus();
-            }} else if (trial.response.toUpperCase() !== 'NA') {{
-                document.onkeydown = (e) => {{
-                    const allowed = trial.response.split(',').map(k => {{
-                        const keyName = k.trim().toLowerCase();
-                        return keyMap[keyName] || keyName;
-                    }});
-                    if (allowed.includes(e.key.toLowerCase())) {{
-                        document.onkeydown = null; // Disable further key presses
-                        handleResponse(e.key);
-                    }}
-                }};
-            }}
-
-            if (trial.latency !== null) {{
-                rafTimer = setTimeout(() => {{
-                    document.onkeydown = null; // Disable key responses during auto-progression
-                    handleResponse(null);
-                }}, trial.latency);
-                // For trials with both response and latency, prioritize latency (automatic progression)
-                // This allows for automatic slideshow-style presentations
-                if (trial.response.toUpperCase() !== 'NA') {{
-                    // Brief delay before disabling keys to allow immediate response if needed
-                    setTimeout(() => {{
-                        if (rafTimer) {{ // Only disable if timer is still active
-                            document.onkeydown = null;
-                        }}
-                    }}, 50);
-                }}
-            }}
-        }}
-
-        function handleResponse(response) {{
-            if (rafTimer) clearTimeout(rafTimer);
-            const responseTime = performance.now() - startTime;
-            const trial = trials[currentTrial];
-            
-            const correctResponseMapped = trial.correctResponse ? (keyMap[trial.correctResponse.toLowerCase()] || trial.correctResponse) : null;
-            const isCorrect = correctResponseMapped ? (response && response.toLowerCase() === correctResponseMapped.toLowerCase()) : null;
-
-            trialResults.push(Object.assign(trial, {{
-                actualResponse: response,
-                responseTime: responseTime,
-                isCorrect: isCorrect,
-                timestamp: new Date().toISOString()
-            }}));
-
-            // Handle feedback based on markers: [correct], [incorrect], [all]
-            let showFeedback = false;
-            let feedbackMessage = '';
-            
-            if (trial.feedbackText) {{
-                const feedbackText = trial.feedbackText.trim();
-                
-                if (feedbackText.includes('[all]')) {{
-                    showFeedback = true;
-                    feedbackMessage = feedbackText.replace('[all]', '').trim();
-                }} else if (feedbackText.includes('[correct]') && isCorrect === true) {{
-                    showFeedback = true;
-                    feedbackMessage = feedbackText.replace('[correct]', '').trim();
-                }} else if (feedbackText.includes('[incorrect]') && isCorrect === false) {{
-                    showFeedback = true;
-                    feedbackMessage = feedbackText.replace('[incorrect]', '').trim();
-                }} else if (!feedbackText.includes('[correct]') && !feedbackText.includes('[incorrect]') && !feedbackText.includes('[all]')) {{
-                    // No markers - show feedback for any response
-                    showFeedback = true;
-                    feedbackMessage = feedbackText;
-                }}
-            }}
-
-            if (showFeedback && feedbackMessage) {{
-                const fb = document.getElementById('feedback');
-                fb.textContent = feedbackMessage;
-                fb.style.display = 'block';
-                setTimeout(() => {{
-                    fb.style.display = 'none';
-                    nextTrial();
-                }}, trial.feedbackDuration || 1000);
-            }} else {{
-                nextTrial();
-            }}
-        }}
-
-        function nextTrial() {{
-            currentTrial++;
-            if (currentTrial < trials.length) {{
-                displayTrial(trials[currentTrial]);
-            }} else {{
-                document.getElementById('container').innerHTML = "<h2>Experiment complete. Thank you!</h2>";
-                downloadData();
-            }}
-        }}
-
-{download_function}
-
-        preloadImages(preloadList).then(() => {{
-            if (trials.length > 0) displayTrial(trials[0]);
-        }});
-    </script>
-</body>
-</html>
-'''
+                kind, value = state['messages'].get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'rows' and value:
+                if not state['loaded']:
+                    self.grid.set_rows([])
+                self.grid.extend_rows(value)
+                state['loaded'] += len(value)
+                self.load_label.config(text=f"Loaded {state['loaded']} rows...")
+            elif kind == 'progress':
+                self.load_progress['value'] = value
+            elif kind == 'done':
+                self._end_load()  # An empty file leaves the current design in place
+                return
+            elif kind == 'error':
+                self.grid.set_rows(state['previous'])
+                self._end_load()
+                messagebox.showwarning("Load Failed", value)
+                return
+        self.master.after(20, self._poll_load)
+
+    def cancel_load(self):
+        if self.load_state is None: return
+        self.load_state['cancel'].set()
+        self.grid.set_rows(self.load_state['previous'])
+        self._end_load()
+
+    def _end_load(self):
+        self.load_state = None
+        self.load_frame.pack_forget()
+        self.load_button.config(state='normal')
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,270 @@
+"""Local preview server for built experiments.
+
+Serves the experiment over HTTP instead of ``file://``, so images load the
+same way they will when deployed, fetches are not throttled and the
+"Save to server" path works without a PHP host:
+
+    python peg.py preview design.csv --port 8000
+
+* the experiment HTML and the ``images/`` and ``assets/`` files are sent
+  gzip or brotli compressed (when the client accepts it and, for brotli, the
+  ``brotli`` package is installed). Each variant is compressed once per file
+  version and kept in memory;
+* every response has a strong ETag, and a request that sends it back in
+  ``If-None-Match`` gets an empty 304;
+* hashed ``assets/`` files never change under the same name and are cached
+  for a year; everything else is revalidated on each load;
+* results posted to ``/experiments/save_peg_results.php`` are stored as by
+  ``peg.py serve`` (see :mod:`peg_server`);
+* served HTML pages long-poll ``/__peg/reload`` and reload themselves when
+  :meth:`PreviewServer.reload` is called after a rebuild.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import mimetypes
+import posixpath
+import threading
+from urllib.parse import unquote
+
+from peg_server import RESULTS_PATH, HTTPError, IngestServer, ResultStore
+
+RELOAD_PATH = '/__peg/reload'
+RELOAD_TIMEOUT = 25  # seconds a reload poll is held open
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+MIN_COMPRESS = 1024  # bytes; smaller bodies are sent as they are
+
+# Appended to served pages; {version} is the build the page was served from.
+# The preview's streamed session is dropped so the reload starts afresh.
+RELOAD_JS = '''<script>
+(function poll(version) {{
+    fetch('{path}?version=' + version).then(response => response.json()).then(data => {{
+        if (data.version === version) return poll(version);
+        try {{ localStorage.removeItem('peg:' + location.pathname + location.search); }} catch (e) {{}}
+        location.reload();
+    }}, () => setTimeout(() => poll(version), 1000));
+}})({version});
+</script>
+'''
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def accepted_encodings(header):
+    """Content codings a client accepts, from its ``Accept-Encoding`` header."""
+    accepted = set()
+    for item in header.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip())
+    return accepted
+
+
+class PreviewServer(IngestServer):
+    """Serves an experiment directory, the results endpoint and reload polls.
+
+    ``root`` holds the experiment HTML (``index`` is served for ``/``) and
+    any hashed ``assets/``; ``/images/`` is served from ``images_dir``.
+    """
+
+    def __init__(self, root, store, images_dir=None, index='experiment.html'):
+        super().__init__(store)
+        self.root = os.path.realpath(root)
+        self.images_dir = os.path.realpath(images_dir or os.path.join(root, 'images'))
+        self.index = index
+        self.version = 0
+        self.loop = None
+        self.url = None
+        self._waiters = []
+        self._variants = {}  # path -> ((mtime_ns, size, version), {encoding: (body, etag)})
+        self.brotli = _brotli()
+
+    def reload(self):
+        """Tell open pages to reload; safe from any thread. Returns how many are listening."""
+        listening = len(self._waiters)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._bump)
+        return listening
+
+    def _bump(self):
+        self.version += 1
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_for_reload(self, version):
+        if version == self.version:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, RELOAD_TIMEOUT)
+            except asyncio.TimeoutError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return self.version
+
+    def resolve(self, url_path):
+        """The file a request path maps to and whether it is immutable; raises 404."""
+        path = posixpath.normpath(unquote(url_path))
+        if path == '/':
+            path = '/' + self.index
+        parts = path.lstrip('/').split('/')
+        if any(part.startswith('.') or part == '' for part in parts):
+            raise HTTPError(404, 'Not found.')
+        if parts[0] == 'images' and len(parts) > 1:
+            base, rest = self.images_dir, parts[1:]
+        elif parts[0] == 'assets' and len(parts) > 1:
+            base, rest = os.path.join(self.root, 'assets'), parts[1:]
+        elif len(parts) == 1 and parts[0].endswith('.html'):
+            base, rest = self.root, parts
+        else:
+            raise HTTPError(404, 'Not found.')
+        full = os.path.realpath(os.path.join(base, *rest))
+        if not full.startswith(base + os.sep) or not os.path.isfile(full):
+            raise HTTPError(404, 'Not found.')
+        return full, parts[0] == 'assets'
+
+    def _encode(self, path, content_type, encodings):
+        """Build every variant of ``path``: identity plus the compressions that pay off."""
+        with open(path, 'rb') as f:
+            body = f.read()
+        if content_type == 'text/html':
+            html = body.decode('utf-8', 'replace')
+            script = RELOAD_JS.format(path=RELOAD_PATH, version=self.version)
+            at = html.rfind('</body>')
+            body = (html[:at] + script + html[at:] if at >= 0 else html + script).encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        variants = {'identity': (body, f'"{digest}"')}
+        if len(body) >= MIN_COMPRESS and content_type.startswith(COMPRESSIBLE):
+            if 'gzip' in encodings:
+                variants['gzip'] = (gzip.compress(body, 9, mtime=0), f'"{digest}-gz"')
+            if 'br' in encodings:
+                variants['br'] = (self.brotli.compress(body, quality=11), f'"{digest}-br"')
+        return variants
+
+    async def static(self, request):
+        if request.method != 'GET':
+            raise HTTPError(405, 'Method not allowed.')
+        path, immutable = self.resolve(request.path)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size, self.version if content_type == 'text/html' else None)
+        cached = self._variants.get(path)
+        if cached is None or cached[0] != key:
+            encodings = ('gzip', 'br') if self.brotli else ('gzip',)
+            variants = await asyncio.get_running_loop().run_in_executor(
+                None, self._encode, path, content_type, encodings)
+            cached = self._variants[path] = (key, variants)
+        variants = cached[1]
+        accepted = accepted_encodings(request.headers.get('accept-encoding', ''))
+        encoding = next((e for e in ('br', 'gzip') if e in variants and e in accepted), 'identity')
+        body, etag = variants[encoding]
+        headers = {
+            'Content-Type': content_type + ('; charset=utf-8' if content_type.startswith('text/') else ''),
+            'ETag': etag,
+            'Cache-Control': IMMUTABLE if immutable else 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+            return 304, b'', headers
+        return 200, body, headers
+
+    async def route(self, request, peer):
+        if request.path == RESULTS_PATH:
+            return await super().route(request, peer)
+        if request.path == RELOAD_PATH:
+            try:
+                version = int(dict(p.partition('=')[::2] for p in request.query.split('&')).get('version', ''))
+            except ValueError:
+                raise HTTPError(400, 'version must be an integer.')
+            version = await self.wait_for_reload(version)
+            return 200, json.dumps({'version': version}).encode('utf-8'), \
+                {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}
+        return await self.static(request)
+
+
+async def serve_preview(app, host='127.0.0.1', port=8000, ready=None):
+    """Run ``app`` until cancelled."""
+    app.loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(app.handle, host, port)
+    app.url = f"http://{host}:{server.sockets[0].getsockname()[1]}"
+    if ready is not None:
+        ready(app.url)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await app.store.close()
+
+
+def start_preview(root, images_dir=None, host='127.0.0.1', port=0, results_dir='experiment_results'):
+    """Start a :class:`PreviewServer` on a daemon thread; returns it once it is listening."""
+    app = PreviewServer(root, ResultStore(results_dir), images_dir)
+    started = threading.Event()
+    failure = []
+
+    def run():
+        try:
+            asyncio.run(serve_preview(app, host, port, lambda url: started.set()))
+        except Exception as e:
+            failure.append(e)
+            started.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    if failure:
+        raise failure[0]
+    return app
+
+
+def fingerprint(paths):
+    """``{path: (mtime_ns, size)}`` for the files, and the files in the directories, given."""
+    state = {}
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                with os.scandir(path) as it:
+                    for entry in it:
+                        st = entry.stat()
+                        state[entry.path] = (st.st_mtime_ns, st.st_size)
+            else:
+                st = os.stat(path)
+                state[path] = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            pass
+    return state
+
+
+async def watch(app, rebuild, paths, interval=0.5):
+    """Call ``rebuild()`` in a worker thread whenever ``paths`` change, then reload open pages.
+
+    ``rebuild`` returns False to report a failed build; pages then keep the
+    previous version.
+    """
+    loop = asyncio.get_running_loop()
+    seen = fingerprint(paths)
+    while True:
+        await asyncio.sleep(interval)
+        current = fingerprint(paths)
+        if current == seen:
+            continue
+        seen = current
+        started = time.perf_counter()
+        if await loop.run_in_executor(None, rebuild) is not False:
+            print(f"Rebuilt in {time.perf_counter() - started:.2f}s; reloading {app.reload()} page(s)",
+                  file=sys.stderr, flush=True)
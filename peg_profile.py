@@ -0,0 +1,131 @@
+"""Build profiling: stage timings, counters and peak memory.
+
+A :class:`BuildProfile` passed to :func:`peg_build.build` (or
+:func:`peg_build.generate_html`) records how long each pipeline stage took,
+how much Python memory was allocated at its peak while it ran, and counters
+such as design rows, unique stimuli, expanded trials and output bytes:
+
+    python peg.py build design.csv --profile profile.json
+
+Stages are timed as they finish, so ``hook(kind, name, value)`` sees them
+live: ``('stage', name, {'seconds': ..., 'peak_memory_bytes': ...})`` after
+each stage and ``('count', name, total)`` after each counter update.
+:meth:`BuildProfile.report` returns the whole run as a JSON-ready dict.
+
+Stage names are dotted for stages that run inside another, e.g.
+``render.stimuli``; a parent's time includes its children's. Memory is
+traced with :mod:`tracemalloc`, which slows the build down; pass
+``memory=False`` for timings closer to an unprofiled build.
+"""
+import time
+import platform
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+class BuildProfile:
+    """Timings, counters and peak memory of one build."""
+
+    def __init__(self, hook=None, memory=True):
+        self.hook = hook
+        self.memory = memory
+        self.stages = []    # {'name', 'seconds', 'peak_memory_bytes'} in the order they started
+        self.counters = {}
+        self._open = []     # [stage record, peak of its finished children] innermost last
+        self._started = None
+        self._tracing = False
+        self.total = None
+
+    def start(self):
+        """Start the clock and, with ``memory``, tracemalloc; called by the first stage."""
+        if self._started is None:
+            self._started = time.perf_counter()
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+
+    def stop(self):
+        """Stop tracemalloc if this profile started it."""
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        if self._started is not None and self.total is None:
+            self.total = time.perf_counter() - self._started
+
+    @contextmanager
+    def stage(self, name):
+        """Time the ``with`` block as stage ``name``."""
+        self.start()
+        if self._open:
+            name = self._open[-1][0]['name'] + '.' + name
+        if self.memory:
+            if self._open:
+                # The parent's peak so far, before the child resets it
+                self._open[-1][1] = max(self._open[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        record = {'name': name, 'seconds': None, 'peak_memory_bytes': None}
+        self.stages.append(record)
+        self._open.append([record, 0])
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = round(time.perf_counter() - started, 6)
+            _, children_peak = self._open.pop()
+            if self.memory:
+                record['peak_memory_bytes'] = max(children_peak, tracemalloc.get_traced_memory()[1])
+                if self._open:
+                    self._open[-1][1] = max(self._open[-1][1], record['peak_memory_bytes'])
+                tracemalloc.reset_peak()
+            if self.hook is not None:
+                self.hook('stage', name, {'seconds': record['seconds'],
+                                          'peak_memory_bytes': record['peak_memory_bytes']})
+
+    def count(self, name, n=1):
+        """Add ``n`` to counter ``name``."""
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.hook is not None:
+            self.hook('count', name, self.counters[name])
+
+    def report(self, **info):
+        """The profile as a dict; ``info`` (e.g. the design path) is included as given."""
+        self.stop()
+        peaks = [s['peak_memory_bytes'] for s in self.stages if s['peak_memory_bytes'] is not None]
+        return dict(info,
+                    python=platform.python_version(),
+                    platform=platform.platform(),
+                    time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    total_seconds=round(self.total or 0.0, 6),
+                    peak_memory_bytes=max(peaks) if peaks else None,
+                    stages=self.stages,
+                    counters=self.counters)
+
+
+class _NoProfile:
+    """Stand-in used when no profile is given: stages and counters cost nothing."""
+
+    def stage(self, name):
+        return nullcontext()
+
+    def count(self, name, n=1):
+        pass
+
+    def stop(self):
+        pass
+
+
+NO_PROFILE = _NoProfile()
+
+
+def format_profile(report):
+    """Lines summarizing a :meth:`BuildProfile.report` for the terminal."""
+    total = report['total_seconds'] or 1
+    lines = [f"{'stage':<22} {'seconds':>9} {'share':>6} {'peak MB':>8}"]
+    for s in report['stages']:
+        indent = '  ' * s['name'].count('.')
+        peak = s['peak_memory_bytes']
+        lines.append(f"{indent + s['name'].rsplit('.', 1)[-1]:<22} {s['seconds']:>9.4f} "
+                     f"{s['seconds'] / total:>6.0%} {'' if peak is None else f'{peak / 2 ** 20:.1f}':>8}")
+    lines.append(f"{'total':<22} {report['total_seconds']:>9.4f}")
+    lines.append(', '.join(f"{name.replace('_', ' ')} {value}" for name, value in report['counters'].items()))
+    return lines
@@ -0,0 +1,89 @@
+"""Reading results documents and rehydrating lean result records.
+
+Experiments built with ``result_schema='lean'`` or ``'columnar'`` store only
+each trial's position, template ID and observed values, plus the template
+table once per document. :func:`rehydrate` turns such a document back into
+the full layout, where every record repeats the trial's stimulus, response
+options, colors and feedback; full documents pass through unchanged.
+
+Streamed uploads send the template table with the first batch only, so
+:func:`iter_documents` carries it over to later batches of the same
+experiment.
+"""
+import os
+import json
+
+# Fields the runtime adds to a template for each presentation, in order
+PRESENTATION_FIELDS = ('repetition', 'blockRepetition', 'trialIndex')
+
+
+def trial_rows(trials):
+    """Result records as a list of dicts, whether stored as rows or columns."""
+    if isinstance(trials, list):
+        return trials
+    fields = list(trials)
+    count = len(trials[fields[0]]) if fields else 0
+    return [{field: trials[field][i] for field in fields} for i in range(count)]
+
+
+def rehydrate_record(record, templates):
+    """The full-layout record for one lean record."""
+    template = templates[record['templateId']]
+    full = dict(template)
+    for field in PRESENTATION_FIELDS:
+        full[field] = record.get(field)
+    for field, value in record.items():
+        if field in PRESENTATION_FIELDS or field == 'templateId':
+            continue
+        if field == 'actualDuration':
+            full['intendedDuration'] = template.get('latency')
+        full[field] = value
+    return full
+
+
+def rehydrate(document, templates=None):
+    """Return ``document`` with full trial records.
+
+    ``templates`` stands in for a template table the document does not carry
+    itself (later batches of a streamed session).
+    """
+    schema = document.get('resultSchema', 'full')
+    if schema == 'full':
+        return document
+    templates = document.get('templates', templates)
+    if templates is None:
+        raise ValueError(f"{document.get('experimentId')}: lean results without a template table")
+    full = {k: v for k, v in document.items() if k not in ('resultSchema', 'templates')}
+    full['trials'] = [rehydrate_record(r, templates) for r in trial_rows(document['trials'])]
+    return full
+
+
+def load_results(path):
+    """Read a downloaded results file and return it rehydrated."""
+    with open(path, "r", encoding="utf-8") as f:
+        return rehydrate(json.load(f))
+
+
+def iter_documents(path):
+    """Yield rehydrated documents from a results file or a results directory.
+
+    A directory may hold downloaded or PHP-saved ``.json`` files and
+    ``peg serve`` shards.
+    """
+    if not os.path.isdir(path):
+        yield load_results(path)
+        return
+    from peg_server import iter_records
+
+    def records():
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.json'):
+                with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                    yield json.load(f)
+        yield from iter_records(path)
+
+    templates = {}  # experimentId -> template table from an earlier batch
+    for record in records():
+        if 'templates' in record:
+            templates[record['experimentId']] = record['templates']
+        yield rehydrate(record, templates.get(record['experimentId']))
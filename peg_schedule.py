@@ -0,0 +1,107 @@
+"""Seeded, lazy expansion of a design into its trial schedule.
+
+A :class:`Schedule` keeps every design row exactly once in an immutable trial
+table and describes the presentation order as arrays of indices into it.
+Iterating a schedule streams ``(table_index, repetition, block_repetition,
+section_repetition)`` tuples without materializing the expanded trial list,
+so memory is bounded by the largest section rather than the trial count.
+The same seed always yields the same order.
+
+Designs with a Condition column branch on responses, so their order is only
+known in the browser: iterating such a schedule yields the order when no
+condition applies, and :func:`peg_build.generate_html` ships the block graph
+(:attr:`Schedule.segments` and :attr:`Schedule.conditions`) instead.
+"""
+import random
+from array import array
+
+
+def new_seed():
+    """A fresh 32-bit seed for participants who were not given one."""
+    return random.SystemRandom().getrandbits(32)
+
+
+class Schedule:
+    """Trial order for one participant, expanded on demand."""
+
+    def __init__(self, design, repeat_count=1, randomize=True, seed=None):
+        self.repeat_count = repeat_count
+        self.randomize = randomize
+        self.seed = new_seed() if seed is None else seed
+        self.seeded = seed is not None  # False when the seed was drawn here
+
+        # Immutable trial table: each design row once, grouped by block
+        table = []
+        block_rows = {}
+        for block_num in design.block_order:
+            start = len(table)
+            table.extend(design.trials_by_block[block_num])
+            block_rows[block_num] = range(start, len(table))
+        self.table = tuple(table)
+        typecode = 'H' if len(table) <= 0xFFFF else 'I'
+
+        # Create section groups for randomization (100s, 200s, etc.)
+        sections = {}
+        for block_num in design.block_order:
+            if block_num >= 100:
+                sections.setdefault(block_num // 100, []).append(block_num)
+
+        # Segments in presentation order: (table indices, repeats, is_section).
+        # Fixed blocks repeat on their own; a randomizable section appears at
+        # its lowest block number and repeats as a whole, and takes its
+        # Condition from that block too.
+        self.segments = []
+        self.segment_blocks = []  # block numbers presented by each segment
+        self.conditions = []      # Condition rules of each segment
+        for block_num in design.block_order:
+            if block_num < 100:
+                self.segments.append((array(typecode, block_rows[block_num]),
+                                      design.block_repeats[block_num], False))
+                self.segment_blocks.append((block_num,))
+            else:
+                section_blocks = sections[block_num // 100]
+                if block_num != min(section_blocks):
+                    continue
+                indices = array(typecode)
+                for sect_block_num in section_blocks:
+                    indices.extend(block_rows[sect_block_num])
+                self.segments.append((indices, design.block_repeats.get(block_num, 1), True))
+                self.segment_blocks.append(tuple(section_blocks))
+            self.conditions.append(design.block_conditions.get(block_num, ()))
+        self.conditional = any(self.conditions)
+
+    def __len__(self):
+        return self.repeat_count * sum(len(indices) * repeats for indices, repeats, _ in self.segments)
+
+    def __iter__(self):
+        # A fresh generator per iteration keeps repeated passes identical
+        rng = random.Random(self.seed)
+        for rep in range(1, self.repeat_count + 1):
+            for indices, repeats, is_section in self.segments:
+                for seg_rep in range(1, repeats + 1):
+                    if not is_section:
+                        for i in indices:
+                            yield i, rep, seg_rep, 1
+                        continue
+                    order = indices
+                    if self.randomize:
+                        order = array(indices.typecode, indices)
+                        rng.shuffle(order)
+                    for i in order:
+                        yield i, rep, 1, seg_rep
+
+    def index_array(self):
+        """All table indices in presentation order as a compact array."""
+        indices = array('H' if len(self.table) <= 0xFFFF else 'I')
+        indices.extend(i for i, _, _, _ in self)
+        return indices
+
+    def runs(self):
+        """Repetition metadata as ``(repetition, block_repetition, section_repetition, length)`` runs."""
+        for rep in range(1, self.repeat_count + 1):
+            for indices, repeats, is_section in self.segments:
+                for seg_rep in range(1, repeats + 1):
+                    if is_section:
+                        yield rep, 1, seg_rep, len(indices)
+                    else:
+                        yield rep, seg_rep, 1, len(indices)
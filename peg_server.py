@@ -0,0 +1,421 @@
+"""Asyncio results ingestion server.
+
+A drop-in replacement for ``save_peg_results.php``: experiments built with
+"Save to server" post their results to ``/experiments/save_peg_results.php``
+and get the same JSON responses back. Instead of one pretty-printed file per
+submission, results are appended as one JSON line each to a fixed set of
+shard files. Submissions arriving together are written and fsynced as a
+single batch per shard, and a response is only sent once its record is on
+disk.
+
+    python peg.py serve --port 8000 --results-dir experiment_results
+
+Request bodies may be gzip or deflate compressed (``Content-Encoding``).
+Run it behind the web server that hosts the experiments, proxying the
+endpoint path to it.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import asyncio
+import secrets
+import platform
+from datetime import datetime
+
+from peg_results import trial_rows
+
+RESULTS_PATH = '/experiments/save_peg_results.php'
+MAX_BODY = 64 * 1024 * 1024
+MAX_TRIAL_INDEX = 1 << 24  # larger trial indices are stored without deduplication
+
+experiment_id_regex = re.compile(r'exp_[a-zA-Z0-9]+')
+
+REASONS = {
+    200: 'OK', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+    500: 'Internal Server Error'
+}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Content-Encoding'
+}
+
+
+class HTTPError(Exception):
+    """Aborts a request with ``status`` and a JSON error ``message``."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path, _, self.query = path.partition('?')
+        self.version = version
+        self.headers = headers  # lower-cased names
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+async def read_request(reader, writer, max_body=MAX_BODY):
+    """Read one HTTP/1.x request; returns None when the client closed the connection."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, path, version = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'Malformed request line.')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('expect', '').lower() == '100-continue':
+        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks, size = [], 0
+        while True:
+            chunk_size = int((await reader.readline()).split(b';')[0], 16)
+            if chunk_size == 0:
+                await reader.readline()
+                break
+            size += chunk_size
+            if size > max_body:
+                raise HTTPError(413, 'Request body too large.')
+            chunks.append(await reader.readexactly(chunk_size))
+            await reader.readline()
+        body = b''.join(chunks)
+    else:
+        length = int(headers.get('content-length') or 0)
+        if length > max_body:
+            raise HTTPError(413, 'Request body too large.')
+        body = await reader.readexactly(length) if length else b''
+    return Request(method.upper(), path, version, headers, body)
+
+
+def decode_body(request, max_body=MAX_BODY):
+    """The request body with any gzip/deflate ``Content-Encoding`` removed."""
+    encoding = request.headers.get('content-encoding', 'identity').lower()
+    if encoding in ('', 'identity'):
+        return request.body
+    if encoding not in ('gzip', 'deflate'):
+        raise HTTPError(400, f'Unsupported Content-Encoding: {encoding}')
+    # Bounded decompression so a small body cannot expand without limit
+    decompressor = zlib.decompressobj(31 if encoding == 'gzip' else 15)
+    try:
+        body = decompressor.decompress(request.body, max_body + 1)
+    except zlib.error:
+        raise HTTPError(400, 'Request body is not valid compressed data.')
+    if len(body) > max_body:
+        raise HTTPError(413, 'Request body too large.')
+    return body
+
+
+def write_response(writer, status, body=b'', headers=None, keep_alive=True):
+    """Queue a complete HTTP/1.1 response on ``writer``."""
+    lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+    for name, value in (headers or {}).items():
+        lines.append(f'{name}: {value}')
+    lines.append(f'Content-Length: {len(body)}')
+    lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def json_body(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def record_line(body, data, extra):
+    """The stored JSON line: the submitted object ``data`` with ``extra`` keys added.
+
+    The client's UTF-8 ``body`` is reused rather than re-encoding the parsed
+    document; pass None when ``data`` was changed after parsing. Raw line
+    breaks in valid JSON can only be whitespace, so they are flattened to
+    spaces.
+    """
+    body = body.strip() if body is not None else b''
+    if body[:1] != b'{':  # Modified document, byte order mark or UTF-16: re-encode instead
+        return json.dumps(dict(data, **extra), ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+    body = body.replace(b'\r', b' ').replace(b'\n', b' ')
+    return body[:-1].rstrip() + b',' + json.dumps(extra, ensure_ascii=False, separators=(',', ':'))[1:].encode('utf-8') + b'\n'
+
+
+def validate_results(data):
+    """Apply the checks of save_peg_results.php; raises :class:`HTTPError`."""
+    for field in ('experimentId', 'timestamp', 'trials'):
+        if not isinstance(data, dict) or data.get(field) is None:
+            raise HTTPError(400, f'Missing required field: {field}')
+    if not isinstance(data['experimentId'], str) or not experiment_id_regex.fullmatch(data['experimentId']):
+        raise HTTPError(400, 'Invalid experiment ID format.')
+    # PHP arrays include JSON objects, which carry columnar results
+    if not isinstance(data['trials'], (list, dict)):
+        raise HTTPError(400, 'Trials data must be an array.')
+
+
+class ResultStore:
+    """Append-only results store sharded over ``shards`` JSON-lines files.
+
+    Each shard has one writer task. Records queued while a write is in
+    progress go out together in the next write and share its fsync, so the
+    number of fsyncs grows with time rather than with submissions.
+    """
+
+    def __init__(self, root, shards=16, batch_size=512):
+        self.root = root
+        self.shards = shards
+        self.batch_size = batch_size
+        self.instance = secrets.token_hex(3)  # keeps IDs unique across restarts
+        self._seq = 0
+        self._queues = None
+        self._tasks = []
+        self._files = {}
+        self._stored = {}  # experimentId -> bitmap of stored trialIndex values (streamed uploads)
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        # Rebuild the deduplication index from streamed records already on disk
+        for name in sorted(os.listdir(self.root)):
+            if not (name.startswith('shard-') and name.endswith('.jsonl')):
+                continue
+            with open(os.path.join(self.root, name), 'rb') as f:
+                for line in f:
+                    if b'"streamed"' not in line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from a crash
+                    if record.get('streamed') is True:
+                        self.claim(record['experimentId'], record['trials'])
+
+    def claim(self, experiment_id, trials):
+        """Mark trials as stored and return those that were not stored before.
+
+        Trials are identified by ``trialIndex``; trials without one are
+        always new.
+        """
+        stored = self._stored.setdefault(experiment_id, bytearray())
+        fresh = []
+        for trial in trials:
+            index = trial.get('trialIndex') if isinstance(trial, dict) else None
+            if type(index) is not int or not 0 <= index < MAX_TRIAL_INDEX:
+                fresh.append(trial)
+                continue
+            byte, bit = divmod(index, 8)
+            if byte >= len(stored):
+                stored.extend(bytes(byte + 1 - len(stored)))
+            if not stored[byte] >> bit & 1:
+                stored[byte] |= 1 << bit
+                fresh.append(trial)
+        return fresh
+
+    def release(self, experiment_id, trials):
+        """Undo :meth:`claim` for trials that could not be written."""
+        stored = self._stored.get(experiment_id, bytearray())
+        for trial in trials:
+            index = trial.get('trialIndex') if isinstance(trial, dict) else None
+            if type(index) is int and 0 <= index < len(stored) * 8:
+                stored[index // 8] &= ~(1 << index % 8) & 0xFF
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, f"shard-{shard:02d}.jsonl")
+
+    def shard_for(self, experiment_id):
+        return zlib.crc32(experiment_id.encode('utf-8')) % self.shards
+
+    def new_id(self, experiment_id):
+        # The event loop is single threaded, so the counter needs no lock
+        self._seq += 1
+        return f"{time.strftime('%Y%m%d_%H%M%S')}_{experiment_id}_{self.instance}{self._seq:x}"
+
+    async def append(self, line, shard):
+        """Queue a JSON line for ``shard`` and wait until it has been fsynced."""
+        if self._queues is None:
+            self._queues = [asyncio.Queue() for _ in range(self.shards)]
+            self._tasks = [asyncio.create_task(self._writer(n)) for n in range(self.shards)]
+        done = asyncio.get_running_loop().create_future()
+        await self._queues[shard].put((line, done))
+        await done
+
+    def _write(self, shard, data):
+        f = self._files.get(shard)
+        if f is None:
+            f = self._files[shard] = open(self.shard_path(shard), 'ab+')
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')  # Terminate a line torn by a crash
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    async def _writer(self, shard):
+        queue = self._queues[shard]
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await queue.get()]
+            while len(items) < self.batch_size and not queue.empty():
+                items.append(queue.get_nowait())
+            try:
+                await loop.run_in_executor(None, self._write, shard, b''.join(line for line, _ in items))
+            except OSError as e:
+                for _, done in items:
+                    if not done.done(): done.set_exception(e)
+            else:
+                for _, done in items:
+                    if not done.done(): done.set_result(None)
+            for _ in items:
+                queue.task_done()
+
+    async def close(self):
+        if self._queues is not None:
+            for queue in self._queues:
+                await queue.join()
+            for task in self._tasks:
+                task.cancel()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def iter_records(results_dir):
+    """Yield every stored submission, shard by shard."""
+    for name in sorted(os.listdir(results_dir)):
+        if name.startswith('shard-') and name.endswith('.jsonl'):
+            with open(os.path.join(results_dir, name), 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # Line torn by a crash
+                        yield record
+
+
+class IngestServer:
+    """Serves the results endpoint on top of a :class:`ResultStore`."""
+
+    def __init__(self, store, max_body=MAX_BODY):
+        self.store = store
+        self.max_body = max_body
+        self.server_info = {'python_version': platform.python_version(), 'server_software': 'peg_server'}
+
+    async def save_results(self, request, peer):
+        """Validate and store a submission; returns the JSON response dict."""
+        if request.method != 'POST':
+            raise HTTPError(405, 'Method not allowed. Only POST requests are accepted.')
+        body = decode_body(request, self.max_body)
+        if not body:
+            raise HTTPError(400, 'No data received.')
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise HTTPError(400, f'Invalid JSON data: {e}')
+        validate_results(data)
+
+        experiment_id = data['experimentId']
+        trials_count = len(trial_rows(data['trials']))
+        duplicates = 0
+        claimed = None
+        if data.get('streamed') is True and isinstance(data['trials'], list):
+            # Streamed batches may be resent after a lost response: keep only new trials
+            claimed = self.store.claim(experiment_id, data['trials'])
+            duplicates = trials_count - len(claimed)
+            if duplicates:
+                if not claimed:
+                    return {
+                        'status': 'success',
+                        'message': 'Experiment data already saved.',
+                        'timestamp': datetime.now().astimezone().isoformat(timespec='seconds'),
+                        'trials_count': 0,
+                        'duplicates': duplicates
+                    }
+                data['trials'] = claimed
+                body = None
+        record_id = self.store.new_id(experiment_id)
+        shard = self.store.shard_for(experiment_id)
+        extra = {
+            'recordId': record_id,
+            'serverTimestamp': datetime.now().astimezone().isoformat(timespec='seconds'),
+            'serverInfo': dict(self.server_info, remote_addr=peer)
+        }
+        try:
+            await self.store.append(record_line(body, data, extra), shard)
+        except OSError:
+            if claimed:
+                self.store.release(experiment_id, claimed)
+            raise HTTPError(500, 'Failed to save data to file.')
+        return {
+            'status': 'success',
+            'message': 'Experiment data saved successfully.',
+            'filename': os.path.basename(self.store.shard_path(shard)),
+            'id': record_id,
+            'timestamp': extra['serverTimestamp'],
+            'trials_count': trials_count - duplicates,
+            'duplicates': duplicates
+        }
+
+    async def route(self, request, peer):
+        """Returns ``(status, body, headers)``; override to serve more paths."""
+        if request.path != RESULTS_PATH:
+            raise HTTPError(404, 'Not found.')
+        if request.method == 'OPTIONS':
+            return 200, b'', dict(CORS_HEADERS)
+        result = await self.save_results(request, peer)
+        return 200, json_body(result), dict(CORS_HEADERS, **{'Content-Type': 'application/json'})
+
+    async def handle(self, reader, writer):
+        peer = (writer.get_extra_info('peername') or ('Unknown',))[0]
+        try:
+            while True:
+                request = None
+                try:
+                    request = await read_request(reader, writer, self.max_body)
+                    if request is None:
+                        break
+                    status, body, headers = await self.route(request, peer)
+                except HTTPError as e:
+                    status, body = e.status, json_body({'status': 'error', 'message': e.message})
+                    headers = dict(CORS_HEADERS, **{'Content-Type': 'application/json'})
+                # A request that failed while being read leaves the stream out of sync
+                keep_alive = request is not None and request.keep_alive
+                write_response(writer, status, body, headers, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client went away or sent garbage framing
+        finally:
+            writer.close()
+
+
+async def serve(host='127.0.0.1', port=8000, results_dir='experiment_results', shards=16, ready=None):
+    """Run the ingestion server until cancelled."""
+    store = ResultStore(results_dir, shards)
+    app = IngestServer(store)
+    server = await asyncio.start_server(app.handle, host, port, backlog=1024)
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1])
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await store.close()
@@ -0,0 +1,122 @@
+"""Stimulus markup compiler.
+
+A Stimulus cell is text with ``[image:file.png(width=200, top, left)]`` and
+``[audio:tone.wav(volume=0.5, delay=100)]`` references. :func:`parse_stimulus`
+turns it into a :class:`Stimulus`: a tuple of parts, each a text run (a plain
+string), an :class:`Image` or an :class:`Audio` with its options already
+parsed, plus the screen position. Parsing is memoized on
+the raw string, so each unique stimulus is parsed once however often it is
+presented. :func:`render_stimulus` emits the HTML from it; sounds are not
+part of the HTML but are played by the runtime (see :func:`stimulus_audio`).
+
+Malformed options raise :class:`StimulusError`, which the design parser and
+validator report with the row number.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+image_regex = re.compile(r'\[image:([^()\]]+?)(?:\((.*?)\))?\]')
+media_regex = re.compile(r'\[(image|audio):([^()\]]+?)(?:\((.*?)\))?\]')
+
+# ``width`` and ``height`` in CSS pixels, or None
+Image = namedtuple('Image', 'filename width height')
+# ``volume`` is a gain (1 is unchanged), ``delay`` ms after the stimulus onset
+Audio = namedtuple('Audio', 'filename volume delay')
+# ``parts`` are text runs and Images; ``position`` is '<top|center|bottom>-<left|center|right>'
+Stimulus = namedtuple('Stimulus', 'parts position')
+
+
+class StimulusError(ValueError):
+    """A Stimulus cell that cannot be compiled, e.g. a non-integer image width."""
+
+
+def _option(attrs, name, filename, kind, convert=int, default=None):
+    if name not in attrs:
+        return default
+    try:
+        return convert(attrs[name])
+    except ValueError:
+        what = "an integer" if convert is int else "a number"
+        raise StimulusError(f"{kind} {name} must be {what} ({filename}: {name}={attrs[name]}).")
+
+
+def _split_options(opts_str):
+    attrs, flags = {}, set()
+    if opts_str:
+        for token in [t.strip() for t in opts_str.split(',') if t.strip()]:
+            if '=' in token:
+                k, v = token.split('=', 1)
+                attrs[k.strip().lower()] = v.strip().strip("'")
+            else:
+                flags.add(token.lower())
+    return attrs, flags
+
+
+def parse_image_options(filename, opts_str):
+    """Parse an image's option string into ``(Image, position)``."""
+    attrs, flags = _split_options(opts_str)
+    position_y, position_x = 'center', 'center'
+    for flag in flags:
+        if 'top' in flag: position_y = 'top'
+        if 'bottom' in flag: position_y = 'bottom'
+        if 'left' in flag: position_x = 'left'
+        if 'right' in flag: position_x = 'right'
+    image = Image(filename, _option(attrs, 'width', filename, "Image"), _option(attrs, 'height', filename, "Image"))
+    return image, f"{position_y}-{position_x}"
+
+
+def parse_audio_options(filename, opts_str):
+    """Parse a sound's option string into an :class:`Audio`."""
+    attrs, _ = _split_options(opts_str)
+    volume = _option(attrs, 'volume', filename, "Audio", float, 1.0)
+    delay = _option(attrs, 'delay', filename, "Audio", int, 0)
+    if volume < 0:
+        raise StimulusError(f"Audio volume cannot be negative ({filename}: volume={attrs['volume']}).")
+    if delay < 0:
+        raise StimulusError(f"Audio delay cannot be negative ({filename}: delay={attrs['delay']}).")
+    return Audio(filename, volume, delay)
+
+
+@lru_cache(maxsize=4096)
+def parse_stimulus(raw):
+    """Compile a Stimulus cell into a :class:`Stimulus`; the last image sets the position."""
+    parts, position, end = [], 'center-center', 0
+    for m in media_regex.finditer(raw):
+        if m.start() > end:
+            parts.append(raw[end:m.start()])
+        filename, opts = m.group(2).strip(), (m.group(3) or '').strip()
+        if m.group(1) == 'audio':
+            parts.append(parse_audio_options(filename, opts))
+        else:
+            image, position = parse_image_options(filename, opts)
+            parts.append(image)
+        end = m.end()
+    if end < len(raw):
+        parts.append(raw[end:])
+    return Stimulus(tuple(parts), position)
+
+
+def image_html(image, assets):
+    src_attr, src = assets.resolve(image.filename, image.width, image.height)
+    styles = ["max-width:90%", "max-height:90vh"]
+    if image.width is not None: styles.append(f"width:{image.width}px")
+    if image.height is not None: styles.append(f"height:{image.height}px")
+    return f'<img {src_attr}="{src}" alt="{image.filename}" style="{";".join(styles)}" />'
+
+
+def render_stimulus(stimulus, assets):
+    """The stimulus HTML, with images resolved through ``assets``."""
+    return ''.join(part if isinstance(part, str) else image_html(part, assets)
+                   for part in stimulus.parts if not isinstance(part, Audio))
+
+
+def stimulus_audio(stimulus):
+    """The sounds a stimulus plays, in order."""
+    return [part for part in stimulus.parts if isinstance(part, Audio)]
+
+
+def media_files(stimulus):
+    """``(kind, filename)`` for every image and sound a stimulus references."""
+    return [('Audio' if isinstance(part, Audio) else 'Image', part.filename)
+            for part in stimulus.parts if not isinstance(part, str)]
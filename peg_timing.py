@@ -0,0 +1,102 @@
+"""Timing-quality report over collected results.
+
+Every results document carries a ``timing`` summary measured in the
+participant's browser. It includes the refresh rate, how late stimulus onsets
+were (onset jitter), how far timed trials overran their latency (overshoot),
+dropped frames, time spent in a hidden tab and event-loop stalls. This module
+collects these per session and flags sessions that miss the thresholds:
+
+    python peg.py timing experiment_results --threshold max_onset_jitter_p95=4
+
+Files saved before the summary existed are judged on what their trial
+records show (dropped frames and overshoot).
+"""
+from peg_results import iter_documents
+
+# name -> limit; min_* flag values below the limit, max_* values above it
+DEFAULT_THRESHOLDS = {
+    'min_refresh_rate': 50.0,           # Hz
+    'max_onset_jitter_p95': 8.0,        # ms, about half a frame at 60 Hz
+    'max_overshoot_p95': 20.0,          # ms
+    'max_dropped_frame_trials': 0.1,    # share of trials with dropped frames
+    'max_hidden_trials': 0,             # trials that ended in a hidden tab
+    'max_stalls': 10,                   # frames later than 50 ms while visible
+    'max_long_tasks': 20,
+}
+
+
+def _p95(values):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * 0.95))], 2) if values else None
+
+
+def session_metrics(documents):
+    """Timing metrics for one session from its documents (several for streamed sessions)."""
+    trials = [t for d in documents for t in d.get('trials') or []]
+    # Summaries are cumulative per page load: use the one covering the most trials
+    timing = max((d['timing'] for d in documents if d.get('timing')), key=lambda t: t.get('trials') or 0,
+                 default=None)
+    overshoot = [t['actualDuration'] - t['intendedDuration'] for t in trials
+                 if t.get('actualResponse') is None and t.get('intendedDuration') is not None
+                 and t.get('actualDuration') is not None]
+    dropped = sum(1 for t in trials if t.get('droppedFrames'))
+    metrics = {
+        'trials': len(trials),
+        'refresh_rate': None,
+        'onset_jitter_p95': _p95([t['onsetJitter'] for t in trials if t.get('onsetJitter') is not None]),
+        'overshoot_p95': _p95(overshoot),
+        'dropped_frame_trials': round(dropped / len(trials), 4) if trials else None,
+        'hidden_trials': None,
+        'hidden_ms': None,
+        'stalls': None,
+        'long_tasks': None,
+    }
+    if timing:
+        metrics.update(
+            refresh_rate=timing.get('refreshRate'),
+            hidden_trials=timing.get('hiddenTrials'),
+            hidden_ms=timing.get('hiddenMs'),
+            stalls=timing.get('stalls'),
+            long_tasks=(timing.get('longTasks') or {}).get('count'))
+    return metrics
+
+
+def check_session(metrics, thresholds):
+    """Messages for every threshold ``metrics`` misses; metrics that were not measured pass."""
+    flags = []
+    for name, limit in thresholds.items():
+        bound, metric = name.split('_', 1)
+        value = metrics.get(metric)
+        if value is None:
+            continue
+        if (bound == 'min' and value < limit) or (bound == 'max' and value > limit):
+            flags.append(f"{metric.replace('_', ' ')} {value:g} {'<' if bound == 'min' else '>'} {limit:g}")
+    return flags
+
+
+def timing_report(path, thresholds=None):
+    """Per-session timing metrics and flags for a results file or directory.
+
+    Returns a list of dicts with ``experimentId``, ``participant``,
+    ``metrics`` and ``flags`` (empty when the session passes), ordered by
+    experimentId.
+    """
+    limits = dict(DEFAULT_THRESHOLDS)
+    for name, value in (thresholds or {}).items():
+        if name not in DEFAULT_THRESHOLDS:
+            raise ValueError(f"Unknown threshold: {name}")
+        limits[name] = value
+    sessions = {}
+    for document in iter_documents(path):
+        sessions.setdefault(document.get('experimentId'), []).append(document)
+    report = []
+    for experiment_id in sorted(sessions, key=str):
+        documents = sessions[experiment_id]
+        metrics = session_metrics(documents)
+        report.append({
+            'experimentId': experiment_id,
+            'participant': documents[0].get('participant'),
+            'metrics': metrics,
+            'flags': check_session(metrics, limits)
+        })
+    return report
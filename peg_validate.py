@@ -0,0 +1,147 @@
+"""Whole-design validation with a complete error report.
+
+:func:`peg_build.parse_design` stops at the first problem. This module checks
+every row and column in one pass and returns all problems with their
+coordinates, so a large imported design can be fixed in one go.
+
+Checks run column by column over the distinct values of each column, which
+in real designs are few, so even very large designs validate quickly.
+"""
+import os
+from collections import namedtuple
+
+from peg_build import HEADERS
+from peg_condition import ConditionError, check_placement, check_repeats, check_targets, parse_condition
+from peg_stimulus import StimulusError, media_files, parse_stimulus
+
+BLOCK, BLOCK_REPEATS, STIMULUS, RESPONSE, LATENCY, CORRECT_RESPONSE, _, FEEDBACK_DURATION = range(8)
+CONDITION = 10
+
+
+class ValidationError(namedtuple('ValidationError', 'row column message')):
+    """One problem: 1-based ``row``, the ``column`` header and a ``message``."""
+    __slots__ = ()
+
+    def __str__(self):
+        return f"Row {self.row}, {self.column}: {self.message}"
+
+
+def _is_int(value):
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _failing(values, ok):
+    """Positions in ``values`` for which ``ok`` is false, testing each distinct value once."""
+    bad = {v for v in set(values) if not ok(v)}
+    if not bad:
+        return []
+    return [k for k, v in enumerate(values) if v in bad]
+
+
+def _correct_ok(pair):
+    response, correct = pair
+    if not correct or response.upper() == 'NA' or response.startswith('[text'):
+        return True
+    return correct in [r.strip() for r in response.split(',')]
+
+
+def validate_design(rows, images_dir=None, progress=None):
+    """Check design rows and return every problem as a :class:`ValidationError`.
+
+    Applies the same rules as :func:`peg_build.parse_design`. With
+    ``images_dir`` every referenced image and sound must also exist there; the
+    directory is listed once rather than checked file by file. An empty
+    list means the design compiles. ``progress(fraction)`` is called between
+    the checks.
+    """
+    if progress is None:
+        progress = lambda fraction: None
+    positions = [i for i, row in enumerate(rows) if any(v.strip() for v in row)]
+    if not positions:
+        return []
+    width = len(HEADERS)
+    columns = [[v.strip() for v in col] for col in zip(*((list(rows[i]) + [''] * width)[:width] for i in positions))]
+    errors = []
+    progress(0.2)
+
+    def report(ks, column, message):
+        errors.extend(ValidationError(positions[k] + 1, HEADERS[column], message) for k in ks)
+
+    # Block: integers; Block Repeats and Condition only count on the first row of each block
+    block = columns[BLOCK]
+    bad_blocks = _failing(block, _is_int)
+    report([k for k in bad_blocks if not block[k]], BLOCK, "Block cannot be empty.")
+    report([k for k in bad_blocks if block[k]], BLOCK, "Block must be an integer.")
+    bad_blocks = set(bad_blocks)
+    first_rows = {}
+    block_nums = {v: int(v) for v in set(block) if _is_int(v)}
+    for k, v in enumerate(block):
+        if k not in bad_blocks:
+            first_rows.setdefault(block_nums[v], k)
+    repeats = columns[BLOCK_REPEATS]
+    report(sorted(k for k in first_rows.values() if repeats[k] and not _is_int(repeats[k])),
+           BLOCK_REPEATS, "Block Repeats must be a number.")
+    block_order = sorted(first_rows, key=first_rows.get)
+    for block_num, k in first_rows.items():
+        condition = columns[CONDITION][k]
+        if not condition:
+            continue
+        try:
+            problem = check_placement(block_num, block_order) or \
+                check_targets(parse_condition(condition), block_num, block_order)
+        except ConditionError as e:
+            problem = str(e)
+        if problem:
+            report([k], CONDITION, problem)
+    if any(columns[CONDITION][k] for k in first_rows.values()):
+        for block_num, k in first_rows.items():
+            if _is_int(repeats[k]):
+                problem = check_repeats(block_num, int(repeats[k]), block_order)
+                if problem:
+                    report([k], BLOCK_REPEATS, problem)
+    progress(0.4)
+
+    response, latency = columns[RESPONSE], columns[LATENCY]
+    report(_failing(list(zip(response, latency)), lambda p: not (p[0].upper() == 'NA' and p[1].upper() == 'NA')),
+           LATENCY, "Response and Latency cannot both be NA.")
+    report(_failing(latency, lambda v: v.upper() == 'NA' or _is_int(v)),
+           LATENCY, "Latency must be a number or NA.")
+    report(_failing(list(zip(response, columns[CORRECT_RESPONSE])), _correct_ok),
+           CORRECT_RESPONSE, "Correct Response must be one of the Response options.")
+    report(_failing(columns[FEEDBACK_DURATION], lambda v: not v or _is_int(v)),
+           FEEDBACK_DURATION, "Feedback Duration must be a number.")
+    progress(0.6)
+
+    stimulus_errors = {}
+    for stimulus in set(columns[STIMULUS]):
+        try:
+            parse_stimulus(stimulus)
+        except StimulusError as e:
+            stimulus_errors[stimulus] = str(e)
+    for k, stimulus in enumerate(columns[STIMULUS]):
+        if stimulus in stimulus_errors:
+            report([k], STIMULUS, stimulus_errors[stimulus])
+    progress(0.8)
+
+    if images_dir is not None:
+        try:
+            available = set(os.listdir(images_dir))
+        except FileNotFoundError:
+            available = set()
+        missing = {}
+        for stimulus in set(columns[STIMULUS]) - set(stimulus_errors):
+            for kind, fname in media_files(parse_stimulus(stimulus)):
+                if fname and fname not in available and not os.path.isfile(os.path.join(images_dir, fname)):
+                    missing.setdefault(stimulus, []).append((kind, fname))
+        if missing:
+            for k, stimulus in enumerate(columns[STIMULUS]):
+                for kind, fname in missing.get(stimulus, ()):
+                    report([k], STIMULUS, f"{kind} file not found in ./images: {fname}")
+
+    progress(1.0)
+    errors.sort(key=lambda e: (e.row, HEADERS.index(e.column)))
+    return errors